@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Answer cache for the chat bot.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+ANSWER_CACHE_SIZE = int(os.environ.get('ANSWER_CACHE_SIZE', 512))
+ANSWER_CACHE_TTL = int(os.environ.get('ANSWER_CACHE_TTL', 3600))
+# "datastore" shares answers between instances; anything else keeps them
+# in this instance only.
+ANSWER_CACHE_BACKEND = os.environ.get('ANSWER_CACHE_BACKEND', '')
+# Seconds the corpus generation is trusted before it is read again.
+GENERATION_REFRESH = float(os.environ.get('CORPUS_GENERATION_REFRESH', 30))
+
+
+def normalize_question(question:str):
+  """Folds case, whitespace and trailing punctuation out of a question."""
+  return re.sub(r"\s+", " ", question.lower()).strip().rstrip("?!. ")
+
+
+class AnswerCache:
+  """
+  Bounded LRU cache of generated answers, keyed on question and agent.
+
+  Keys also carry the corpus generation that DriveWatch increments whenever
+  it changes the indexed documents, so answers from before a re-index are
+  never returned once the new generation has been read.
+  """
+
+  def __init__(self, max_size:int=ANSWER_CACHE_SIZE, ttl:int=ANSWER_CACHE_TTL,
+               backend:str=ANSWER_CACHE_BACKEND):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.backend = backend
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+    self._datastore = None
+    self._generation = None
+    self._generation_read = 0
+
+  def get(self, question:str, agent:str):
+    """Returns the cached answer, or None on a miss."""
+    if self.max_size <= 0:
+      return None
+    key = self._key(question, agent)
+    now = time.time()
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry and entry[0] > now:
+        self._entries.move_to_end(key)
+        return entry[1]
+      self._entries.pop(key, None)
+
+    if self.backend == "datastore":
+      shared = self._get_datastore().fetch_answer(key)
+      if shared and shared["expires"] > now:
+        answer = json.loads(shared["answer"])
+        self._remember(key, answer, shared["expires"])
+        return answer
+    return None
+
+  def put(self, question:str, agent:str, answer):
+    if self.max_size <= 0:
+      return
+    key = self._key(question, agent)
+    expires = time.time() + self.ttl
+    self._remember(key, answer, expires)
+    if self.backend == "datastore":
+      self._get_datastore().store_answer(key, json.dumps(answer), expires)
+
+  def _remember(self, key, answer, expires):
+    with self._lock:
+      self._entries[key] = (expires, answer)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+
+  def _key(self, question, agent):
+    key = f"{agent}\n{self._corpus_generation()}\n{normalize_question(question)}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+  def _corpus_generation(self):
+    now = time.time()
+    if now - self._generation_read > GENERATION_REFRESH:
+      self._generation = self._get_datastore().fetch("corpus_generation") or 0
+      self._generation_read = now
+    return self._generation
+
+  def _get_datastore(self):
+    # Created on first use so importing main stays free of client setup.
+    if self._datastore is None:
+      from datastore import Datastore
+      self._datastore = Datastore()
+    return self._datastore
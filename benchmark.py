@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Offline benchmark of the Drive to Cloud Storage sync.
+
+Runs DriveWatch.check_files end to end against the in-process fakes in
+fakeservices.py: an initial full sync of the generated folder, then an
+incremental sync after a share of the files has changed. Each folder size
+runs in its own process so peak RSS is measured per size.
+
+  python benchmark.py --sizes 1000 10000 100000 --latency-ms 5
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+FOLDER_ID = "root"
+BUCKET_NAME = "benchmark_bucket"
+
+
+def run_scenario(args):
+  """Runs one folder size in this process and returns its measurements."""
+  from drivewatch import DriveWatch
+  from fakeservices import (ApiStats, FakeBackend, FakeDatastore, FakeDiscoveryEngine,
+                            FakeDrive, FakeStorage)
+
+  stats = ApiStats()
+  backend = FakeBackend(stats, latency=args.latency_ms / 1000,
+                        error_rate=args.error_rate, seed=args.seed)
+  drive = FakeDrive(backend, FOLDER_ID, args.files,
+                    mean_size=int(args.mean_size_kb * 1024),
+                    page_size=args.page_size, seed=args.seed)
+  watch = DriveWatch(drive=drive,
+                     storage=FakeStorage(backend, drive),
+                     datastore=FakeDatastore(backend),
+                     discovery=FakeDiscoveryEngine(backend))
+
+  runs = []
+  for name in ("initial", "incremental"):
+    if name == "incremental":
+      drive.mutate(args.change_fraction)
+    stats.calls.clear()
+    stats.bytes_moved = 0
+    started = time.perf_counter()
+    watch.check_files(folder_id=FOLDER_ID, bucket_name=BUCKET_NAME)
+    runs.append({
+      "files": args.files,
+      "run": name,
+      "wall_seconds": round(time.perf_counter() - started, 3),
+      "api_calls": stats.total_calls(),
+      "calls": dict(stats.calls),
+      "bytes_moved": stats.bytes_moved,
+      # ru_maxrss is reported in KiB on Linux.
+      "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    })
+  return runs
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                      help="folder sizes to run, in files")
+  parser.add_argument("--latency-ms", type=float, default=5,
+                      help="latency added to every fake API call")
+  parser.add_argument("--error-rate", type=float, default=0.0,
+                      help="share of downloads and upload chunks that fail")
+  parser.add_argument("--page-size", type=int, default=1000,
+                      help="results per Drive list page")
+  parser.add_argument("--mean-size-kb", type=float, default=200,
+                      help="mean generated file size")
+  parser.add_argument("--change-fraction", type=float, default=0.01,
+                      help="share of files changed before the incremental run")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--json", action="store_true", help="print raw JSON results")
+  parser.add_argument("--files", type=int, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  # Each size runs in a child process, which prints its runs as JSON.
+  if args.files:
+    print(json.dumps(run_scenario(args)))
+    return
+
+  results = []
+  for size in args.sizes:
+    command = [sys.executable, os.path.abspath(__file__), "--files", str(size),
+               "--latency-ms", str(args.latency_ms), "--error-rate", str(args.error_rate),
+               "--page-size", str(args.page_size), "--mean-size-kb", str(args.mean_size_kb),
+               "--change-fraction", str(args.change_fraction), "--seed", str(args.seed)]
+    # The sync logs every transfer; only the last line is the result.
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    results += json.loads(output.strip().splitlines()[-1])
+
+  if args.json:
+    print(json.dumps(results, indent=2))
+    return
+
+  print(f"{'files':>8} {'run':<12} {'wall s':>9} {'api calls':>10} {'MiB moved':>10} {'peak RSS MiB':>13}")
+  for result in results:
+    print(f"{result['files']:>8} {result['run']:<12} {result['wall_seconds']:>9.2f} "
+          f"{result['api_calls']:>10} {result['bytes_moved'] / 2**20:>10.1f} "
+          f"{result['peak_rss_mb']:>13.1f}")
+
+
+if __name__ == '__main__':
+  main()
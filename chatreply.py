@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Asynchronous replies through the Google Chat API.
+"""
+
+import os
+import threading
+import time
+
+import clients
+
+# "async" answers in a task; anything else answers in the webhook.
+CHAT_REPLY_MODE = os.environ.get('CHAT_REPLY_MODE', 'sync')
+# "local" runs reply tasks on threads in the instance, for local runs and
+# tests; anything else creates them on the TASK_QUEUE Cloud Tasks queue.
+CHAT_REPLY_DISPATCH = os.environ.get('CHAT_REPLY_DISPATCH', 'cloudtasks')
+CHAT_API_ENDPOINT = os.environ.get('CHAT_API_ENDPOINT', 'https://chat.googleapis.com')
+CHAT_REPLY_DEADLINE = float(os.environ.get('CHAT_REPLY_DEADLINE', 120))
+# Threads answering with CHAT_REPLY_DISPATCH=local.
+CHAT_REPLY_WORKERS = int(os.environ.get('CHAT_REPLY_WORKERS', 4))
+# Least seconds between partial answer updates to one message.
+CHAT_PARTIAL_INTERVAL = float(os.environ.get('CHAT_PARTIAL_INTERVAL', 1))
+CHAT_REPLY_PATH = '/chat/reply'
+
+PLACEHOLDER_MESSAGE = 'Looking into that, one moment...'
+TIMEOUT_MESSAGE = 'Sorry, that took too long to answer. Please try again.'
+ERROR_MESSAGE = 'Sorry, something went wrong while answering.'
+
+
+class ChatClient:
+  """Creates and updates the bot's messages with the Chat REST API."""
+
+  def __init__(self, session=None, endpoint:str=CHAT_API_ENDPOINT):
+    # The shared session is authorized for the chat.bot scope; a plain
+    # requests session works against a local fake endpoint.
+    self.session = session or clients.get("chat")
+    self.endpoint = endpoint.rstrip("/")
+
+  def create_message(self, space:str, text:str, thread:str=None):
+    """Posts a message, in thread if given, and returns its resource name."""
+    body = {"text": text}
+    params = {}
+    if thread:
+      body["thread"] = {"name": thread}
+      params["messageReplyOption"] = "REPLY_MESSAGE_FALLBACK_TO_NEW_THREAD"
+    response = self.session.post(f"{self.endpoint}/v1/{space}/messages",
+                                 params=params, json=body)
+    response.raise_for_status()
+    return response.json()["name"]
+
+  def update_message(self, name:str, text:str):
+    response = self.session.patch(f"{self.endpoint}/v1/{name}",
+                                  params={"updateMask": "text"},
+                                  json={"text": text})
+    response.raise_for_status()
+
+
+class AsyncReplier:
+  """
+  Answers chat messages in tasks.
+
+  submit posts a placeholder and queues a task on the CHAT_REPLY_PATH route,
+  which calls reply to run answer_fn and swap the placeholder for its
+  result. If no result arrives within the deadline, counted from the
+  submission so that time spent queued counts too, the placeholder is
+  replaced with an apology instead.
+
+  With partial_replies, answer_fn is also given an on_partial callback, and
+  the text passed to it replaces the placeholder while the answer is still
+  being generated, at most once every CHAT_PARTIAL_INTERVAL seconds.
+  """
+
+  def __init__(self, answer_fn, chat:ChatClient=None, dispatcher=None,
+               deadline:float=CHAT_REPLY_DEADLINE, partial_replies:bool=False):
+    self.answer_fn = answer_fn
+    self.partial_replies = partial_replies
+    self.deadline = deadline
+    self._chat = chat
+    self._dispatcher = dispatcher
+
+  def submit(self, space:str, thread:str, *args):
+    """
+    Posts a placeholder in thread and queues answer_fn(*args) to replace it.
+
+    Returns False if the placeholder could not be posted, so the caller can
+    answer in the request. If the task cannot be queued, the answer is put
+    in the placeholder before this returns.
+    """
+    try:
+      name = self.chat().create_message(space, PLACEHOLDER_MESSAGE, thread)
+    except Exception as error:
+      print(f"Could not post placeholder: {error}")
+      return False
+
+    payload = {"message": name, "args": list(args), "submitted": time.time()}
+    try:
+      self.dispatcher().dispatch(payload, path=CHAT_REPLY_PATH)
+    except Exception as error:
+      print(f"Could not queue reply to {name}: {error}")
+      self.reply(payload)
+    return True
+
+  def chat(self):
+    # Created on first use so importing main stays free of client setup.
+    if self._chat is None:
+      self._chat = ChatClient()
+    return self._chat
+
+  def dispatcher(self):
+    if self._dispatcher is None:
+      from taskqueue import CloudTasksDispatcher, LocalDispatcher
+      if CHAT_REPLY_DISPATCH == 'local':
+        self._dispatcher = LocalDispatcher(self.reply, max_workers=CHAT_REPLY_WORKERS)
+      else:
+        self._dispatcher = CloudTasksDispatcher()
+    return self._dispatcher
+
+  def reply(self, payload:dict):
+    """Answers a question queued by submit, given the task's payload."""
+    name = payload["message"]
+    sent = threading.Event()
+    sent_lock = threading.Lock()
+
+    def send(text):
+      with sent_lock:
+        if sent.is_set():
+          return
+        sent.set()
+      try:
+        self.chat().update_message(name, text)
+      except Exception as error:
+        print(f"Could not update {name}: {error}")
+
+    remaining = self.deadline - (time.time() - payload["submitted"])
+    if remaining <= 0:
+      # The question waited in the queue for its whole deadline.
+      send(TIMEOUT_MESSAGE)
+      return
+
+    last_partial = [0.0]
+
+    def send_partial(text):
+      with sent_lock:
+        if sent.is_set() or time.monotonic() - last_partial[0] < CHAT_PARTIAL_INTERVAL:
+          return
+        last_partial[0] = time.monotonic()
+        try:
+          self.chat().update_message(name, text)
+        except Exception as error:
+          print(f"Could not update {name}: {error}")
+
+    # The timer only runs while this task's request does.
+    timer = threading.Timer(remaining, send, (TIMEOUT_MESSAGE,))
+    timer.daemon = True
+    timer.start()
+    try:
+      if self.partial_replies:
+        text = self.answer_fn(*payload["args"], on_partial=send_partial)
+      else:
+        text = self.answer_fn(*payload["args"])
+    except Exception as error:
+      print(f"Answer failed: {error}")
+      text = ERROR_MESSAGE
+    finally:
+      timer.cancel()
+    send(text)
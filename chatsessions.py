@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Dialogflow sessions kept per Chat thread.
+"""
+
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+SESSION_TABLE_SIZE = int(os.environ.get('SESSION_TABLE_SIZE', 1024))
+# Dialogflow CX ends a session after 30 idle minutes, so ours end first.
+SESSION_IDLE_TTL = int(os.environ.get('SESSION_IDLE_TTL', 25 * 60))
+
+
+class SessionTable:
+  """
+  Bounded LRU table of Dialogflow session ids, keyed on agent, space and thread.
+
+  Messages in the same Chat thread share a session, so follow-up questions
+  keep their context. A session idle for longer than ttl is replaced with
+  a fresh one, and the least recently used sessions are dropped once the
+  table holds max_size.
+  """
+
+  def __init__(self, max_size:int=SESSION_TABLE_SIZE, ttl:int=SESSION_IDLE_TTL):
+    self.max_size = max_size
+    self.ttl = ttl
+    self._sessions = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, agent:str, space:str, thread:str=None):
+    """Returns the session id for the thread, and whether it was just started."""
+    if not space or self.max_size <= 0:
+      return str(uuid.uuid4()), True
+    key = (agent, space, thread)
+    now = time.time()
+    with self._lock:
+      entry = self._sessions.get(key)
+      new = entry is None or entry[1] + self.ttl <= now
+      session_id = str(uuid.uuid4()) if new else entry[0]
+      self._sessions[key] = (session_id, now)
+      self._sessions.move_to_end(key)
+      while len(self._sessions) > self.max_size:
+        self._sessions.popitem(last=False)
+    return session_id, new
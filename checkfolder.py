@@ -16,15 +16,173 @@ See the License for the specific language governing permissions and
 limitations under the License.
 
 Drive watch initializer service.
+
+SYNC_TARGETS configures the folders one deployment syncs, as a JSON list
+of objects with a name, folder_id, bucket and datastore_id, e.g.
+
+  [{"name": "sales", "folder_id": "1AbC...", "bucket": "sales",
+    "datastore_id": "sales-docs"}]
+
+Buckets are named {PROJECT}_{bucket}, like BUCKET_NAME, and each target
+keeps its sync state in its own Datastore namespace, named after it.
+Without SYNC_TARGETS the one target is read from FOLDER_ID, BUCKET_NAME
+and DATASTORE_ID, with its state in the default namespace.
 """
 
+import json
 import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from datastore import Datastore
+from discoveryengine import DiscoveryEngine
+from driveservice import Drive
+from drivewatch import DriveWatch, SYNC_TIME_BUDGET
+from lease import Lease, wait_for
+from storageservice import Storage
+from transferpool import FairScheduler
+
+# Datastore namespaces allow these names, other than ones starting "__".
+_TARGET_NAME = re.compile(r"[0-9A-Za-z._-]{1,100}")
+
+
+class SyncTarget:
+  """A Drive folder synced to a bucket and indexed in a Discovery Engine datastore."""
+
+  def __init__(self, name:str, folder_id:str, bucket:str, datastore_id:str, namespace:str=None):
+    self.name = name
+    self.folder_id = folder_id
+    self.bucket_name = f"{os.environ.get('PROJECT')}_{bucket}"
+    self.datastore_id = datastore_id
+    self.namespace = namespace
+
+
+def load_targets():
+  """Returns the configured sync targets."""
+  config = os.environ.get('SYNC_TARGETS')
+  if not config:
+    return [SyncTarget("default", os.environ.get('FOLDER_ID'), os.environ.get('BUCKET_NAME'),
+                       os.environ.get('DATASTORE_ID'))]
+
+  targets = []
+  for entry in json.loads(config):
+    name = entry["name"]
+    if not _TARGET_NAME.fullmatch(name) or name.startswith("__"):
+      raise ValueError(f"Invalid sync target name: {name!r}")
+    targets.append(SyncTarget(name, entry["folder_id"], entry["bucket"],
+                              entry["datastore_id"], namespace=name))
+  if len({target.name for target in targets}) < len(targets):
+    raise ValueError("Sync target names must be unique")
+  return targets
+
+
+def search_datastore_id():
+  """
+  Returns the datastore that chat questions are searched in: DATASTORE_ID,
+  or else the datastore of the only sync target.
+  """
+  data_store_id = os.environ.get('DATASTORE_ID')
+  if data_store_id:
+    return data_store_id
+  targets = load_targets()
+  if len(targets) == 1 and targets[0].datastore_id:
+    return targets[0].datastore_id
+  raise ValueError("ANSWER_BACKEND=discoveryengine needs DATASTORE_ID set to the datastore "
+                   "to search, or SYNC_TARGETS with a single target")
+
+
+# Name of the lease a /watch run holds while it syncs.
+WATCH_LEASE = "watch"
 
-from drivewatch import DriveWatch
 
-def trigger_drive_watch():
-  DriveWatch().check_files(folder_id=os.environ.get('FOLDER_ID'), bucket_name=f"{os.environ.get('PROJECT')}_{os.environ.get('BUCKET_NAME')}")
+def watch_for(target:SyncTarget, drive:Drive=None, scheduler:FairScheduler=None,
+              lease:Lease=None):
+  """Builds the DriveWatch for one sync target."""
+  drive = drive or Drive()
+  return DriveWatch(drive=drive,
+                    storage=Storage(drive=drive),
+                    datastore=Datastore(namespace=target.namespace),
+                    discovery=DiscoveryEngine(data_store_id=target.datastore_id),
+                    target=target.name,
+                    scheduler=scheduler,
+                    lease=lease,
+                    corpus_state=Datastore())
+
+
+def trigger_drive_watch(dry_run=False):
+  """
+  Syncs every target concurrently.
+
+  The targets share one time budget and SYNC_WORKERS transfer slots, which
+  a FairScheduler hands out to them in turn. A target that fails is logged
+  and the others carry on.
+
+  A run holds the WATCH_LEASE lease throughout, and raises LeaseHeld if
+  another run already does.
+
+  With dry_run a dict is returned instead, with the plan of each target
+  under "plans" and the error of each target that failed under "errors",
+  both keyed by target name. Dry runs change nothing, so they take no
+  lease.
+  """
+  if dry_run:
+    plans, errors = _watch_targets(dry_run=True)
+    return {"plans": plans, "errors": errors}
+
+  datastore = Datastore()
+  with Lease(datastore, WATCH_LEASE) as lease:
+    _, errors = _watch_targets(lease=lease)
+    if errors:
+      lease.result = f"failed: {', '.join(errors)}"
+  # Lets the cron safety net skip runs while push notifications keep up.
+  datastore.store(key="last_sync", value=time.time())
   return 'Triggered Drive Watch'
 
+
+def _watch_targets(dry_run=False, lease=None):
+  """Runs every target's watch and returns their results and the errors of those that failed."""
+  targets = load_targets()
+  drive = Drive()
+  scheduler = FairScheduler()
+  deadline = time.monotonic() + SYNC_TIME_BUDGET
+
+  def watch(target):
+    return watch_for(target, drive, scheduler, lease).check_files(
+        folder_id=target.folder_id, bucket_name=target.bucket_name,
+        dry_run=dry_run, deadline=deadline)
+
+  with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+    futures = {target.name: executor.submit(watch, target) for target in targets}
+  results = {}
+  errors = {}
+  for name, future in futures.items():
+    try:
+      results[name] = future.result()
+    except Exception as error:
+      print(f"Sync of target {name} failed: {error}")
+      errors[name] = str(error)
+  return results, errors
+
+
+def wait_for_watch():
+  """Waits for the /watch run in progress to end and returns its lease row."""
+  return wait_for(Datastore(), WATCH_LEASE)
+
+
+def run_sync_task(payload:dict):
+  """
+  Carries out a task dispatched by the watch of the target it names.
+
+  A task for a target no longer in SYNC_TARGETS is logged and dropped, so
+  that Cloud Tasks does not retry it.
+  """
+  name = payload.get("target", "default")
+  target = next((target for target in load_targets() if target.name == name), None)
+  if target is None:
+    print(f"Dropping a task for sync target {name}, which is no longer configured.")
+    return
+  watch_for(target).run_task(**payload)
+
 if __name__ == '__main__':
   trigger_drive_watch()
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Process-wide registry of Google API clients.
+
+Clients are created on first use and shared by every request the instance
+serves. Client libraries are imported inside their factories, so a request
+only pays for the libraries it actually uses.
+"""
+
+import os
+import threading
+
+# Reentrant, as factories get the shared credentials while it is held.
+_lock = threading.RLock()
+_clients = {}
+# Each thread's authorized httplib2 connection.
+_local = threading.local()
+
+
+def _credentials():
+  import google.auth
+  credentials, _ = google.auth.default()
+  return credentials
+
+
+def _drive():
+  from googleapiclient.discovery import build
+  # Use the discovery document bundled with the library rather than
+  # fetching it over the network.
+  return build("drive", "v3", credentials=get("credentials"),
+               static_discovery=True, cache_discovery=False)
+
+
+def _serviceusage():
+  from googleapiclient.discovery import build
+  return build("serviceusage", "v1", credentials=get("credentials"),
+               static_discovery=True, cache_discovery=False)
+
+
+def _storage():
+  from google.cloud import storage
+  return storage.Client(credentials=get("credentials"))
+
+
+def _datastore():
+  from google.cloud import datastore
+  return datastore.Client(credentials=get("credentials"))
+
+
+def _discoveryengine_options():
+  from google.api_core.client_options import ClientOptions
+  if os.environ.get('LOCATION') == "global":
+    return None
+  return ClientOptions(api_endpoint=f"{os.environ.get('LOCATION')}-discoveryengine.googleapis.com")
+
+
+def _discoveryengine():
+  from google.cloud import discoveryengine_v1beta as discoveryengine_v1
+  return discoveryengine_v1.DocumentServiceClient(
+      credentials=get("credentials"), client_options=_discoveryengine_options())
+
+
+def _search():
+  from google.cloud import discoveryengine_v1beta as discoveryengine_v1
+  return discoveryengine_v1.SearchServiceClient(
+      credentials=get("credentials"), client_options=_discoveryengine_options())
+
+
+def _dialogflow():
+  from google.cloud import dialogflowcx_v3
+  return dialogflowcx_v3.SessionsClient(credentials=get("credentials"))
+
+
+def _chat():
+  import google.auth
+  from google.auth.transport.requests import AuthorizedSession
+  credentials, _ = google.auth.default(
+      scopes=["https://www.googleapis.com/auth/chat.bot"])
+  return AuthorizedSession(credentials)
+
+
+def _tasks():
+  import google.auth
+  from google.auth.transport.requests import AuthorizedSession
+  credentials, _ = google.auth.default(
+      scopes=["https://www.googleapis.com/auth/cloud-platform"])
+  return AuthorizedSession(credentials)
+
+
+_FACTORIES = {
+  "credentials": _credentials,
+  "drive": _drive,
+  "serviceusage": _serviceusage,
+  "storage": _storage,
+  "datastore": _datastore,
+  "discoveryengine": _discoveryengine,
+  "search": _search,
+  "dialogflow": _dialogflow,
+  "chat": _chat,
+  "tasks": _tasks,
+}
+
+
+def get(name:str):
+  """Returns the shared client for name, creating it on first use."""
+  client = _clients.get(name)
+  if client is None:
+    with _lock:
+      client = _clients.get(name)
+      if client is None:
+        client = _FACTORIES[name]()
+        _clients[name] = client
+  return client
+
+
+def http():
+  """
+  Returns this thread's authorized connection for googleapiclient requests.
+
+  httplib2 is not thread-safe, so each thread sends through its own
+  connection while sharing the discovery services and credentials.
+  """
+  connection = getattr(_local, "http", None)
+  if connection is None:
+    import httplib2
+    from google_auth_httplib2 import AuthorizedHttp
+    connection = AuthorizedHttp(get("credentials"), http=httplib2.Http())
+    _local.http = connection
+  return connection
+
+
+def register(name:str, client):
+  """Replaces the shared client for name, e.g. with a local fake."""
+  with _lock:
+    _clients[name] = client
+
+
+def warm_up():
+  """Creates every client ahead of the first request."""
+  for name in _FACTORIES:
+    get(name)
@@ -18,25 +18,255 @@ limitations under the License.
 Datastore service.
 """
 
+import datetime
+import json
+import time
 
 from google.cloud import datastore
 
+import clients
+import metrics
+
+# Largest number of keys a single lookup or write accepts.
+GET_BATCH_SIZE = 1000
+PUT_BATCH_SIZE = 500
+# Work items per queue row, keeping rows well under the 1 MiB entity limit.
+QUEUE_CHUNK_SIZE = 500
+
 class Datastore:
-  """Datastore class."""
+  """
+  Datastore class.
+
+  A namespace keeps the rows of one sync target apart from the others;
+  without one the default namespace is used.
+  """
+
+  def __init__(self, namespace:str=None):
+      self.client = clients.get("datastore")
+      self.namespace = namespace
 
-  def __init__(self):
-      self.client = datastore.Client()
+  def _key(self, table, name):
+    return self.client.key(table, name, namespace=self.namespace)
 
-  def store(self, key, value, table="settings"):
-    entity = datastore.Entity(key=self.client.key(table, "drive"))
-    obj={}
-    obj[key]=value
-    entity.update(obj)
-    res = self.client.put(entity)
+  def store(self, key, value, table="settings", indexed=True):
+    # Merge into the existing row so settings stored under other keys survive.
+    entity_key = self._key(table, "drive")
+    with metrics.timed("datastore", "transaction"), self.client.transaction():
+      entity = self.client.get(entity_key) or datastore.Entity(key=entity_key)
+      if not indexed:
+        # Unindexed strings may be longer than the 1500 byte index limit.
+        entity.exclude_from_indexes.add(key)
+      obj={}
+      obj[key]=value
+      entity.update(obj)
+      res = self.client.put(entity)
+
+  def increment(self, prop, table="settings"):
+    """Atomically adds one to a counter and returns its new value."""
+    entity_key = self._key(table, "drive")
+    with metrics.timed("datastore", "transaction"), self.client.transaction():
+      entity = self.client.get(entity_key) or datastore.Entity(key=entity_key)
+      entity[prop] = (entity.get(prop) or 0) + 1
+      self.client.put(entity)
+    return entity[prop]
 
   def fetch(self, prop, table="settings"):
-    key = self.client.key(table, "drive")
-    result = self.client.get(key)
+    key = self._key(table, "drive")
+    with metrics.timed("datastore", "lookup"):
+      result = self.client.get(key)
     if result is None:
       return None
     return result.get(prop)
+
+  def acquire_lease(self, name:str, holder:str, ttl:float, table="lease"):
+    """
+    Takes the lease called name for holder, unless another holder's is live.
+
+    Returns whether holder now has the lease, and the lease row as it stands.
+    """
+    key = self._key(table, name)
+    now = time.time()
+    with metrics.timed("datastore", "transaction"), self.client.transaction():
+      entity = self.client.get(key) or datastore.Entity(key=key)
+      if entity.get("holder") not in (None, holder) and entity.get("expires", 0) > now:
+        return False, dict(entity)
+      entity.update({"holder": holder, "started": now, "expires": now + ttl})
+      self.client.put(entity)
+    return True, dict(entity)
+
+  def renew_lease(self, name:str, holder:str, ttl:float, table="lease"):
+    """Extends holder's lease by ttl seconds; False if holder lost it."""
+    key = self._key(table, name)
+    with metrics.timed("datastore", "transaction"), self.client.transaction():
+      entity = self.client.get(key)
+      if entity is None or entity.get("holder") != holder:
+        return False
+      entity["expires"] = time.time() + ttl
+      self.client.put(entity)
+    return True
+
+  def release_lease(self, name:str, holder:str, result:str, table="lease"):
+    """Gives up holder's lease, recording how the run it covered ended."""
+    key = self._key(table, name)
+    with metrics.timed("datastore", "transaction"), self.client.transaction():
+      entity = self.client.get(key)
+      if entity is None or entity.get("holder") != holder:
+        return
+      entity.update({"holder": None, "expires": 0, "finished": time.time(),
+                     "result": result})
+      self.client.put(entity)
+
+  def fetch_lease(self, name:str, table="lease"):
+    with metrics.timed("datastore", "lookup"):
+      entity = self.client.get(self._key(table, name))
+    return dict(entity) if entity else None
+
+  def get_manifest(self, file_ids:list, table="manifest"):
+    """Fetches the sync manifest entries for file_ids, keyed by file id."""
+    keys = [self._key(table, file_id) for file_id in file_ids]
+    manifest = {}
+    for i in range(0, len(keys), GET_BATCH_SIZE):
+      with metrics.timed("datastore", "lookup"):
+        entities = self.client.get_multi(keys[i:i + GET_BATCH_SIZE])
+      for entity in entities:
+        manifest[entity.key.name] = dict(entity)
+    return manifest
+
+  def put_manifest(self, entries:dict, table="manifest"):
+    """Writes sync manifest entries, given as a dict keyed by file id."""
+    entities = []
+    for file_id, entry in entries.items():
+      # The manifest is only ever read by key, so nothing is indexed.
+      entity = datastore.Entity(key=self._key(table, file_id),
+                                exclude_from_indexes=tuple(entry))
+      entity.update(entry)
+      entities.append(entity)
+    for i in range(0, len(entities), PUT_BATCH_SIZE):
+      with metrics.timed("datastore", "commit"):
+        self.client.put_multi(entities[i:i + PUT_BATCH_SIZE])
+
+  def delete_manifest(self, file_ids:list, table="manifest"):
+    keys = [self._key(table, file_id) for file_id in file_ids]
+    for i in range(0, len(keys), PUT_BATCH_SIZE):
+      with metrics.timed("datastore", "commit"):
+        self.client.delete_multi(keys[i:i + PUT_BATCH_SIZE])
+
+  def get_references(self, names:list, table="object_refs"):
+    """Fetches the reference rows for names, keyed by name."""
+    return self.get_manifest(names, table=table)
+
+  def update_references(self, added:dict, removed:dict, details:dict=None,
+                        table="object_refs"):
+    """
+    Adds and removes the file ids referencing each name, in transactions.
+
+    added and removed map a name, such as an object's, to file ids, and
+    details to properties stored on its row, such as its generation. A
+    name's first file id stays first until it is removed.
+
+    Returns a tuple of each name's row before and after, keyed by name. A
+    row no file references any more is deleted and returned as None.
+    """
+    names = sorted(set(added) | set(removed))
+    changes = {}
+    for i in range(0, len(names), PUT_BATCH_SIZE):
+      keys = [self._key(table, name) for name in names[i:i + PUT_BATCH_SIZE]]
+      with metrics.timed("datastore", "transaction"), self.client.transaction():
+        rows = {entity.key.name: entity for entity in self.client.get_multi(keys)}
+        puts, deletes = [], []
+        for key in keys:
+          name = key.name
+          entity = rows.get(name)
+          before = dict(entity) if entity else None
+          gone = set(removed.get(name, ()))
+          file_ids = [file_id for file_id in (before or {}).get("file_ids", [])
+                      if file_id not in gone]
+          file_ids += [file_id for file_id in dict.fromkeys(added.get(name, ()))
+                       if file_id not in file_ids]
+          if not file_ids:
+            if entity:
+              deletes.append(key)
+            changes[name] = (before, None)
+            continue
+          entity = entity or datastore.Entity(key=key)
+          entity.exclude_from_indexes.update(("file_ids", *(details or {}).get(name, {})))
+          entity.update((details or {}).get(name, {}))
+          entity["file_ids"] = file_ids
+          puts.append(entity)
+          changes[name] = (before, dict(entity))
+        if puts:
+          self.client.put_multi(puts)
+        if deletes:
+          self.client.delete_multi(deletes)
+    return changes
+
+  def get_rows(self, table:str):
+    """Returns every row of table, keyed by name."""
+    with metrics.timed("datastore", "runQuery"):
+      entities = list(self.client.query(kind=table, namespace=self.namespace).fetch())
+    return {entity.key.name: dict(entity) for entity in entities}
+
+  def get_queue(self, table="sync_queue"):
+    """Returns the saved work queue, in the order it was saved."""
+    with metrics.timed("datastore", "runQuery"):
+      entities = list(self.client.query(kind=table, namespace=self.namespace).fetch())
+    items = []
+    for entity in sorted(entities, key=lambda entity: entity.key.id):
+      items += json.loads(entity["items"])
+    return items
+
+  def put_queue(self, items:list, table="sync_queue"):
+    """
+    Replaces the saved work queue with items.
+
+    The old rows are deleted before the new ones are written. A run that
+    dies in between leaves no queue, and the next run plans afresh.
+    """
+    query = self.client.query(kind=table, namespace=self.namespace)
+    query.keys_only()
+    with metrics.timed("datastore", "runQuery"):
+      keys = [entity.key for entity in query.fetch()]
+    for i in range(0, len(keys), PUT_BATCH_SIZE):
+      with metrics.timed("datastore", "commit"):
+        self.client.delete_multi(keys[i:i + PUT_BATCH_SIZE])
+
+    entities = []
+    for i in range(0, len(items), QUEUE_CHUNK_SIZE):
+      entity = datastore.Entity(key=self._key(table, i // QUEUE_CHUNK_SIZE + 1),
+                                exclude_from_indexes=("items",))
+      entity["items"] = json.dumps(items[i:i + QUEUE_CHUNK_SIZE])
+      entities.append(entity)
+    for i in range(0, len(entities), PUT_BATCH_SIZE):
+      with metrics.timed("datastore", "commit"):
+        self.client.put_multi(entities[i:i + PUT_BATCH_SIZE])
+
+  def fetch_answer(self, key:str, table="answer_cache"):
+    """
+    Returns a cached answer with expires in seconds since the epoch, or
+    None. An expired row is deleted as it is read.
+    """
+    with metrics.timed("datastore", "lookup"):
+      entity = self.client.get(self._key(table, key))
+    if not entity:
+      return None
+    answer = dict(entity)
+    if isinstance(answer["expires"], datetime.datetime):
+      answer["expires"] = answer["expires"].timestamp()
+    if answer["expires"] <= time.time():
+      with metrics.timed("datastore", "commit"):
+        self.client.delete(entity.key)
+      return None
+    return answer
+
+  def store_answer(self, key:str, answer:str, expires:float, table="answer_cache"):
+    """
+    Caches an answer until expires, in seconds since the epoch. It is stored
+    as a timestamp so that a TTL policy on expires deletes the row, including
+    rows of old corpus generations that are never read again.
+    """
+    entity = datastore.Entity(key=self._key(table, key),
+                              exclude_from_indexes=("answer", "expires"))
+    entity.update({"answer": answer,
+                   "expires": datetime.datetime.fromtimestamp(expires, datetime.timezone.utc)})
+    with metrics.timed("datastore", "commit"):
+      self.client.put(entity)
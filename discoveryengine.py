@@ -20,41 +20,175 @@ DiscoveryEngine service.
 
 import os
 
-from google.api_core.client_options import ClientOptions
+from google.api_core.exceptions import NotFound
 from google.cloud import discoveryengine_v1beta as discoveryengine_v1
+from google.longrunning import operations_pb2
+
+import clients
+import metrics
+
+# Largest number of documents an inline import request accepts.
+IMPORT_BATCH_SIZE = 100
+# Search results the answer summary is written from and cited.
+SUMMARY_RESULT_COUNT = int(os.environ.get('SUMMARY_RESULT_COUNT', 5))
+
 
 class DiscoveryEngine:
-  def __init__(self):
-    self.client = discoveryengine_v1.DocumentServiceClient(client_options = (
-        ClientOptions(api_endpoint=f"{os.environ.get('LOCATION')}-discoveryengine.googleapis.com")
-        if os.environ.get('LOCATION') != "global"
-        else None
-    ))
-
-  def updateCorpus(self):
-    parent = self.client.branch_path(
+  def __init__(self, data_store_id:str=None):
+    self.client = clients.get("discoveryengine")
+    self.data_store_id = data_store_id or os.environ.get('DATASTORE_ID')
+
+  def _branch_path(self):
+    return self.client.branch_path(
         project=os.environ.get('PROJECT'),
         location=os.environ.get('LOCATION'),
-        data_store=os.environ.get('DATASTORE_ID'),
+        data_store=self.data_store_id,
         branch="default_branch",
     )
 
+  def updateCorpus(self, documents:list=None, deleted_ids:list=None):
+    """
+    Re-indexes only the documents that changed.
+
+    documents are dicts with the id, Cloud Storage uri and mime_type of each
+    changed object, and the file_id of a Drive file holding it, which is
+    stored with the document for links. They are imported incrementally,
+    and the documents for deleted_ids are removed. The imports are left
+    running. Returns the documents of each import keyed by the name of its
+    operation, so that later runs can poll them and import again the
+    documents of one that failed.
+    """
+    parent = self._branch_path()
+    for document_id in deleted_ids or []:
+      try:
+        with metrics.timed("discoveryengine", "documents.delete"):
+          self.client.delete_document(name=f"{parent}/documents/{document_id}")
+      except NotFound:
+        pass
+
+    documents = documents or []
+    operations = {}
+    for i in range(0, len(documents), IMPORT_BATCH_SIZE):
+      request = discoveryengine_v1.ImportDocumentsRequest(
+          parent=parent,
+          reconciliation_mode=discoveryengine_v1.ImportDocumentsRequest.ReconciliationMode.INCREMENTAL,
+          inline_source=discoveryengine_v1.ImportDocumentsRequest.InlineSource(
+            documents=[
+              discoveryengine_v1.Document(
+                id=document["id"],
+                struct_data={"file_id": document["file_id"]},
+                content=discoveryengine_v1.Document.Content(
+                  uri=document["uri"],
+                  mime_type=document["mime_type"]
+                )
+              )
+              for document in documents[i:i + IMPORT_BATCH_SIZE]
+            ]
+          )
+      )
+
+      with metrics.timed("discoveryengine", "documents.import"):
+        operation = self.client.import_documents(request=request)
+      print(f"Started import {operation.operation.name}")
+      operations[operation.operation.name] = documents[i:i + IMPORT_BATCH_SIZE]
+    return operations
+
+  def import_jsonl(self, uris:list):
+    """
+    Imports documents incrementally from JSONL files in Cloud Storage.
+
+    Each line is a Document as JSON, with its id, its metadata as jsonData
+    and its content. The import is left running, and the name of its
+    operation is returned.
+    """
     request = discoveryengine_v1.ImportDocumentsRequest(
-        parent=parent,
-        reconciliation_mode=discoveryengine_v1.ImportDocumentsRequest.ReconciliationMode.FULL,
-          gcs_source=discoveryengine_v1.GcsSource(
-            input_uris=[
-              f"gs://{os.environ.get('PROJECT')}_{os.environ.get('BUCKET_NAME')}/*.pdf"
-            ],
-            data_schema="content"
-        )
+        parent=self._branch_path(),
+        reconciliation_mode=discoveryengine_v1.ImportDocumentsRequest.ReconciliationMode.INCREMENTAL,
+        gcs_source=discoveryengine_v1.GcsSource(input_uris=uris, data_schema="document"),
     )
+    with metrics.timed("discoveryengine", "documents.import"):
+      operation = self.client.import_documents(request=request)
+    print(f"Started import {operation.operation.name}")
+    return operation.operation.name
+
+  def poll_operations(self, names:list):
+    """
+    Checks on earlier imports and returns the names of those still running
+    and of those that failed, whole or for some of their documents.
+    """
+    pending, failed = [], []
+    for name in names:
+      try:
+        with metrics.timed("discoveryengine", "operations.get"):
+          operation = self.client.get_operation(
+              request=operations_pb2.GetOperationRequest(name=name))
+      except NotFound:
+        print(f"Import {name} no longer exists.")
+        continue
+
+      if not operation.done:
+        pending.append(name)
+      elif operation.HasField("error"):
+        print(f"Import {name} failed: {operation.error.message}")
+        failed.append(name)
+      else:
+        response = discoveryengine_v1.ImportDocumentsResponse.deserialize(
+            operation.response.value)
+        if response.error_samples:
+          print(f"Import {name} failed for some documents: {response.error_samples[0].message}")
+          failed.append(name)
+        else:
+          print(f"Import {name} finished.")
+    return pending, failed
 
-    operation = self.client.import_documents(request=request)
 
-    print("Waiting for operation to complete...")
+class SearchAnswers:
+  """Answers questions with a summarized search of the datastore."""
 
-    response = operation.result()
+  def __init__(self, data_store_id:str):
+    self.client = clients.get("search")
+    self.data_store_id = data_store_id
+
+  def answer(self, question:str):
+    """
+    Searches the datastore and returns its summary with the cited documents.
+
+    The answer is a dict with the summary text, whose [n] markers refer to
+    the n-th citation, and a citation per result with its title and Drive
+    link. Documents carry the id of a Drive file holding their content, so
+    the links need no lookup; older documents are named after theirs.
+    Chunks imported as text carry their file's title too.
+    """
+    request = discoveryengine_v1.SearchRequest(
+        serving_config=self.client.serving_config_path(
+          project=os.environ.get('PROJECT'),
+          location=os.environ.get('LOCATION'),
+          data_store=self.data_store_id,
+          serving_config="default_search",
+        ),
+        query=question,
+        page_size=SUMMARY_RESULT_COUNT,
+        content_search_spec=discoveryengine_v1.SearchRequest.ContentSearchSpec(
+          summary_spec=discoveryengine_v1.SearchRequest.ContentSearchSpec.SummarySpec(
+            summary_result_count=SUMMARY_RESULT_COUNT,
+            include_citations=True,
+            ignore_adversarial_query=True,
+            ignore_non_summary_seeking_query=True,
+          )
+        ),
+    )
+    with metrics.timed("discoveryengine", "search"):
+      response = self.client.search(request=request)
 
-    # Handle the response
-    print(response)
+    citations = []
+    # Only the first page is fetched; the pager hands back its fields.
+    for result in list(response.results)[:SUMMARY_RESULT_COUNT]:
+      data = result.document.derived_struct_data
+      struct = result.document.struct_data or {}
+      file_id = struct.get("file_id") or result.document.id
+      citations.append({
+        "title": (struct.get("title") or (data.get("title") if data else None)
+                  or result.document.id),
+        "link": f"https://drive.google.com/open?id={file_id}",
+      })
+    return {"text": response.summary.summary_text, "citations": citations}
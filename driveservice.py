@@ -19,97 +19,369 @@ Drive service.
 """
 
 import io
+import json
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
 
-import google.auth
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload
 
+import clients
+import metrics
+import ratelimit
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+SHORTCUT_MIME_TYPE = "application/vnd.google-apps.shortcut"
+FILE_FIELDS = ("id, name, modifiedTime, mimeType, parents, md5Checksum, version, size, "
+               "shortcutDetails(targetId, targetMimeType)")
+# Largest page size files.list accepts.
+PAGE_SIZE = 1000
+# Parents per files.list query, which keeps each query well under the
+# length limit for q.
+QUERY_BATCH_SIZE = int(os.environ.get('DRIVE_QUERY_BATCH_SIZE', 50))
+LIST_WORKERS = int(os.environ.get('DRIVE_LIST_WORKERS', 8))
+# Largest number of calls a Drive batch request accepts.
+BATCH_SIZE = 100
+# Bytes held per transfer step. Cloud Storage needs resumable upload chunks
+# in multiples of 256 KiB, so the configured size is rounded up to one.
+_CHUNK_MULTIPLE = 256 * 1024
+CHUNK_SIZE = max(1, math.ceil(int(os.environ.get('TRANSFER_CHUNK_SIZE', 8 * 1024 * 1024))
+                              / _CHUNK_MULTIPLE)) * _CHUNK_MULTIPLE
+
+
+GOOGLE_APPS_PREFIX = "application/vnd.google-apps."
+# Format each Google file type is exported to. Types left out, such as
+# forms, shortcuts and sites, cannot be exported and are not synced.
+DEFAULT_EXPORT_FORMATS = {
+  "application/vnd.google-apps.document": "text/html",
+  "application/vnd.google-apps.spreadsheet":
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+  "application/vnd.google-apps.presentation": "text/plain",
+  "application/vnd.google-apps.drawing": "application/pdf",
+}
+# A JSON object overriding the defaults per type, for example
+# {"application/vnd.google-apps.spreadsheet": "text/csv"}.
+EXPORT_FORMATS = {**DEFAULT_EXPORT_FORMATS,
+                  **json.loads(os.environ.get('EXPORT_FORMATS') or '{}')}
+# Files larger than this many bytes are not synced.
+MAX_FILE_SIZE = int(os.environ.get('MAX_FILE_SIZE', 100 * 1024 * 1024))
+
+
+def get_export_format(mime_type:str):
+  """Returns the format a Google file is exported to, or None if downloaded as-is."""
+  return EXPORT_FORMATS.get(mime_type)
+
+
+def get_content_type(mime_type:str):
+  """Returns the type a file is stored as, or None if it cannot be synced."""
+  if mime_type.startswith(GOOGLE_APPS_PREFIX):
+    return get_export_format(mime_type)
+  return mime_type
+
 
 class Drive:
   """Drive Service."""
 
   def __init__(self):
-    self.creds, _ = google.auth.default()
-    self.service = build("drive", "v3", credentials=self.creds)
-
-  def get_drive_blob(self, file_id:str='', mime_type:str=''):
-    if not file_id: return
+    self.service = clients.get("drive")
 
-    try:
-      if "google" in mime_type:
-        print("exporting google file type")
-        request = self.service.files().export_media(
-          fileId=file_id, mimeType="application/pdf"
-        ).execute()
-        return request
-      else:
-        print("exporting to bytes")
-        request = self.service.files().get_media(fileId=file_id)
-
-
-      file = io.BytesIO()
-      downloader = MediaIoBaseDownload(file, request)
-      done = False
-      while done is False:
-        status, done = downloader.next_chunk()
+  def open_drive_blob(self, file_id:str='', mime_type:str='', chunk_size:int=CHUNK_SIZE):
+    """
+    Opens a readable stream over a Drive file's content.
 
-    except HttpError as error:
-      print(f"An error occurred: {error}")
-      file = None
+    Google files are exported to their format in EXPORT_FORMATS and every
+    other file is downloaded as-is. The first chunk is fetched here, so an HttpError for a file that
+    cannot be read is raised before any upload is started.
+    """
+    if not file_id: return
 
-    if not file:
-      return
+    export_format = get_export_format(mime_type)
+    if export_format:
+      print("exporting google file type")
+      request = self.service.files().export_media(
+        fileId=file_id, mimeType=export_format
+      )
+      operation = "files.export"
+    else:
+      print("exporting to bytes")
+      request = self.service.files().get_media(fileId=file_id)
+      operation = "files.get_media"
+    request.http = clients.http()
+    return DriveStream(request, chunk_size, operation=operation)
 
-    return file.getvalue()
+  def list_drive_files(self, folder_id:str='', folders:list=None):
+    """
+    Yields every file, other than folders, anywhere under folder_id.
 
-  def list_folders(self, folder_ids:list=[]):
-    if not folder_ids: return
-    join_query = ""
-    for folder_id in folder_ids:
-      join_query+=f"'{folder_id}' in parents"
+    The tree is walked breadth first. Each level's folder ids are split into
+    queries of at most QUERY_BATCH_SIZE parents, which are listed
+    concurrently with every page collected. Only one level of folder ids is
+    held at a time, and files are yielded as each query completes. The ids
+    of the folders walked, folder_id's included, are appended to folders if
+    given.
+    """
+    if not folder_id: return
+    level = [folder_id]
+    with ThreadPoolExecutor(max_workers=LIST_WORKERS) as executor:
+      while level:
+        if folders is not None:
+          folders.extend(level)
+        batches = [level[i:i + QUERY_BATCH_SIZE]
+                   for i in range(0, len(level), QUERY_BATCH_SIZE)]
+        level = []
+        for files in executor.map(self._list_children, batches):
+          for file in files:
+            if file["mimeType"] == FOLDER_MIME_TYPE:
+              level.append(file["id"])
+            else:
+              yield file
 
-    query = f"({join_query}) and trashed = false and mimeType = 'application/vnd.google-apps.folder'"
+  def _list_children(self, folder_ids:list):
+    parents_query = " or ".join(f"'{folder_id}' in parents" for folder_id in folder_ids)
+    query = f"({parents_query}) and trashed = false"
+    files = []
     page_token = None
     while True:
-      results = self.service.files().list(
+      request = self.service.files().list(
         q=query,
-        pageSize=10,
-        fields="nextPageToken, files(id)",
+        pageSize=PAGE_SIZE,
+        fields=f"nextPageToken, files({FILE_FIELDS})",
         pageToken=page_token
-      ).execute()
+      )
+      results = ratelimit.call("drive", "files.list",
+                               lambda: request.execute(http=clients.http()))
+      files.extend(results.get("files", []))
       page_token = results.get("nextPageToken", None)
 
       if page_token is None:
         break
+    return files
 
-    returnedIds = [file['id'] for file in results.get("files", [])]
-    response = self.list_folders(returnedIds) or []
-    return response + returnedIds
+  def get_start_page_token(self):
+    """Returns the token marking the current head of the changes feed."""
+    request = self.service.changes().getStartPageToken()
+    response = ratelimit.call("drive", "changes.getStartPageToken",
+                              lambda: request.execute(http=clients.http()))
+    return response.get("startPageToken")
 
+  def watch_changes(self, page_token:str, channel_id:str, address:str, token:str,
+                    expiration:int):
+    """
+    Opens a push channel that notifies address of every change after page_token.
 
-  def list_drive_files(self, folder_id:str=''):
-    if not folder_id: return
-    folder_ids = self.list_folders([folder_id])
-    folder_id_query = [f"'{folder_id}' in parents" for folder_id in folder_ids]
-    query = f"({' or '.join(folder_id_query)}) and mimeType != 'application/vnd.google-apps.folder'"
+    expiration is in milliseconds since the epoch. Returns the channel,
+    with the resourceId needed to stop it and its actual expiration.
+    """
+    request = self.service.changes().watch(
+      pageToken=page_token,
+      includeRemoved=True,
+      spaces="drive",
+      body={"id": channel_id, "type": "web_hook", "address": address,
+            "token": token, "expiration": expiration}
+    )
+    return ratelimit.call("drive", "changes.watch",
+                          lambda: request.execute(http=clients.http()))
+
+  def stop_channel(self, channel_id:str, resource_id:str):
+    request = self.service.channels().stop(
+      body={"id": channel_id, "resourceId": resource_id}
+    )
+    ratelimit.call("drive", "channels.stop", lambda: request.execute(http=clients.http()))
+
+  def list_changes(self, page_token:str):
+    """
+    Lists every change recorded since page_token.
 
+    Returns a tuple of the changes and the token to start from on the next
+    run, or None when the token has expired and a full rescan is required.
+    """
+    changes = []
+    next_page_token = page_token
     try:
-      page_token = None
-      while True:
-        results = self.service.files().list(
-          q=query,
-          pageSize=10,
-          fields="nextPageToken, files(id, name, modifiedTime, mimeType)",
-          pageToken=page_token
-        ).execute()
-        page_token = results.get("nextPageToken", None)
-
-        if page_token is None:
-          break
+      while next_page_token:
+        request = self.service.changes().list(
+          pageToken=next_page_token,
+          pageSize=PAGE_SIZE,
+          includeRemoved=True,
+          spaces="drive",
+          fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file({FILE_FIELDS}, trashed))"
+        )
+        results = ratelimit.call("drive", "changes.list",
+                                 lambda: request.execute(http=clients.http()))
+        changes.extend(results.get("changes", []))
+        if "newStartPageToken" in results:
+          return changes, results["newStartPageToken"]
+        next_page_token = results.get("nextPageToken")
 
     except HttpError as error:
+      if error.resp.status in (400, 404, 410):
+        print(f"Start page token rejected: {error}")
+        return None
       print(f"An error occurred: {error}")
-      results = None
 
-    return results
+    # Retry from the same token on the next run rather than skip changes.
+    return [], page_token
+
+  def is_in_folder(self, parents:list, folder_id:str, cache:dict):
+    """
+    Checks whether any of parents is folder_id or one of its descendants.
+
+    The answer for every folder looked up is recorded in cache, so sibling
+    files cost no further lookups.
+    """
+    self.resolve_folders(parents or [], folder_id, cache)
+    return any(cache[parent] for parent in parents or [])
+
+  def resolve_folders(self, folder_ids, folder_id:str, cache:dict):
+    """
+    Records in cache whether each of folder_ids is folder_id or one of its descendants.
+
+    The tree is walked up a level at a time for all the folders together,
+    with each level's parents fetched in batch requests, so a whole changes
+    feed costs one round of lookups per level of nesting.
+    """
+    cache.setdefault(folder_id, True)
+    parent_of = {}
+    level = {folder for folder in folder_ids if folder and folder not in cache}
+    while level:
+      files = self.get_files(sorted(level), fields="parents")
+      for folder in level:
+        parent_of[folder] = ((files.get(folder) or {}).get("parents") or [None])[0]
+      level = {parent for parent in map(parent_of.get, level)
+               if parent and parent not in cache and parent not in parent_of}
+
+    for folder in parent_of:
+      visited = []
+      current = folder
+      while current and current not in cache:
+        visited.append(current)
+        current = parent_of[current]
+      found = bool(current) and cache[current]
+      for visited_folder in visited:
+        cache[visited_folder] = found
+
+  def resolve_shortcuts(self, files:list):
+    """
+    Returns files with each shortcut replaced by the file it points to.
+
+    A resolved shortcut keeps its own id, name, parents and trashed state,
+    so it is synced as a file of the folder, and takes the rest of its
+    metadata from its target, whose id is added as targetId. Shortcuts to
+    folders, and to files that are gone or in the trash, are returned as
+    they are and so are not synced. The targets are fetched with batch
+    requests.
+    """
+    target_ids = {file["shortcutDetails"]["targetId"] for file in files
+                  if file.get("mimeType") == SHORTCUT_MIME_TYPE
+                  and file.get("shortcutDetails", {}).get("targetMimeType") != FOLDER_MIME_TYPE}
+    if not target_ids:
+      return files
+    targets = self.get_files(sorted(target_ids), fields=f"{FILE_FIELDS}, trashed")
+    resolved = []
+    for file in files:
+      target = targets.get((file.get("shortcutDetails") or {}).get("targetId"))
+      if file.get("mimeType") == SHORTCUT_MIME_TYPE and target and not target.get("trashed"):
+        file = {**target, "id": file["id"], "name": file["name"],
+                "parents": file.get("parents"), "trashed": file.get("trashed", False),
+                "targetId": target["id"]}
+      resolved.append(file)
+    return resolved
+
+  def get_files(self, file_ids:list, fields:str):
+    """
+    Fetches fields of each of file_ids with batch requests of up to BATCH_SIZE calls.
+
+    Returns the files keyed by id. Files that cannot be read are left out,
+    and calls that fail with retryable errors are retried until their
+    attempts run out, when the error is raised rather than the file dropped.
+    """
+    files = {}
+    pending = list(file_ids)
+    attempt = 0
+    while pending:
+      retry = []
+      last_error = None
+      for i in range(0, len(pending), BATCH_SIZE):
+        chunk = pending[i:i + BATCH_SIZE]
+        responses = ratelimit.call("drive", "batch",
+                                   lambda: self._execute_batch(chunk, fields),
+                                   cost=len(chunk))
+        for file_id, (response, error) in responses.items():
+          if error is None:
+            files[file_id] = response
+          elif ratelimit.is_retryable(error):
+            retry.append(file_id)
+            last_error = error
+          else:
+            print(f"An error occurred: {error}")
+      if retry:
+        ratelimit.wait_to_retry("drive", "files.get", last_error, attempt)
+        attempt += 1
+      pending = retry
+    return files
+
+  def _execute_batch(self, file_ids:list, fields:str):
+    responses = {}
+
+    def callback(request_id, response, exception):
+      responses[request_id] = (response, exception)
+
+    batch = self.service.new_batch_http_request(callback=callback)
+    for file_id in file_ids:
+      batch.add(self.service.files().get(fileId=file_id, fields=fields), request_id=file_id)
+    batch.execute(http=clients.http())
+    return responses
+
+
+class DriveStream(io.RawIOBase):
+  """
+  Reads a Drive download or export one chunk at a time.
+
+  At most one downloaded chunk is buffered, so the stream can be handed to
+  a resumable upload without the whole file ever being held in memory.
+  """
+
+  def __init__(self, request, chunk_size:int=CHUNK_SIZE, operation:str="files.get_media"):
+    self._operation = operation
+    self._buffer = io.BytesIO()
+    self._downloader = MediaIoBaseDownload(self._buffer, request, chunksize=chunk_size)
+    self._chunk = b""
+    self._offset = 0
+    self._position = 0
+    self._done = False
+    self._fetch()
+
+  def _fetch(self):
+    # A failed chunk leaves the download where it was, so it can be retried.
+    _, self._done = ratelimit.call("drive", self._operation, self._downloader.next_chunk)
+    self._chunk = self._buffer.getvalue()
+    metrics.add_bytes("drive", "download", len(self._chunk))
+    self._offset = 0
+    self._buffer.seek(0)
+    self._buffer.truncate()
+
+  def readable(self):
+    return True
+
+  def tell(self):
+    return self._position
+
+  def read(self, size=-1):
+    """Reads size bytes, returning fewer only at the end of the file."""
+    parts = []
+    remaining = size
+    while remaining != 0:
+      if self._offset >= len(self._chunk):
+        if self._done:
+          break
+        self._fetch()
+        continue
+      end = len(self._chunk) if remaining < 0 else self._offset + remaining
+      part = self._chunk[self._offset:end]
+      self._offset += len(part)
+      remaining -= len(part) if remaining > 0 else 0
+      parts.append(part)
+    data = b"".join(parts)
+    self._position += len(data)
+    return data
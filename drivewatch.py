@@ -18,67 +18,656 @@ limitations under the License.
 Drive watch of set Folder for delta changes.
 """
 
-import datetime
-from dateutil import tz
+import base64
+import collections
+import hashlib
+import itertools
+import json
+import os
+import time
+import uuid
 
-from driveservice import Drive
+from googleapiclient.errors import HttpError
+
+import metrics
+import ratelimit
+from driveservice import (FILE_FIELDS, FOLDER_MIME_TYPE, Drive, get_content_type,
+                          get_export_format)
 from storageservice import Storage
-from datastore import Datastore
+from datastore import Datastore, GET_BATCH_SIZE
 from discoveryengine import DiscoveryEngine
+from syncplanner import (SyncPlan, SyncPlanner, document_id, is_current, object_name,
+                         plan_changes)
+from taskqueue import TASK_BATCH_SIZE, get_dispatcher
+from textextract import chunk_id, chunk_text, extract_text, is_extractable
+from transferpool import SYNC_WORKERS, TransferPool, TransferResult
+
+# Seconds a sync may spend starting transfers. Work left over is saved and
+# picked up by the next run, well within App Engine's 10 minute deadline.
+SYNC_TIME_BUDGET = float(os.environ.get('SYNC_TIME_BUDGET', 420))
+
+# Content types Discovery Engine indexes as unstructured documents. Objects
+# of other types, such as CSV exports, are stored but not imported.
+INDEXED_CONTENT_TYPES = (
+  "application/pdf",
+  "text/html",
+  "text/plain",
+  "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+  "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+  "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+)
+
+# "1" to extract the text of documents here, split it into chunks and
+# import those, rather than have Discovery Engine parse every object.
+CHUNKED_IMPORT = os.environ.get('CHUNKED_IMPORT', '') in ('1', 'true')
+# Objects larger than this are imported whole instead of read into memory.
+# Each sync worker may hold one, as may each target's.
+EXTRACT_MAX_BYTES = int(os.environ.get('EXTRACT_MAX_BYTES', 10 * 1024 * 1024))
+# Chunks written per JSONL file, each imported by one operation.
+CHUNK_IMPORT_BATCH_SIZE = 10000
+# Where the JSONL files are written in the bucket. The sync leaves them
+# out, and they are deleted once the imports have had a day to read them.
+IMPORT_PREFIX = "_imports/"
+IMPORT_FILE_TTL = 24 * 3600
+# Times an import is started before its documents are given up on.
+IMPORT_ATTEMPTS = 3
 
 
 class DriveWatch:
   """Manages the Cron Job watching for Folder Activity."""
-  def __init__(self):
-    self.storage = Storage()
-    self.drive = Drive()
-    self.datastore = Datastore()
-    self.discovery = DiscoveryEngine()
-
-  def check_files(self, folder_id, bucket_name):
-    response = self.drive.list_drive_files(folder_id)
-    if not response:
+  def __init__(self, drive=None, storage=None, datastore=None, discovery=None,
+               dispatcher=None, target="default", scheduler=None, corpus_state=None,
+               lease=None):
+    self.drive = drive or Drive()
+    self.storage = storage or Storage(drive=self.drive)
+    self.datastore = datastore or Datastore()
+    self.discovery = discovery or DiscoveryEngine()
+    self.dispatcher = dispatcher or get_dispatcher(lambda payload: self.run_task(**payload))
+    # The sync target this watch serves, named in tasks and metrics.
+    self.target = target
+    # Shares transfer slots with the other targets' watches.
+    self.scheduler = scheduler
+    # Where corpus_generation is counted, which the answer cache reads from
+    # the default namespace whatever the target.
+    self.corpus_state = corpus_state or self.datastore
+    # The run's lease; once it is lost no more transfers are started.
+    self.lease = lease
+
+  def check_files(self, folder_id, bucket_name, dry_run=False, deadline=None):
+    """
+    Syncs the folder to the bucket.
+
+    Applies only the changes recorded in the Drive changes feed since the last
+    run, and falls back to a full rescan when no start page token is stored
+    yet or the stored one has expired. Imports started by earlier runs and
+    tasks are polled rather than waited on, and started again if they failed.
+
+    Transfers are started, most urgent first, for up to SYNC_TIME_BUDGET
+    seconds. The rest of the plan is checkpointed to Datastore and carried
+    on by the next run before any new changes are read.
+
+    deadline, a time.monotonic() value, replaces the time budget, e.g. to
+    share one budget between targets.
+
+    With dry_run nothing is transferred or stored, and the plan the sync
+    would carry out is returned as a dict instead.
+    """
+    if dry_run:
+      plan, _ = self._resume() or self._plan(folder_id, bucket_name)
+      return plan.to_dict()
+
+    with metrics.stage("sync", target=self.target, folder_id=folder_id, bucket=bucket_name):
+      self._poll_imports()
+      self._sync(folder_id, bucket_name,
+                 deadline or time.monotonic() + SYNC_TIME_BUDGET)
+
+  def _poll_imports(self):
+    """
+    Polls the imports in the imports table, and starts those that failed again.
+
+    An import's row is deleted once it finishes, or once it has failed
+    IMPORT_ATTEMPTS times.
+    """
+    imports = self.datastore.get_rows("imports")
+    if not imports:
       return
-    files = response.get("files", [])
-    if not files:
+    pending, failed = self.discovery.poll_operations(sorted(imports))
+    if len(pending) < len(imports):
+      # Finished imports changed the index, so cached answers are stale.
+      self.corpus_state.increment("corpus_generation")
+    for name in failed:
+      attempts = imports[name]["attempts"]
+      if attempts >= IMPORT_ATTEMPTS:
+        print(f"Import {name} failed {attempts} times, giving up on it.")
+        continue
+      source = json.loads(imports[name]["source"])
+      if "uris" in source:
+        self._import_files(source["uris"], attempts + 1)
+      else:
+        self._import_documents(source["documents"], attempts=attempts + 1)
+    self.datastore.delete_manifest([name for name in imports if name not in pending],
+                                   table="imports")
+
+  def _sync(self, folder_id, bucket_name, deadline):
+    try:
+      with metrics.stage("plan", target=self.target) as fields:
+        resumed = self._resume()
+        plan, new_page_token = resumed or self._plan(folder_id, bucket_name)
+        fields.update(resumed=bool(resumed), rescan=plan.rescan, uploads=len(plan.uploads),
+                      reexports=len(plan.reexports), deletes=len(plan.deletes), noops=plan.noops)
+    except HttpError as error:
+      # An incomplete listing would look like deleted files, so stop here.
+      print(f"An error occurred: {error}")
       return
-    stored_files = self.storage.list_bucket_files(bucket_name=bucket_name)
-    # Get last update time.
-    last_update =self.datastore.fetch("last_update")
-
-    files_modified=False
-    for file in files:
-      # TODO: Remove the filename from the StorageList
-      filename = f"{file['id']}.pdf"
-      if filename in stored_files:
-        stored_files.remove(filename)
-
-      # Check if modified time is greater than last update.
-      last_modified = datetime.datetime.strptime(file["modifiedTime"],
-                                        '%Y-%m-%dT%H:%M:%S.%fZ').astimezone(tz = tz.tzlocal())
-      last_update = last_update.astimezone(tz = tz.tzlocal())
-
-      if not last_update or (int(last_modified.strftime('%Y%m%d%H%M%S'))
-                             > int(last_update.strftime('%Y%m%d%H%M%S'))
-                            ):
-        # Upload file to bucket.
-        self.storage.upload_file(bucket_name=bucket_name,
-                                 file_id=file["id"],
-                                 mime_type=file["mimeType"])
-        files_modified=True
-    files_deleted = False
-    for stored_file in stored_files:
-      self.storage.delete_blob(bucket_name=bucket_name, blob_name=stored_file)
-      files_deleted = True
-
-
-    if files_modified or files_deleted:
+    if plan.folder_ids is not None:
+      # Tells later runs which folder changes need a full scan.
+      self.datastore.put_queue(plan.folder_ids, table="tree_folders")
+
+    if self.dispatcher:
+      results, remaining = self._dispatch(bucket_name, plan), []
+    else:
+      results, remaining = self._execute(bucket_name, plan, deadline)
+    # Items that failed are retried first on the next run, unless they
+    # failed for good, e.g. on a file deleted meanwhile, whose change
+    # follows in the feed.
+    failed = [result.item for result in results
+              if not result.ok and not ratelimit.is_permanent(result.error)]
+    if resumed:
+      # The retries stored before the checkpoint have not been planned yet.
+      retries = json.loads(self.datastore.fetch("retry_changes") or "[]")
+      failed = list({item["fileId"]: item for item in retries + failed}.values())
+    self.datastore.store(key="retry_changes", value=json.dumps(failed), indexed=False)
+
+    if remaining:
+      print(f"Time budget spent, {len(remaining)} items left for the next run.")
+      # The page token is only stored once the queue is drained, so the
+      # changes made meanwhile are read after it.
+      self.datastore.store(key="pending_page_token", value=new_page_token)
+    else:
+      self.datastore.store(key="start_page_token", value=new_page_token)
+    if remaining or resumed:
+      self.datastore.put_queue(remaining)
+
+  def _resume(self):
+    """Returns the plan and page token checkpointed by an earlier run, if any."""
+    items = self.datastore.get_queue()
+    if not items:
+      return None
+    print(f"Resuming {len(items)} items checkpointed by an earlier run.")
+    return SyncPlan.from_items(items), self.datastore.fetch("pending_page_token")
+
+  def _plan(self, folder_id, bucket_name):
+    """
+    Plans the sync and returns the plan with the page token to store after it.
+
+    A full scan's plan has rescan set, so that dry runs report it.
+    """
+    page_token = self.datastore.fetch("start_page_token")
+    if page_token:
+      response = self.drive.list_changes(page_token)
+      if response is not None:
+        changes, new_page_token = response
+        retries = json.loads(self.datastore.fetch("retry_changes") or "[]")
+        # Only the latest change to a file is planned, so a retry is
+        # dropped in favour of a newer change to its file.
+        changes = list({change["fileId"]: change for change in retries + changes}.values())
+        plan = self._plan_changes(changes, folder_id)
+        if not plan.rescan:
+          return plan, new_page_token
+        print("Folder change detected, running a full rescan.")
+        return self._plan_full_scan(folder_id, bucket_name), new_page_token
+      print("Start page token expired, running a full rescan.")
+    else:
+      print("No start page token stored, running a full rescan.")
+
+    # Take the token before listing so edits made during the scan are
+    # picked up by the next incremental run.
+    new_page_token = self.drive.get_start_page_token()
+    return self._plan_full_scan(folder_id, bucket_name), new_page_token
+
+  def _plan_changes(self, changes, folder_id):
+    changes = self._resolve_shortcuts(changes)
+    folder_cache = {}
+    # Settle the folders of every changed file with batched lookups up front,
+    # rather than walking up from each file in turn.
+    self.drive.resolve_folders({parent for change in changes
+                                for parent in (change.get("file") or {}).get("parents") or []},
+                               folder_id, folder_cache)
+    manifest = self.datastore.get_manifest(list({change["fileId"] for change in changes}))
+    # Only needed to tell whether a folder that changed, or a removed file,
+    # was a folder of the tree.
+    tree_folders = None
+    if any(change.get("removed") or (change.get("file") or {}).get("mimeType") == FOLDER_MIME_TYPE
+           for change in changes):
+      tree_folders = set(self.datastore.get_queue(table="tree_folders")) or None
+    return plan_changes(changes, manifest,
+                        lambda file: self.drive.is_in_folder(file.get("parents"),
+                                                             folder_id, folder_cache),
+                        tree_folders)
+
+  def _resolve_shortcuts(self, changes):
+    """
+    Resolves the shortcuts among changed files, adding changes for the shortcuts to them.
+
+    A target's edits are in the changes feed wherever the target is kept,
+    but its shortcuts' are not, so the shortcuts recorded against each
+    changed file are treated as changed too.
+    """
+    changed = {change["fileId"] for change in changes}
+    rows = self.datastore.get_references(sorted(changed), table="shortcut_refs")
+    shortcut_ids = sorted({shortcut_id for row in rows.values()
+                           for shortcut_id in row["file_ids"]} - changed)
+    if shortcut_ids:
+      shortcuts = self.drive.get_files(shortcut_ids, fields=f"{FILE_FIELDS}, trashed")
+      changes = changes + [{"fileId": shortcut_id, "file": shortcuts[shortcut_id]}
+                           if shortcut_id in shortcuts else {"fileId": shortcut_id, "removed": True}
+                           for shortcut_id in shortcut_ids]
+    resolved = iter(self.drive.resolve_shortcuts([change["file"] for change in changes
+                                                  if change.get("file")]))
+    return [dict(change, file=next(resolved)) if change.get("file") else change
+            for change in changes]
+
+  def _plan_full_scan(self, folder_id, bucket_name):
+    planner = SyncPlanner([blob for blob in self.storage.list_bucket_files(bucket_name=bucket_name)
+                           if not blob["name"].startswith(IMPORT_PREFIX)])
+    folder_ids = []
+    files = self.drive.list_drive_files(folder_id, folder_ids)
+    # Look the manifest up a batch of files at a time as the listing
+    # streams in.
+    for batch in iter(lambda: list(itertools.islice(files, GET_BATCH_SIZE)), []):
+      batch = self.drive.resolve_shortcuts(batch)
+      planner.add_files(batch, self.datastore.get_manifest([file["id"] for file in batch]))
+    plan = planner.finish(self.datastore.get_references(planner.unclaimed()))
+    plan.rescan = True
+    plan.folder_ids = folder_ids
+    return plan
+
+  def _execute(self, bucket_name, plan, deadline=None):
+    """
+    Carries out a plan, most urgent transfers first.
+
+    No transfer is started after deadline, a time.monotonic() value, or
+    once the lease is lost. Returns the result of every item carried out,
+    and the items left over.
+    """
+    remaining = []
+    with metrics.stage("transfer", target=self.target) as fields, \
+        TransferPool(scheduler=self.scheduler, target=self.target) as pool:
+      transfers = plan.transfers()
+      # Binary files' object names are known before transfer, so the
+      # objects already stored for them are looked up in one go.
+      stored = self.datastore.get_references(sorted(
+          {object_name(item["file"]) for item in transfers if item["file"].get("md5Checksum")}))
+      # Copies of one binary content share its object, so only the first
+      # of them transfers it and the others take its result.
+      copies = {}
+      for i, item in enumerate(transfers):
+        if ((deadline is not None and time.monotonic() >= deadline)
+            or (self.lease is not None and self.lease.lost)):
+          remaining = transfers[i:]
+          break
+        name = object_name(item["file"]) if item["file"].get("md5Checksum") else None
+        if name in copies:
+          copies[name].append(item)
+          continue
+        if name:
+          copies[name] = []
+        pool.submit("upload", item, self._upload, bucket_name, item["file"], stored)
+      results = pool.wait()
+      results += [self._copy_result(result, item) for result in results
+                  if result.item["file"].get("md5Checksum")
+                  for item in copies.get(object_name(result.item["file"]), [])]
+      fields.update(items=len(results), remaining=len(remaining),
+                    failed=sum(1 for result in results if not result.ok))
+    # Keep an object its file was renamed away from until the new one is
+    # uploaded; the failed upload's retry plans its delete again.
+    failed = {result.item["fileId"] for result in results if not result.ok}
+    held = {item["fileId"] for item in remaining}
+    remaining += [item for item in plan.deletes
+                  if item.get("replaced") and item["fileId"] in held]
+    uploaded = {result.item["fileId"]: result.value for result in results
+                if result.ok and result.action == "upload"}
+    with metrics.stage("delete", target=self.target) as fields:
+      deletes = [item for item in plan.deletes
+                 if not (item.get("replaced") and item["fileId"] in failed | held)]
+      previous = self.datastore.get_manifest(list(uploaded) + [item["fileId"] for item in deletes])
+      references = self._update_references(uploaded, deletes, previous)
+      deletes = self._delete_blobs(bucket_name, deletes, references)
+      fields.update(items=len(deletes),
+                    failed=sum(1 for result in deletes if not result.ok))
+    results += deletes
+    with metrics.stage("import", target=self.target):
+      self._update_corpus(bucket_name, uploaded, deletes, references, previous, deadline)
+    return results, remaining
+
+  def _dispatch(self, bucket_name, plan):
+    """
+    Hands the plan's transfers to task workers and deletes the rest here.
+
+    Each task carries TASK_BATCH_SIZE transfers, together with the deletes
+    of objects their files were renamed away from. Returns the results of
+    the deletes made here, and a failed result for each transfer of a task
+    the dispatcher reports as failed, so that the caller retries them
+    before moving the page token on. Cloud Tasks retries its tasks itself
+    and reports none.
+    """
+    transfers = plan.transfers()
+    transferred = {item["fileId"] for item in transfers}
+    replaced = {item["fileId"]: item for item in plan.deletes
+                if item.get("replaced") and item["fileId"] in transferred}
+    with metrics.stage("dispatch", target=self.target) as fields:
+      for i in range(0, len(transfers), TASK_BATCH_SIZE):
+        batch = transfers[i:i + TASK_BATCH_SIZE]
+        batch += [replaced[item["fileId"]] for item in batch if item["fileId"] in replaced]
+        self.dispatcher.dispatch({"target": self.target, "bucket_name": bucket_name,
+                                  "items": batch})
+      fields.update(items=len(transfers),
+                    tasks=-(-len(transfers) // TASK_BATCH_SIZE))
+    local = SyncPlan.from_items([item for item in plan.deletes
+                                 if item is not replaced.get(item["fileId"])])
+    results, _ = self._execute(bucket_name, local)
+    # A failed task's transfers that did succeed are current when retried,
+    # and skipped. The others drop their files' old objects once they succeed.
+    for payload, error in self.dispatcher.wait():
+      results += [TransferResult("upload", item, error=error)
+                  for item in payload["items"] if "blob" not in item]
+    return results
+
+  def run_task(self, bucket_name, items, target=None):
+    """
+    Carries out a batch of plan items sent by _dispatch.
+
+    target names the sync target the task was sent for; the caller builds
+    this watch for it.
+
+    Transfers whose manifest entry is already current are skipped, so a
+    retried task only repeats what failed. Raises if any item fails, which
+    has Cloud Tasks retry the task. The imports it starts are polled by the
+    next run, like the run's own.
+    """
+    with metrics.stage("task", target=self.target, items=len(items)):
+      plan = SyncPlan.from_items(items)
+      manifest = self.datastore.get_manifest([item["fileId"] for item in plan.transfers()])
+      plan = SyncPlan.from_items(plan.deletes + [
+        item for item in plan.transfers()
+        if not is_current(item["file"], manifest.get(item["fileId"]))])
+      results, _ = self._execute(bucket_name, plan)
+      failed = [result for result in results if not result.ok]
+      if failed:
+        raise RuntimeError(f"{len(failed)} of {len(results)} items failed")
+
+  def _upload(self, bucket_name, file, stored=None):
+    """
+    Stores a file's content, unless an object already holds it, and returns its new manifest entry.
+
+    Binary files are named after their md5Checksum before anything is
+    read, and looked up in stored, the reference rows of the objects
+    already stored. Their upload fails if Drive serves another revision
+    meanwhile, whose content does not belong under that name. Google files
+    are exported into memory first, which the Drive API caps at 10 MB, and
+    named after the MD5 of the export. A shortcut's content is read from its
+    target.
+    """
+    content_file_id = file.get("targetId", file["id"])
+    content_type = get_content_type(file["mimeType"])
+    if get_export_format(file["mimeType"]):
+      data = self.drive.open_drive_blob(content_file_id, file["mimeType"]).read()
+      content_hash = hashlib.md5(data).hexdigest()
+      name = object_name(file, content_hash)
+      generation = self.storage.find_object(bucket_name, name)
+      if generation is None:
+        generation = self.storage.upload_data(bucket_name, data, content_type, name)
+    else:
+      content_hash = file.get("md5Checksum")
+      name = object_name(file)
+      # An object named after a file id may hold an older version.
+      generation = ((stored or {}).get(name) or {}).get("generation") if content_hash else None
+      if generation is None:
+        generation = self.storage.upload_file(bucket_name=bucket_name,
+                                              file_id=content_file_id,
+                                              mime_type=file["mimeType"],
+                                              object_name=name,
+                                              md5_checksum=content_hash)
+    return self._manifest_entry(file, name, generation, content_hash)
+
+  def _copy_result(self, result, item):
+    """Returns the result of a transfer whose content was stored by the transfer of result."""
+    if not result.ok:
+      return TransferResult("upload", item, error=result.error)
+    return TransferResult("upload", item, value=self._manifest_entry(
+        item["file"], result.value["object_name"], result.value["generation"],
+        result.value["content_hash"]))
+
+  def _manifest_entry(self, file, name, generation, content_hash):
+    """Returns the manifest entry of a file whose content is stored as the object name."""
+    return {
+      "md5Checksum": file.get("md5Checksum"),
+      "version": int(file.get("version", 0)),
+      "modifiedTime": file.get("modifiedTime"),
+      "title": file.get("name"),
+      "generation": generation,
+      "export_format": get_export_format(file["mimeType"]),
+      "content_type": get_content_type(file["mimeType"]),
+      "content_hash": content_hash,
+      "targetId": file.get("targetId"),
+      "object_name": name,
+    }
+
+  def _update_references(self, uploaded, deletes, previous):
+    """
+    Records the objects uploaded files now use, and drops the references of
+    deletes and of the objects uploads moved away from.
+
+    previous holds the files' manifest entries before the sync. Shortcuts
+    are recorded against their targets the same way. Returns the objects'
+    reference rows before and after, as update_references does.
+    """
+    added, removed = collections.defaultdict(list), collections.defaultdict(list)
+    shortcuts_added, shortcuts_removed = collections.defaultdict(list), collections.defaultdict(list)
+    details = {}
+    for file_id, entry in uploaded.items():
+      added[entry["object_name"]].append(file_id)
+      # Copies uploaded together each write the object; the last one's
+      # generation, the highest, is the one left.
+      if entry["generation"] >= details.get(entry["object_name"], {}).get("generation", 0):
+        details[entry["object_name"]] = {"generation": entry["generation"],
+                                         "content_type": entry["content_type"]}
+      old = previous.get(file_id) or {}
+      if old.get("object_name") not in (None, entry["object_name"]):
+        removed[old["object_name"]].append(file_id)
+      if entry["targetId"]:
+        shortcuts_added[entry["targetId"]].append(file_id)
+      if old.get("targetId") not in (None, entry["targetId"]):
+        shortcuts_removed[old["targetId"]].append(file_id)
+    for item in deletes:
+      removed[item["blob"]["name"]].append(item["fileId"])
+      old = previous.get(item["fileId"]) or {}
+      if not item.get("replaced") and old.get("targetId"):
+        shortcuts_removed[old["targetId"]].append(item["fileId"])
+
+    if shortcuts_added or shortcuts_removed:
+      self.datastore.update_references(shortcuts_added, shortcuts_removed, table="shortcut_refs")
+    return self.datastore.update_references(added, removed, details)
+
+  def _delete_blobs(self, bucket_name, deletes, references):
+    """
+    Deletes the objects no file references any more, and reports each planned delete.
+
+    Each object is deleted on condition of the generation recorded for it,
+    so one stored again meanwhile is kept.
+    """
+    planned = {item["blob"]["name"]: item["blob"] for item in deletes}
+    orphaned = [{"name": name,
+                 "generation": (before or {}).get("generation")
+                               or planned.get(name, {}).get("generation")}
+                for name, (before, after) in references.items() if after is None]
+    failed = self.storage.delete_blobs(bucket_name, orphaned) if orphaned else set()
+    for name in failed - set(planned):
+      print(f"{name} is no longer used but was not deleted; the next full scan deletes it.")
+    return [TransferResult("delete", item,
+                           error=RuntimeError(f"{item['blob']['name']} was not deleted")
+                           if item["blob"]["name"] in failed else None)
+            for item in deletes]
+
+  def _update_corpus(self, bucket_name, uploaded, deletes, references, previous, deadline=None):
+    """
+    Re-indexes what changed, then records finished transfers in the manifest.
+
+    There is one document per object, imported when the object is stored
+    anew or the first file using it changes, whose id it keeps for links,
+    and removed when no file uses the object any more. With CHUNKED_IMPORT
+    the documents are imported as chunks of their text instead, read until
+    deadline, a time.monotonic() value.
+
+    The manifest is only written once the imports are started, so if they
+    cannot be, the transfers are planned again. Their documents are then
+    imported because the first file's manifest entry, in previous, does not
+    name the object yet.
+    """
+    deleted = [result.item["fileId"] for result in deletes
+               if result.ok and not result.item.get("replaced")]
+
+    documents = []
+    removed_documents = []
+    for name, (before, after) in references.items():
+      if after is None:
+        removed_documents.append(document_id(name))
+      elif (after["content_type"] in INDEXED_CONTENT_TYPES
+            and (before is None or before["file_ids"][0] != after["file_ids"][0]
+                 or before.get("generation") != after.get("generation")
+                 or (after["file_ids"][0] in uploaded
+                     and (previous.get(after["file_ids"][0]) or {}).get("object_name") != name))):
+        documents.append({"id": document_id(name),
+                          "uri": f"gs://{bucket_name}/{name}",
+                          "mime_type": after["content_type"],
+                          "file_id": after["file_ids"][0],
+                          "object_name": name,
+                          "stored": before is not None})
+    operations = []
+    if CHUNKED_IMPORT and (documents or removed_documents):
+      with metrics.stage("chunk", target=self.target) as fields:
+        documents, removed_chunks, operations = self._import_chunks(
+            bucket_name, documents, removed_documents, uploaded, deadline)
+        fields.update(whole=len(documents), removed_chunks=len(removed_chunks),
+                      imports=len(operations))
+      removed_documents += removed_chunks
+    if documents or removed_documents or operations:
       print("Files modified.")
-      self.discovery.updateCorpus()
+      self._import_documents(documents, removed_documents)
+      self.corpus_state.increment("corpus_generation")
     else:
       print("No files modified.")
+    self.datastore.put_manifest(uploaded)
+    self.datastore.delete_manifest(deleted)
+
+  def _import_documents(self, documents, deleted_ids=None, attempts=1):
+    """Imports documents and removes those of deleted_ids, recording the imports started."""
+    operations = self.discovery.updateCorpus(documents=documents, deleted_ids=deleted_ids)
+    self._record_imports({name: {"documents": batch} for name, batch in operations.items()},
+                         attempts)
+
+  def _import_files(self, uris, attempts=1):
+    """Imports the documents of JSONL files, recording the import, and returns its name."""
+    name = self.discovery.import_jsonl(uris)
+    self._record_imports({name: {"uris": uris}}, attempts)
+    return name
+
+  def _record_imports(self, operations, attempts):
+    """Records the imports for the next run to poll, with what each imports to start it again."""
+    self.datastore.put_manifest({name: {"source": json.dumps(source), "attempts": attempts}
+                                 for name, source in operations.items()}, table="imports")
+
+  def _import_chunks(self, bucket_name, documents, removed_documents, uploaded, deadline=None):
+    """
+    Imports documents as chunks of their text, read and split on the transfer pool.
+
+    A chunk's id is derived from the id of the file it is linked to and the
+    hash of its text, so the chunks an edit leaves alone keep their ids and
+    are not imported again. The chunk ids of each document are kept in the
+    chunks table; ids no longer in use are returned to be deleted. The new
+    chunks are streamed to JSONL files in the bucket with their file's
+    title, Drive link and modifiedTime, and imported from there.
+
+    Documents are read SYNC_WORKERS at a time, so only theirs are held in
+    memory. Those whose text cannot be read here, and those left once
+    deadline passes, are returned to be imported whole. Returns those, the
+    ids to delete and the imports started.
+    """
+    rows = self.datastore.get_manifest([document["id"] for document in documents]
+                                       + removed_documents, table="chunks")
+    # Chunks move between documents when their file's content changes,
+    # so the ids in use are compared across all the documents at once.
+    used = {chunk for row in rows.values() for chunk in row["chunk_ids"]}
+    files = {**self.datastore.get_manifest(sorted(
+                 {document["file_id"] for document in documents} - set(uploaded))),
+             **uploaded}
+    kept, whole, new_rows = set(), [], {}
+
+    def lines():
+      for i in range(0, len(documents), SYNC_WORKERS):
+        if deadline is not None and time.monotonic() >= deadline:
+          whole.extend(documents[i:])
+          return
+        batch = documents[i:i + SYNC_WORKERS]
+        with TransferPool(scheduler=self.scheduler, target=self.target) as pool:
+          for document in batch:
+            if is_extractable(document["mime_type"]):
+              pool.submit("extract", document["id"], self._extract_chunks, bucket_name,
+                          document)
+          chunked = {result.item: result.value for result in pool.wait()
+                     if result.ok and result.value}
+        for document in batch:
+          if document["id"] not in chunked:
+            whole.append(document)
+            continue
+          file = files.get(document["file_id"]) or {}
+          metadata = json.dumps({"file_id": document["file_id"],
+                                 "title": file.get("title") or document["file_id"],
+                                 "link": f"https://drive.google.com/open?id={document['file_id']}",
+                                 "modifiedTime": file.get("modifiedTime")})
+          ids = {chunk_id(document["file_id"], text): text for text in chunked[document["id"]]}
+          for chunk, text in ids.items():
+            if chunk not in used and chunk not in kept:
+              yield (json.dumps({
+                "id": chunk,
+                "jsonData": metadata,
+                "content": {"mimeType": "text/plain",
+                            "rawBytes": base64.b64encode(text.encode()).decode()},
+              }) + "\n").encode()
+          kept.update(ids)
+          new_rows[document["id"]] = {"chunk_ids": list(ids), "file_id": document["file_id"]}
+
+    operations = []
+    new_lines = lines()
+    # Each file takes up to CHUNK_IMPORT_BATCH_SIZE lines, as they are made.
+    for line in new_lines:
+      name = f"{IMPORT_PREFIX}{uuid.uuid4().hex}.jsonl"
+      self.storage.upload_stream(
+          bucket_name, itertools.chain([line], itertools.islice(new_lines,
+                                                                CHUNK_IMPORT_BATCH_SIZE - 1)),
+          "application/json", name)
+      operations.append(self._import_files([f"gs://{bucket_name}/{name}"]))
+    # An object stored before it was chunked may still have a whole document.
+    removed = sorted(used - kept) + [document["id"] for document in documents
+                                     if document["id"] in new_rows and document["stored"]
+                                     and document["id"] not in rows]
+    self.datastore.put_manifest(new_rows, table="chunks")
+    self.datastore.delete_manifest([name for name in rows if name not in new_rows],
+                                   table="chunks")
+    if operations:
+      self._delete_expired_imports(bucket_name)
+    return whole, removed, operations
 
-    # Update last update time.
-    self.datastore.store(key="last_update",
-                         value=datetime.datetime.now(tz = tz.tzlocal()))
+  def _extract_chunks(self, bucket_name, document):
+    """Returns the chunks of an object's text, or None if it has none that can be read here."""
+    data = self.storage.download_data(bucket_name, document["object_name"], EXTRACT_MAX_BYTES)
+    text = extract_text(data, document["mime_type"]) if data is not None else None
+    return chunk_text(text) if text and text.strip() else None
 
+  def _delete_expired_imports(self, bucket_name):
+    expires = time.time() - IMPORT_FILE_TTL
+    expired = [blob for blob in self.storage.list_bucket_files(bucket_name=bucket_name,
+                                                               prefix=IMPORT_PREFIX)
+               if blob.get("updated") and blob["updated"].timestamp() < expires]
+    if expired:
+      self.storage.delete_blobs(bucket_name, expired)
@@ -0,0 +1,619 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+In-process fakes of the Drive, Storage, Datastore and DiscoveryEngine services.
+
+The fakes keep their state in memory and stand in for the real classes
+without any network access. Every call sleeps for a configurable latency,
+can fail at a configurable rate, and is counted in ApiStats so a run can be
+measured offline.
+
+The chat handler's clients are faked at the client level instead, as
+FakeSessionsClient, FakeChatSession and FakeDatastoreClient, for
+clients.register to swap in.
+"""
+
+import collections
+import hashlib
+import io
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from driveservice import (BATCH_SIZE, FOLDER_MIME_TYPE, LIST_WORKERS, QUERY_BATCH_SIZE, Drive,
+                          get_export_format)
+from datastore import GET_BATCH_SIZE, PUT_BATCH_SIZE
+from discoveryengine import IMPORT_BATCH_SIZE
+from storageservice import DELETE_BATCH_SIZE, ChecksumMismatch
+
+# Share of fake Dialogflow answers per shape: plain text, text with a
+# richContent action link as data store agents return, and the agent's
+# reply while the datastore is still indexing.
+RESPONSE_SHAPES = (
+  ("text", 0.5),
+  ("action_link", 0.45),
+  ("indexing", 0.05),
+)
+INDEXING_MESSAGE = "Indexing didn't finish yet, please come back in a few hours."
+
+# Share of generated files per MIME type.
+MIME_TYPES = (
+  ("application/pdf", 0.6),
+  ("application/vnd.google-apps.document", 0.3),
+  ("application/vnd.openxmlformats-officedocument.wordprocessingml.document", 0.1),
+)
+
+
+class SimulatedError(Exception):
+  """Raised by a fake call that was chosen to fail."""
+
+
+class ApiStats:
+  """Thread-safe counters of calls per API method and bytes transferred."""
+
+  def __init__(self):
+    self.calls = collections.Counter()
+    self.bytes_moved = 0
+    self._lock = threading.Lock()
+
+  def count(self, api:str, calls:int=1):
+    with self._lock:
+      self.calls[api] += calls
+
+  def add_bytes(self, size:int):
+    with self._lock:
+      self.bytes_moved += size
+
+  def total_calls(self):
+    return sum(self.calls.values())
+
+
+class FakeBackend:
+  """Latency, failure rate and call counting shared by the fakes."""
+
+  def __init__(self, stats:ApiStats, latency:float=0.0, error_rate:float=0.0, seed:int=0):
+    self.stats = stats
+    self.latency = latency
+    self.error_rate = error_rate
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+
+  def call(self, api:str, can_fail:bool=False, latency:float=None):
+    """Counts and sleeps through a call, or for latency seconds if given."""
+    self.stats.count(api)
+    latency = self.latency if latency is None else latency
+    if latency:
+      time.sleep(latency)
+    if can_fail and self.error_rate:
+      with self._lock:
+        failed = self._random.random() < self.error_rate
+      if failed:
+        raise SimulatedError(f"simulated {api} failure")
+
+
+class FakeDrive:
+  """
+  A generated Drive folder tree.
+
+  Files are spread over folders of files_per_folder, with folders nested
+  fan_out to a level. Sizes follow a log-normal distribution around
+  mean_size bytes. mutate edits, adds and removes files and records the
+  matching entries in the changes feed.
+  """
+
+  def __init__(self, backend:FakeBackend, root_id:str, file_count:int,
+               files_per_folder:int=50, fan_out:int=10, mean_size:int=200 * 1024,
+               page_size:int=1000, seed:int=0):
+    self.backend = backend
+    self.root_id = root_id
+    self.page_size = page_size
+    self._random = random.Random(seed)
+    self._mean_size = mean_size
+    self._children = collections.defaultdict(list)
+    self._files = {}
+    self._parents = {}
+    self._changes = []
+    self._token = 0
+    self._next_id = itertools.count()
+
+    folders = [root_id]
+    frontier = collections.deque([root_id])
+    while len(folders) * files_per_folder < file_count:
+      parent = frontier.popleft()
+      for _ in range(fan_out):
+        folder_id = f"folder{len(folders)}"
+        self._children[parent].append({"id": folder_id, "mimeType": FOLDER_MIME_TYPE,
+                                       "parents": [parent]})
+        self._parents[folder_id] = parent
+        folders.append(folder_id)
+        frontier.append(folder_id)
+    for i in range(file_count):
+      self._add_file(folders[i % len(folders)])
+
+  def _add_file(self, parent):
+    file_id = f"file{next(self._next_id)}"
+    mime_type = self._random.choices([m for m, _ in MIME_TYPES],
+                                     [w for _, w in MIME_TYPES])[0]
+    file = {"id": file_id, "name": f"{file_id}", "mimeType": mime_type,
+            "parents": [parent], "version": "1",
+            "modifiedTime": "2024-01-01T00:00:00.000Z",
+            "size": self._size()}
+    self._touch(file)
+    self._files[file_id] = file
+    self._children[parent].append(file)
+    return file
+
+  def _size(self):
+    return max(1, int(self._random.lognormvariate(0, 1) * self._mean_size / 1.65))
+
+  def _touch(self, file):
+    version = int(file["version"]) + 1
+    file["version"] = str(version)
+    file["modifiedTime"] = f"2024-01-01T00:00:{version % 60:02d}.000Z"
+    if not get_export_format(file["mimeType"]):
+      file["md5Checksum"] = hashlib.md5(f"{file['id']}{version}".encode()).hexdigest()
+
+  def mutate(self, fraction:float):
+    """Edits, adds and removes about fraction of the files, in equal parts."""
+    count = max(1, int(len(self._files) * fraction / 3))
+    ids = self._random.sample(sorted(self._files), min(len(self._files), 2 * count))
+    for file_id in ids[:count]:
+      file = self._files[file_id]
+      self._touch(file)
+      self._changes.append({"fileId": file_id, "file": dict(file)})
+    for file_id in ids[count:]:
+      file = self._files.pop(file_id)
+      self._children[file["parents"][0]].remove(file)
+      self._changes.append({"fileId": file_id, "removed": True})
+    for _ in range(count):
+      file = self._add_file(self._random.choice(sorted(self._parents) or [self.root_id]))
+      self._changes.append({"fileId": file["id"], "file": dict(file)})
+
+  def list_drive_files(self, folder_id:str='', folders:list=None):
+    level = [folder_id]
+    with ThreadPoolExecutor(max_workers=LIST_WORKERS) as executor:
+      while level:
+        if folders is not None:
+          folders.extend(level)
+        batches = [level[i:i + QUERY_BATCH_SIZE]
+                   for i in range(0, len(level), QUERY_BATCH_SIZE)]
+        level = []
+        for files in executor.map(self._list_children, batches):
+          for file in files:
+            if file["mimeType"] == FOLDER_MIME_TYPE:
+              level.append(file["id"])
+            else:
+              yield dict(file)
+
+  def _list_children(self, folder_ids):
+    files = [file for folder_id in folder_ids for file in self._children[folder_id]]
+    for _ in range(max(1, -(-len(files) // self.page_size))):
+      self.backend.call("drive.files.list")
+    return files
+
+  def get_start_page_token(self):
+    self.backend.call("drive.changes.getStartPageToken")
+    self._token = len(self._changes)
+    return str(self._token)
+
+  def list_changes(self, page_token:str):
+    changes = self._changes[int(page_token):]
+    for _ in range(max(1, -(-len(changes) // self.page_size))):
+      self.backend.call("drive.changes.list")
+    return changes, str(len(self._changes))
+
+  is_in_folder = Drive.is_in_folder
+  resolve_folders = Drive.resolve_folders
+  resolve_shortcuts = Drive.resolve_shortcuts
+
+  def get_files(self, file_ids:list, fields:str):
+    for _ in range(-(-len(file_ids) // BATCH_SIZE)):
+      self.backend.call("drive.batch")
+    files = {}
+    for file_id in file_ids:
+      if file_id in self._files:
+        files[file_id] = dict(self._files[file_id])
+      elif file_id in self._parents:
+        files[file_id] = {"id": file_id, "mimeType": FOLDER_MIME_TYPE,
+                          "parents": [self._parents[file_id]]}
+    return files
+
+  def open_drive_blob(self, file_id:str='', mime_type:str='', chunk_size:int=0):
+    api = "drive.files.export" if get_export_format(mime_type) else "drive.files.get_media"
+    self.backend.call(api, can_fail=True)
+    return _ZeroStream(self._files[file_id]["size"])
+
+
+class _ZeroStream(io.RawIOBase):
+  """Readable stream of size zero bytes that never holds more than one read."""
+
+  def __init__(self, size:int):
+    self._remaining = size
+
+  def readable(self):
+    return True
+
+  def read(self, size=-1):
+    size = self._remaining if size < 0 else min(size, self._remaining)
+    self._remaining -= size
+    return bytes(size)
+
+
+class FakeStorage:
+  """
+  A bucket filled from a FakeDrive.
+
+  Only the name, generation and size of each object are kept, so memory
+  use does not grow with the bytes synced. Downloads return filler words.
+  """
+
+  def __init__(self, backend:FakeBackend, drive:FakeDrive, chunk_size:int=8 * 1024 * 1024):
+    self.backend = backend
+    self.drive = drive
+    self.chunk_size = chunk_size
+    self.objects = {}
+    self._generations = itertools.count(1)
+    self._lock = threading.Lock()
+
+  def list_bucket_files(self, bucket_name:str, prefix:str=None):
+    with self._lock:
+      objects = [blob for name, blob in self.objects.items()
+                 if not prefix or name.startswith(prefix)]
+    for _ in range(max(1, -(-len(objects) // 1000))):
+      self.backend.call("storage.objects.list")
+    return [dict(blob) for blob in objects]
+
+  def upload_file(self, bucket_name:str, file_id:str, mime_type:str, object_name:str,
+                  md5_checksum:str=None):
+    """Streams a file into the bucket, failing like Storage if its revision is not md5_checksum."""
+    stream = self.drive.open_drive_blob(file_id, mime_type, chunk_size=self.chunk_size)
+    size = 0
+    while True:
+      self.backend.call("storage.objects.insert", can_fail=True)
+      chunk = stream.read(self.chunk_size)
+      size += len(chunk)
+      if len(chunk) < self.chunk_size:
+        break
+    self.backend.stats.add_bytes(size)
+    current = self.drive._files[file_id].get("md5Checksum")
+    if md5_checksum and current != md5_checksum:
+      raise ChecksumMismatch(f"{file_id} changed since it was planned: uploaded MD5 "
+                             f"{current}, expected {md5_checksum}")
+    with self._lock:
+      generation = next(self._generations)
+      self.objects[object_name] = {"name": object_name, "generation": generation,
+                                   "size": size}
+    return generation
+
+  def find_object(self, bucket_name:str, object_name:str):
+    self.backend.call("storage.objects.get")
+    with self._lock:
+      return (self.objects.get(object_name) or {}).get("generation")
+
+  def upload_data(self, bucket_name:str, data:bytes, content_type:str, object_name:str):
+    self.backend.call("storage.objects.insert", can_fail=True)
+    self.backend.stats.add_bytes(len(data))
+    with self._lock:
+      generation = next(self._generations)
+      self.objects[object_name] = {"name": object_name, "generation": generation,
+                                   "size": len(data)}
+    return generation
+
+  def upload_stream(self, bucket_name:str, chunks, content_type:str, object_name:str):
+    size = 0
+    for chunk in chunks:
+      size += len(chunk)
+    for _ in range(max(1, -(-size // self.chunk_size))):
+      self.backend.call("storage.objects.insert", can_fail=True)
+    self.backend.stats.add_bytes(size)
+    with self._lock:
+      self.objects[object_name] = {"name": object_name, "generation": next(self._generations),
+                                   "size": size}
+
+  def download_data(self, bucket_name:str, object_name:str, max_bytes:int=None):
+    """Returns filler words of an object's size, as only the sizes of objects are kept."""
+    self.backend.call("storage.objects.get", can_fail=True)
+    with self._lock:
+      blob = self.objects.get(object_name)
+    if blob is None or (max_bytes is not None and blob["size"] > max_bytes):
+      return None
+    self.backend.call("storage.objects.download", can_fail=True)
+    data = (b"lorem ipsum dolor sit amet\n\n" * (blob["size"] // 28 + 1))[:blob["size"]]
+    self.backend.stats.add_bytes(len(data))
+    return data
+
+  def delete_blobs(self, bucket_name:str, blobs:list):
+    failed = set()
+    for i in range(0, len(blobs), DELETE_BATCH_SIZE):
+      self.backend.call("storage.batch")
+      for blob in blobs[i:i + DELETE_BATCH_SIZE]:
+        with self._lock:
+          stored = self.objects.get(blob["name"])
+          if stored and blob.get("generation") not in (None, stored["generation"]):
+            failed.add(blob["name"])
+          else:
+            self.objects.pop(blob["name"], None)
+    return failed
+
+
+class FakeDatastore:
+  """Settings and manifest rows held in memory."""
+
+  def __init__(self, backend:FakeBackend):
+    self.backend = backend
+    self.settings = {}
+    self.manifest = {}
+    self.references = collections.defaultdict(dict)
+    self._lock = threading.Lock()
+
+  def store(self, key, value, table="settings", indexed=True):
+    self.backend.call("datastore.commit")
+    with self._lock:
+      self.settings[key] = value
+
+  def fetch(self, prop, table="settings"):
+    self.backend.call("datastore.lookup")
+    return self.settings.get(prop)
+
+  def increment(self, prop, table="settings"):
+    self.backend.call("datastore.commit")
+    with self._lock:
+      self.settings[prop] = (self.settings.get(prop) or 0) + 1
+      return self.settings[prop]
+
+  def get_rows(self, table:str):
+    self.backend.call("datastore.runQuery")
+    with self._lock:
+      return {name: dict(row) for name, row in self.references[table].items()}
+
+  def get_queue(self, table="sync_queue"):
+    self.backend.call("datastore.runQuery")
+    with self._lock:
+      return list(self.settings.get(table) or [])
+
+  def put_queue(self, items:list, table="sync_queue"):
+    self.backend.call("datastore.commit")
+    with self._lock:
+      self.settings[table] = list(items)
+
+  def acquire_lease(self, name:str, holder:str, ttl:float, table="lease"):
+    self.backend.call("datastore.commit")
+    with self._lock:
+      lease = self.settings.setdefault((table, name), {})
+      if lease.get("holder") not in (None, holder) and lease.get("expires", 0) > time.time():
+        return False, dict(lease)
+      lease.update({"holder": holder, "started": time.time(), "expires": time.time() + ttl})
+      return True, dict(lease)
+
+  def renew_lease(self, name:str, holder:str, ttl:float, table="lease"):
+    self.backend.call("datastore.commit")
+    with self._lock:
+      lease = self.settings.get((table, name)) or {}
+      if lease.get("holder") != holder:
+        return False
+      lease["expires"] = time.time() + ttl
+      return True
+
+  def release_lease(self, name:str, holder:str, result:str, table="lease"):
+    self.backend.call("datastore.commit")
+    with self._lock:
+      lease = self.settings.get((table, name)) or {}
+      if lease.get("holder") == holder:
+        lease.update({"holder": None, "expires": 0, "finished": time.time(),
+                      "result": result})
+
+  def fetch_lease(self, name:str, table="lease"):
+    self.backend.call("datastore.lookup")
+    with self._lock:
+      lease = self.settings.get((table, name))
+      return dict(lease) if lease else None
+
+  def get_manifest(self, file_ids:list, table="manifest"):
+    for _ in range(0, len(file_ids), GET_BATCH_SIZE):
+      self.backend.call("datastore.lookup")
+    rows = self.manifest if table == "manifest" else self.references[table]
+    with self._lock:
+      return {file_id: dict(rows[file_id]) for file_id in file_ids if file_id in rows}
+
+  def get_references(self, names:list, table="object_refs"):
+    return self.get_manifest(names, table=table)
+
+  def update_references(self, added:dict, removed:dict, details:dict=None,
+                        table="object_refs"):
+    names = sorted(set(added) | set(removed))
+    for _ in range(0, len(names), PUT_BATCH_SIZE):
+      self.backend.call("datastore.commit")
+    changes = {}
+    with self._lock:
+      rows = self.references[table]
+      for name in names:
+        before = rows.get(name)
+        gone = set(removed.get(name, ()))
+        file_ids = [file_id for file_id in (before or {}).get("file_ids", [])
+                    if file_id not in gone]
+        file_ids += [file_id for file_id in dict.fromkeys(added.get(name, ()))
+                     if file_id not in file_ids]
+        if file_ids:
+          rows[name] = {**(before or {}), **(details or {}).get(name, {}), "file_ids": file_ids}
+        else:
+          rows.pop(name, None)
+        changes[name] = (before, dict(rows[name]) if file_ids else None)
+    return changes
+
+  def put_manifest(self, entries:dict, table="manifest"):
+    for _ in range(0, len(entries), PUT_BATCH_SIZE):
+      self.backend.call("datastore.commit")
+    rows = self.manifest if table == "manifest" else self.references[table]
+    with self._lock:
+      rows.update(entries)
+
+  def delete_manifest(self, file_ids:list, table="manifest"):
+    for _ in range(0, len(file_ids), PUT_BATCH_SIZE):
+      self.backend.call("datastore.commit")
+    rows = self.manifest if table == "manifest" else self.references[table]
+    with self._lock:
+      for file_id in file_ids:
+        rows.pop(file_id, None)
+
+
+class FakeDiscoveryEngine:
+  """Records imports and deletes, finishing every import by the next poll."""
+
+  def __init__(self, backend:FakeBackend):
+    self.backend = backend
+    self.imported = 0
+    self.deleted = 0
+    self.jsonl_imports = 0
+    self._ids = itertools.count()
+
+  def updateCorpus(self, documents:list=None, deleted_ids:list=None):
+    for _ in deleted_ids or []:
+      self.backend.call("discoveryengine.documents.delete")
+    self.deleted += len(deleted_ids or [])
+    operations = {}
+    documents = documents or []
+    for i in range(0, len(documents), IMPORT_BATCH_SIZE):
+      self.backend.call("discoveryengine.documents.import")
+      operations[f"operations/import-{next(self._ids)}"] = documents[i:i + IMPORT_BATCH_SIZE]
+    self.imported += len(documents)
+    return operations
+
+  def import_jsonl(self, uris:list):
+    self.backend.call("discoveryengine.documents.import")
+    self.jsonl_imports += len(uris)
+    return f"operations/import-{next(self._ids)}"
+
+  def poll_operations(self, names:list):
+    for _ in names:
+      self.backend.call("discoveryengine.operations.get")
+    return [], []
+
+
+class FakeSessionsClient:
+  """
+  Answers detect intent requests like a Dialogflow CX SessionsClient.
+
+  Answers take shapes drawn from shapes, pairs of a RESPONSE_SHAPES name
+  and its weight. Streaming requests send partials partial responses,
+  spread over the latency, before the final one.
+  """
+
+  def __init__(self, backend:FakeBackend, shapes=RESPONSE_SHAPES, partials:int=3, seed:int=0):
+    self.backend = backend
+    self.shapes = shapes
+    self.partials = partials
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+
+  def detect_intent(self, request=None):
+    from google.cloud import dialogflowcx_v3
+    self.backend.call("dialogflow.detect_intent", can_fail=True)
+    return dialogflowcx_v3.DetectIntentResponse(
+        query_result=self._query_result(request.query_input.text.text))
+
+  def streaming_detect_intent(self, requests=None):
+    from google.cloud import dialogflowcx_v3
+    request = next(iter(requests))
+    result = self._query_result(request.query_input.text.text)
+    text = result.response_messages[0].text.text[0]
+    words = text.split()
+    partial = dialogflowcx_v3.DetectIntentResponse.ResponseType.PARTIAL
+    # The responses share the call's latency between them.
+    latency = self.backend.latency / (self.partials + 1)
+    for i in range(1, self.partials + 1):
+      self.backend.call("dialogflow.streaming_detect_intent", can_fail=True, latency=latency)
+      yield dialogflowcx_v3.StreamingDetectIntentResponse(
+          detect_intent_response=dialogflowcx_v3.DetectIntentResponse(
+            response_type=partial,
+            query_result=dialogflowcx_v3.QueryResult(response_messages=[
+              dialogflowcx_v3.ResponseMessage(text=dialogflowcx_v3.ResponseMessage.Text(
+                text=[" ".join(words[:len(words) * i // (self.partials + 1)])]))])))
+    self.backend.call("dialogflow.streaming_detect_intent", can_fail=True, latency=latency)
+    yield dialogflowcx_v3.StreamingDetectIntentResponse(
+        detect_intent_response=dialogflowcx_v3.DetectIntentResponse(
+          response_type=dialogflowcx_v3.DetectIntentResponse.ResponseType.FINAL,
+          query_result=result))
+
+  def _query_result(self, question:str):
+    from google.cloud import dialogflowcx_v3
+    with self._lock:
+      shape = self._random.choices([name for name, _ in self.shapes],
+                                   [weight for _, weight in self.shapes])[0]
+    if shape == "indexing":
+      return dialogflowcx_v3.QueryResult(response_messages=[
+        dialogflowcx_v3.ResponseMessage(text=dialogflowcx_v3.ResponseMessage.Text(
+          text=[INDEXING_MESSAGE]))])
+    messages = [dialogflowcx_v3.ResponseMessage(text=dialogflowcx_v3.ResponseMessage.Text(
+      text=[f"This is a generated answer to: {question}"]))]
+    if shape == "action_link":
+      messages.append(dialogflowcx_v3.ResponseMessage(payload={"richContent": [[{
+        "type": "info",
+        "title": "Source document",
+        "subtitle": "A matching passage from the source document.",
+        "actionLink": "https://drive.google.com/open?id=loadtest",
+      }]]}))
+    return dialogflowcx_v3.QueryResult(text=question, response_messages=messages)
+
+
+class _FakeResponse:
+
+  def __init__(self, body:dict):
+    self._body = body
+
+  def raise_for_status(self):
+    pass
+
+  def json(self):
+    return self._body
+
+
+class FakeChatSession:
+  """Accepts the Chat API message posts and updates of async replies."""
+
+  def __init__(self, backend:FakeBackend):
+    self.backend = backend
+    self._ids = itertools.count()
+
+  def post(self, url:str, params=None, json=None):
+    self.backend.call("chat.messages.create", can_fail=True)
+    space = url.split("/v1/", 1)[1].rsplit("/messages", 1)[0]
+    return _FakeResponse({"name": f"{space}/messages/{next(self._ids)}"})
+
+  def patch(self, url:str, params=None, json=None):
+    self.backend.call("chat.messages.update", can_fail=True)
+    return _FakeResponse({})
+
+
+class FakeDatastoreClient:
+  """
+  Serves Datastore lookups from an empty database.
+
+  The answer cache reads corpus_generation on the chat path, which this
+  answers as never set.
+  """
+
+  def __init__(self, backend:FakeBackend):
+    self.backend = backend
+
+  def key(self, *path, namespace=None):
+    return (namespace, *path)
+
+  def get(self, key):
+    self.backend.call("datastore.lookup")
+    return None
@@ -18,54 +18,102 @@ limitations under the License.
 Initialization of APIs.
 """
 
-from googleapiclient import discovery
-from oauth2client.client import GoogleCredentials
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+import clients
+import metrics
+
+# Largest number of services batchGet and batchEnable accept per call.
+BATCH_GET_SIZE = 30
+BATCH_ENABLE_SIZE = 20
+# Seconds to wait for enable operations to finish.
+OPERATION_TIMEOUT = 300
+
 
 class ApiEnable:
 
   def __init__(self):
-    self.creds = GoogleCredentials.get_application_default()
-    self.serviceusage = discovery.build("serviceusage", "v1", credentials=self.creds)
-    self.crm = discovery.build("cloudresourcemanager", "v1", credentials=self.creds)
-    self.iam = discovery.build("iam", "v1", credentials=self.creds)
+    self.serviceusage = clients.get("serviceusage")
 
 
   def enable_api(self, project_id, api):
-      """Enables the GCP service APIs
+      """Enables a single GCP service API, see enable_apis."""
+      return self.enable_apis(project_id, [api])
 
-      Args:
-          project_id : The ID of the project where the service status is being checked
-      """
-
-      # Get the API service status in the project
-      api_status = self._get_service_api_status(
-          api, project_id
-      )
 
-      # Enable the API service in the project
-      if api_status != "ENABLED":
-          self.serviceusage.services().enable(
-              name=f"projects/{project_id}/services/{api}"
-          ).execute()
+  def enable_apis(self, project_id, apis):
+      """Enables the GCP service APIs that are not enabled yet
 
-          print(f"Enabled {api} API in project : {project_id}")
+      Checks every service with batched status calls, enables the missing
+      ones in batches and waits for the resulting operations concurrently.
 
+      Args:
+          project_id : The ID of the project where the services are enabled
+          apis : Names of the services, e.g. drive.googleapis.com
 
-  def _get_service_api_status(self, api_name, project_id):
+      Returns:
+          list : the services that were enabled
+      """
+      states = self._get_service_api_states(apis, project_id)
+      missing = [api for api in apis if states.get(api) != "ENABLED"]
+      if not missing:
+          return []
+
+      operations = []
+      for i in range(0, len(missing), BATCH_ENABLE_SIZE):
+          with metrics.timed("serviceusage", "services.batchEnable"):
+              operation = self.serviceusage.services().batchEnable(
+                  parent=f"projects/{project_id}",
+                  body={"serviceIds": missing[i:i + BATCH_ENABLE_SIZE]}
+              ).execute(http=clients.http())
+          if not operation.get("done"):
+              operations.append(operation["name"])
+
+      with ThreadPoolExecutor(max_workers=max(1, len(operations))) as executor:
+          list(executor.map(self._wait_for_operation, operations))
+      print(f"Enabled {', '.join(missing)} APIs in project : {project_id}")
+      return missing
+
+
+  def _get_service_api_states(self, api_names, project_id):
       """
-      Get the current status of a GCP service API
+      Get the current status of GCP service APIs
 
       Args:
-          api_name : API name whose status is to be returned
+          api_names : API names whose status is to be returned
           project_id : The ID of the project where the service status is being checked
 
       Returns:
-          string : service api status
+          dict : service api status keyed by API name
       """
-      response = (
-          self.serviceusage.services()
-          .get(name=f"projects/{project_id}/services/{api_name}")
-          .execute()
-      )
-      return response["state"]
+      states = {}
+      for i in range(0, len(api_names), BATCH_GET_SIZE):
+          with metrics.timed("serviceusage", "services.batchGet"):
+              response = self.serviceusage.services().batchGet(
+                  parent=f"projects/{project_id}",
+                  names=[f"projects/{project_id}/services/{api}"
+                         for api in api_names[i:i + BATCH_GET_SIZE]]
+              ).execute(http=clients.http())
+          for service in response.get("services", []):
+              states[service["config"]["name"]] = service["state"]
+      return states
+
+
+  def _wait_for_operation(self, name):
+      """Polls an operation, backing off up to 10 seconds, until it is done."""
+      deadline = time.monotonic() + OPERATION_TIMEOUT
+      interval = 1
+      while time.monotonic() < deadline:
+          with metrics.timed("serviceusage", "operations.get"):
+              operation = self.serviceusage.operations().get(
+                  name=name).execute(http=clients.http())
+          if operation.get("done"):
+              if "error" in operation:
+                  raise RuntimeError(f"Operation {name} failed: {operation['error']}")
+              return operation
+          time.sleep(interval)
+          interval = min(interval * 2, 10)
+      raise TimeoutError(f"Operation {name} did not finish in {OPERATION_TIMEOUT}s")
 
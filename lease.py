@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Datastore leases that keep sync runs from overlapping.
+
+A lease is a Datastore row naming its holder and when it expires. It is
+taken and renewed with transactions, so two instances can never both
+hold it, and a heartbeat keeps it alive while the run goes on. If the
+instance dies, the lease expires and the next run takes it over.
+"""
+
+import os
+import socket
+import threading
+import time
+import uuid
+
+LEASE_TTL = float(os.environ.get('LEASE_TTL', 60))
+# Seconds a caller joining a run waits for it before giving up.
+LEASE_WAIT_TIMEOUT = float(os.environ.get('LEASE_WAIT_TIMEOUT', 540))
+
+
+class LeaseHeld(Exception):
+  """Raised when another run holds the lease; status is the lease row."""
+
+  def __init__(self, status:dict):
+    super().__init__(f"Lease held by {status.get('holder')}")
+    self.status = status
+
+
+class Lease:
+  """
+  Holds the lease called name for the duration of a with block.
+
+  Entering raises LeaseHeld if another run has it. While held, a
+  heartbeat renews it every third of ttl. If a renewal finds the lease
+  taken over, lost is set so the run can wind down. Leaving records
+  whether the block raised, or else result, which the block may set.
+  """
+
+  def __init__(self, datastore, name:str, ttl:float=LEASE_TTL):
+    self.datastore = datastore
+    self.name = name
+    self.ttl = ttl
+    self.holder = f"{os.environ.get('GAE_INSTANCE') or socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+    self.result = "ok"
+    self._lost = threading.Event()
+    self._stop = threading.Event()
+    self._heartbeat_thread = None
+
+  @property
+  def lost(self):
+    return self._lost.is_set()
+
+  def __enter__(self):
+    acquired, status = self.datastore.acquire_lease(self.name, self.holder, self.ttl)
+    if not acquired:
+      raise LeaseHeld(status)
+    self._heartbeat_thread = threading.Thread(target=self._heartbeat, daemon=True)
+    self._heartbeat_thread.start()
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    self._stop.set()
+    self._heartbeat_thread.join()
+    self.datastore.release_lease(self.name, self.holder,
+                                 f"failed: {exc}" if exc_type else self.result)
+
+  def _heartbeat(self):
+    while not self._stop.wait(self.ttl / 3):
+      try:
+        renewed = self.datastore.renew_lease(self.name, self.holder, self.ttl)
+      except Exception as error:
+        # Try again at the next beat; the lease outlives two missed ones.
+        print(f"Could not renew lease {self.name}: {error}")
+        continue
+      if not renewed:
+        print(f"Lease {self.name} was taken over.")
+        self._lost.set()
+        return
+
+
+def wait_for(datastore, name:str, timeout:float=LEASE_WAIT_TIMEOUT, interval:float=2):
+  """
+  Waits for the run holding the lease called name to end.
+
+  Returns the lease row, which records how the run ended, with a status of
+  "finished", or "running" if the run is still going after timeout seconds.
+  """
+  deadline = time.monotonic() + timeout
+  while True:
+    status = datastore.fetch_lease(name) or {}
+    if not status.get("holder") or status.get("expires", 0) <= time.time():
+      return {"status": "finished", **status}
+    if time.monotonic() >= deadline:
+      return {"status": "running", **status}
+    time.sleep(interval)
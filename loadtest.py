@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Load test of the /chat endpoint.
+
+Serves the app under gunicorn with each worker and thread setting in turn,
+with Dialogflow, Datastore and the Chat API swapped for the fakes in
+fakeservices.py, and sends it a mix of Google Chat events: questions and
+help requests, in direct messages and rooms. Reports the throughput,
+latency percentiles and error rate of each setting.
+
+  python loadtest.py --configs 1x1 4x1 4x4 --concurrency 32 --latency-ms 1500
+
+gunicorn builds the app with create_app(), which reads the fakes'
+settings from LOADTEST_* environment variables, so a server can also be
+started by hand and loaded with --url:
+
+  LOADTEST_LATENCY_MS=1500 gunicorn -w 4 --threads 4 'loadtest:create_app()'
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+# Share of sent events per kind.
+EVENT_MIX = (
+  ("dm_question", 0.4),
+  ("room_question", 0.4),
+  ("dm_help", 0.1),
+  ("room_help", 0.1),
+)
+PERCENTILES = (0.5, 0.95, 0.99)
+
+
+def create_app():
+  """Returns the Flask app with its Google clients replaced by fakes, for gunicorn to serve."""
+  import clients
+  from fakeservices import (RESPONSE_SHAPES, ApiStats, FakeBackend, FakeChatSession,
+                            FakeDatastoreClient, FakeSessionsClient)
+
+  os.environ.setdefault('AGENT_ID', 'loadtest')
+  os.environ.setdefault('PROJECT', 'loadtest')
+  shapes = os.environ.get('LOADTEST_SHAPES')
+  backend = FakeBackend(ApiStats(),
+                        latency=float(os.environ.get('LOADTEST_LATENCY_MS', 1500)) / 1000,
+                        error_rate=float(os.environ.get('LOADTEST_ERROR_RATE', 0)),
+                        seed=os.getpid())
+  clients.register("dialogflow", FakeSessionsClient(
+      backend, shapes=tuple(json.loads(shapes).items()) if shapes else RESPONSE_SHAPES,
+      partials=int(os.environ.get('LOADTEST_PARTIALS', 3)), seed=os.getpid()))
+  clients.register("chat", FakeChatSession(FakeBackend(
+      ApiStats(), latency=float(os.environ.get('LOADTEST_CHAT_LATENCY_MS', 100)) / 1000,
+      error_rate=backend.error_rate, seed=os.getpid())))
+  # Datastore is only read for the corpus generation, at most every 30s.
+  clients.register("datastore", FakeDatastoreClient(FakeBackend(ApiStats())))
+
+  from main import app
+  return app
+
+
+def chat_event(kind:str, rng:random.Random, questions:int, spaces:int):
+  """Builds a Google Chat MESSAGE event of kind, as the Chat API posts it."""
+  number = rng.randrange(spaces)
+  direct = kind.startswith("dm")
+  space = {"name": f"spaces/loadtest-{'dm' if direct else 'room'}-{number}",
+           "type": "DM" if direct else "ROOM"}
+  user = {"name": f"users/{number}", "displayName": f"Load Tester {number}", "type": "HUMAN"}
+  text = ("help" if kind.endswith("help")
+          else f"What does the handbook say about topic {rng.randrange(questions)}?")
+  message = {"name": f"{space['name']}/messages/{rng.getrandbits(32)}",
+             "sender": user,
+             "thread": {"name": f"{space['name']}/threads/{rng.randrange(4)}"},
+             "text": text if direct else f"@Drive Bot {text}"}
+  if not direct:
+    message["argumentText"] = f" {text}"
+  return {"type": "MESSAGE", "space": space, "user": user, "message": message}
+
+
+def run_load(url:str, concurrency:int, duration:float, warmup:float, questions:int,
+             spaces:int, seed:int):
+  """
+  Sends events from concurrency clients for warmup + duration seconds.
+
+  Returns the kind, latency and success of every request sent after the
+  warmup.
+  """
+  import requests
+
+  samples = []
+  lock = threading.Lock()
+  started = time.monotonic()
+  measure_from = started + warmup
+  deadline = measure_from + duration
+
+  def client(number):
+    rng = random.Random(seed * 1000 + number)
+    session = requests.Session()
+    kinds = [kind for kind, _ in EVENT_MIX]
+    weights = [weight for _, weight in EVENT_MIX]
+    while time.monotonic() < deadline:
+      kind = rng.choices(kinds, weights)[0]
+      event = chat_event(kind, rng, questions, spaces)
+      sent = time.monotonic()
+      try:
+        ok = session.post(f"{url}/chat", json=event, timeout=120).status_code == 200
+      except requests.RequestException:
+        ok = False
+      now = time.monotonic()
+      if sent >= measure_from and now <= deadline:
+        with lock:
+          samples.append((kind, now - sent, ok))
+
+  threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return samples
+
+
+def summarize(samples, duration:float):
+  """Returns the throughput, latency percentiles in ms and error rate of samples."""
+  latencies = sorted(latency for _, latency, _ in samples)
+  summary = {
+    "requests": len(samples),
+    "requests_per_second": round(len(samples) / duration, 2),
+    "error_rate": round(sum(1 for *_, ok in samples if not ok) / len(samples), 4)
+                  if samples else None,
+  }
+  for share in PERCENTILES:
+    summary[f"p{share * 100:g}_ms"] = (
+      round(latencies[max(0, math.ceil(share * len(latencies)) - 1)] * 1000, 1)
+      if latencies else None)
+  return summary
+
+
+def serve(workers:int, threads:int, env:dict):
+  """Starts gunicorn on a free local port and returns the process and its URL."""
+  with socket.socket() as probe:
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+  process = subprocess.Popen(
+      [sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{port}",
+       "--workers", str(workers), "--threads", str(threads), "--timeout", "120",
+       "loadtest:create_app()"],
+      cwd=os.path.dirname(os.path.abspath(__file__)), env={**os.environ, **env},
+      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  ready_by = time.monotonic() + 30
+  while time.monotonic() < ready_by:
+    if process.poll() is not None:
+      raise RuntimeError(f"gunicorn exited with {process.returncode}")
+    try:
+      socket.create_connection(("127.0.0.1", port), timeout=1).close()
+      return process, f"http://127.0.0.1:{port}"
+    except OSError:
+      time.sleep(0.2)
+  process.terminate()
+  raise RuntimeError("gunicorn did not start within 30s")
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--configs", nargs="+", default=["1x1", "4x1", "4x4"],
+                      help="gunicorn settings to run, as WORKERSxTHREADS")
+  parser.add_argument("--concurrency", type=int, default=16,
+                      help="clients sending events at once")
+  parser.add_argument("--duration", type=float, default=30,
+                      help="seconds measured per setting")
+  parser.add_argument("--warmup", type=float, default=3,
+                      help="seconds of load sent before measuring")
+  parser.add_argument("--latency-ms", type=float, default=1500,
+                      help="latency of each fake Dialogflow answer")
+  parser.add_argument("--chat-latency-ms", type=float, default=100,
+                      help="latency of each fake Chat API call, made by async replies")
+  parser.add_argument("--error-rate", type=float, default=0.0,
+                      help="share of fake Dialogflow and Chat API calls that fail")
+  parser.add_argument("--shapes", type=json.loads,
+                      help="JSON object of the weight per answer shape: text, action_link "
+                           "and indexing")
+  parser.add_argument("--reply-mode", choices=["sync", "async"], default="sync",
+                      help="CHAT_REPLY_MODE of the app")
+  parser.add_argument("--streaming", action="store_true",
+                      help="answer with streaming detect intent")
+  parser.add_argument("--questions", type=int, default=1000,
+                      help="distinct questions asked; fewer means more answer cache hits")
+  parser.add_argument("--spaces", type=int, default=200,
+                      help="distinct spaces and users the events come from")
+  parser.add_argument("--url", help="load a server already running at this URL instead")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--json", action="store_true", help="print raw JSON results")
+  args = parser.parse_args()
+
+  env = {
+    "LOADTEST_LATENCY_MS": str(args.latency_ms),
+    "LOADTEST_CHAT_LATENCY_MS": str(args.chat_latency_ms),
+    "LOADTEST_ERROR_RATE": str(args.error_rate),
+    "CHAT_REPLY_MODE": args.reply_mode,
+    # There is no Cloud Tasks queue to answer async replies locally.
+    "CHAT_REPLY_DISPATCH": "local",
+    "DIALOGFLOW_STREAMING": "1" if args.streaming else "",
+  }
+  if args.shapes:
+    env["LOADTEST_SHAPES"] = json.dumps(args.shapes)
+
+  results = []
+  for config in [None] if args.url else args.configs:
+    process = None
+    if config:
+      workers, threads = (int(part) for part in config.lower().split("x"))
+      process, url = serve(workers, threads, env)
+    else:
+      url = args.url.rstrip("/")
+    try:
+      samples = run_load(url, args.concurrency, args.duration, args.warmup,
+                         args.questions, args.spaces, args.seed)
+    finally:
+      if process:
+        process.terminate()
+        process.wait()
+    results.append({
+      "config": config or url,
+      "concurrency": args.concurrency,
+      **summarize(samples, args.duration),
+      "by_kind": {kind: summarize([sample for sample in samples if sample[0] == kind],
+                                  args.duration)
+                  for kind, _ in EVENT_MIX},
+    })
+
+  if args.json:
+    print(json.dumps(results, indent=2))
+    return
+
+  print(f"{'config':<10} {'clients':>7} {'requests':>9} {'req/s':>8} {'p50 ms':>9} "
+        f"{'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+  for result in results:
+    print(f"{result['config']:<10} {result['concurrency']:>7} {result['requests']:>9} "
+          f"{result['requests_per_second']:>8.2f} {result['p50_ms'] or 0:>9.1f} "
+          f"{result['p95_ms'] or 0:>9.1f} {result['p99_ms'] or 0:>9.1f} "
+          f"{(result['error_rate'] or 0):>7.2%}")
+
+
+if __name__ == '__main__':
+  main()
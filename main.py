@@ -23,58 +23,194 @@ import os
 import uuid
 
 from flask import Flask, request
-from google.cloud import dialogflowcx_v3
-import google.auth
-from google.oauth2 import service_account
-from storageservice import Storage
-from drivewatch import DriveWatch
-from checkfolder import trigger_drive_watch
-from initialize import ApiEnable
+
+import clients
+import metrics
+from answercache import AnswerCache
+from chatreply import AsyncReplier, CHAT_REPLY_MODE
+from chatsessions import SessionTable
+
+INDEXING_MESSAGE = 'Indexing didn\'t finish yet, please come back in a few hours.'
+# "discoveryengine" answers from a summarized search of DATASTORE_ID, or
+# the only sync target's datastore; anything else asks the Dialogflow CX agent.
+ANSWER_BACKEND = os.environ.get('ANSWER_BACKEND', 'dialogflow')
+if ANSWER_BACKEND == 'discoveryengine':
+  # Checked at startup rather than failing every question.
+  from checkfolder import search_datastore_id
+  SEARCH_DATASTORE_ID = search_datastore_id()
+# Streams detect intent, so async replies show partial answers as they arrive.
+DIALOGFLOW_STREAMING = os.environ.get('DIALOGFLOW_STREAMING', '') in ('1', 'true')
+REQUIRED_APIS = ['iam.googleapis.com', 'dialogflow.googleapis.com', 'datastore.googleapis.com',
+                 'discoveryengine.googleapis.com', 'drive.googleapis.com', 'chat.googleapis.com']
 
 # Initialize Flask app
 app = Flask(__name__)
+answer_cache = AnswerCache()
+sessions = SessionTable()
+search_answers = None
+# Set once _init has run or found the setup done, so later hits to / are free.
+_initialized = False
+# Looked up on each call, as answer_question is defined below the routes.
+async_replier = AsyncReplier(
+    lambda *args, **kwargs: answer_question(*args, **kwargs),
+    partial_replies=DIALOGFLOW_STREAMING)
 
 
 # Generates an answer from question sent to Conversational AI
-def generate_answer(prompt, agent):
+def generate_answer(prompt, agent, session_id=None, on_partial=None):
+  """Asks the agent in session_id, or a new session, and returns the query result.
+
+    With DIALOGFLOW_STREAMING on, the text of each partial response is
+    passed to on_partial as it arrives.
+  """
+  # Imported here so instances serving only /watch never load it.
+  from google.cloud import dialogflowcx_v3
+
   # Construct session to interact with DialogFlow API
 
   agent = f'projects/{os.environ.get("PROJECT")}/locations/global/agents/{agent}'
-  session_id = uuid.uuid4()
-  session_path = f'{agent}/sessions/{session_id}'
+  session_path = f'{agent}/sessions/{session_id or uuid.uuid4()}'
   # Call DialogFlow CX API https://cloud.google.com/dialogflow/cx/docs/quick/api#detect-intent-python
-  credentials, project_id = google.auth.default()
-  client = dialogflowcx_v3.SessionsClient(credentials=credentials)
+  client = clients.get("dialogflow")
 
   query_input = dialogflowcx_v3.QueryInput()
   query_input.text.text = prompt
   query_input.language_code = 'en-us'
-  dfcx_request = dialogflowcx_v3.DetectIntentRequest(
-      session=session_path,
-      query_input=query_input,
-  )
 
-  # Make the request, then return answer
-  response = client.detect_intent(request=dfcx_request)
-  result = response.query_result
+  if DIALOGFLOW_STREAMING:
+    result = _stream_answer(client, session_path, query_input, on_partial)
+  else:
+    dfcx_request = dialogflowcx_v3.DetectIntentRequest(
+        session=session_path,
+        query_input=query_input,
+    )
+
+    # Make the request, then return answer
+    with metrics.timed("dialogflow", "detect_intent"):
+      response = client.detect_intent(request=dfcx_request)
+    result = response.query_result
   answer = dialogflowcx_v3.types.session.QueryResult.to_json(result)
   return json.loads(answer)
 
+def _stream_answer(client, session_path, query_input, on_partial):
+  """Runs a streaming detect intent and returns the final query result."""
+  from google.cloud import dialogflowcx_v3
+  partial = dialogflowcx_v3.DetectIntentResponse.ResponseType.PARTIAL
+  dfcx_request = dialogflowcx_v3.StreamingDetectIntentRequest(
+      session=session_path,
+      query_input=query_input,
+      enable_partial_response=True,
+  )
+  result = None
+  with metrics.timed("dialogflow", "streaming_detect_intent"):
+    for response in client.streaming_detect_intent(requests=iter([dfcx_request])):
+      detect_intent_response = response.detect_intent_response
+      if not detect_intent_response:
+        continue
+      if detect_intent_response.response_type == partial:
+        text = ' '.join(text for message in detect_intent_response.query_result.response_messages
+                        for text in message.text.text)
+        if text and on_partial:
+          on_partial(text)
+      else:
+        result = detect_intent_response.query_result
+  if result is None:
+    raise RuntimeError('Streaming detect intent ended without a final response')
+  return result
+
 @app.route('/', methods=['GET'])
 def get_handler():
   """Initial Setup."""
   _init()
   return 'Hello World'
 
+@app.route('/_ah/warmup', methods=['GET'])
+def warmup():
+  """Creates the shared API clients before the instance takes traffic."""
+  clients.warm_up()
+  return '', 200
+
 @app.route('/watch', methods=['GET'])
 def trigger_drive_watch_route():
-  """Checks the drive folder for modifications."""
-  trigger_drive_watch()
+  """Checks the drive folder for modifications.
+
+    With ?dry_run=1 the planned uploads, re-exports and deletes of each
+    target are returned as JSON, with the error of any target that could
+    not be planned, and nothing is changed. The status is 500 if a target
+    failed.
+
+    If another run is in progress this returns its status at once, or with
+    ?wait=1 waits for it to end and returns how it ended.
+  """
+  from checkfolder import trigger_drive_watch, wait_for_watch
+  from lease import LeaseHeld
+  if request.args.get('dry_run') in ('1', 'true'):
+      result = trigger_drive_watch(dry_run=True)
+      return result, 500 if result["errors"] else 200
+  # With push notifications the cron is only a safety net.
+  from pushnotify import PUSH_NOTIFICATIONS, recently_synced
+  if PUSH_NOTIFICATIONS and 'X-Appengine-Cron' in request.headers and recently_synced():
+      return 'Skipped, a push-triggered sync ran recently'
+  try:
+      trigger_drive_watch()
+  except LeaseHeld as held:
+      if request.args.get('wait') in ('1', 'true'):
+          return wait_for_watch(), 200
+      return {'status': 'running', **held.status}, 200
   return 'Triggered Drive Watch'
 
+@app.route('/push', methods=['POST'])
+def push_notification():
+  """Receives Drive change notifications and schedules a sync."""
+  from pushnotify import handle_notification
+  return handle_notification(request.headers)
+
+@app.route('/push/sync', methods=['POST'])
+def push_sync():
+  """Runs a sync scheduled on Cloud Tasks by push notifications."""
+  # App Engine strips this header from requests that Cloud Tasks did not send.
+  if 'X-AppEngine-QueueName' not in request.headers:
+      return 'This service only processes tasks from Cloud Tasks', 403
+  from pushnotify import run_push_sync
+  return run_push_sync(request.get_json(silent=False))
+
+@app.route('/push/renew', methods=['GET'])
+def renew_push_channel():
+  """Registers the Drive watch channel, or replaces it before it expires."""
+  from pushnotify import PUSH_NOTIFICATIONS, channels
+  if not PUSH_NOTIFICATIONS:
+      return 'Push notifications are disabled'
+  channel = channels.renew()
+  return f"Channel {channel['id']} expires at {channel['expiration']}"
+
+@app.route('/tasks', methods=['POST'])
+def run_sync_task():
+  """Carries out a batch of sync work dispatched to Cloud Tasks."""
+  # App Engine strips this header from requests that Cloud Tasks did not send.
+  if 'X-AppEngine-QueueName' not in request.headers:
+      return 'This service only processes tasks from Cloud Tasks', 403
+  from checkfolder import run_sync_task
+  run_sync_task(request.get_json(silent=False))
+  return 'OK', 200
+
+@app.route('/chat/reply', methods=['POST'])
+def chat_reply():
+  """Answers a chat message in its placeholder, as queued on Cloud Tasks by /chat."""
+  # App Engine strips this header from requests that Cloud Tasks did not send.
+  if 'X-AppEngine-QueueName' not in request.headers:
+      return 'This service only processes tasks from Cloud Tasks', 403
+  async_replier.reply(request.get_json(silent=False))
+  return 'OK', 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+  """Serves the API call and stage metrics in the Prometheus text format."""
+  return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
 @app.route('/chat', methods=['POST'])
 def chat_bot():
-  return handler()
+  with metrics.stage("chat_handler"):
+    return handler()
 
 def handler():
   """Chat Bot Handler.
@@ -98,6 +234,8 @@ def handler():
       text = event_data['message']['text'].strip()
   if text:
       first = text.split()[0].lower()
+  space = event_data['space']['name']
+  thread = event_data.get('message', {}).get('thread', {}).get('name')
 
   # Print help message
   if first in ('?', 'hi', 'hello', 'help', 'hey', 'start', 'test', '/help'):
@@ -107,29 +245,96 @@ def handler():
           name = f"<{event_data['user']['name']}>"  # 'users/[USER_ID]'
       output_message = f'Hi *{name}*! As a demo, ask a question on the data trained for the bot.'
 
+  # Answer in a task and update a placeholder when ready
+  elif CHAT_REPLY_MODE == 'async' and async_replier.submit(space, thread, text, agent,
+                                                           space, thread):
+      return {}, 200
+
   # Query Dialogflow for LLM answer
   else:
-      answer = generate_answer(text, agent)
-      responses = answer['responseMessages']
-      output_message = responses[0]['text']['text'][0]
-
-      if output_message == 'Indexing didn\'t finish yet, please come back in a few hours.':
-          output_message = 'Sorry, I can\'t help you with that.'
-      elif len(responses) > 1 and 'payload' in responses[1]:
-          content = responses[1]['payload']['richContent'][0][0]
-          action_link = None
-          for k, v in content.items():
-              if k == 'actionLink':
-                  action_link = v
-                  break
-          output_message += f'\n{action_link}'
-          print(f'response {output_message}')
+      output_message = answer_question(text, agent, space, thread)
   return {'text': output_message}, 200
 
+def answer_question(text, agent, space=None, thread=None, on_partial=None):
+  """Returns the reply text for a question, using cached answers if possible.
+
+    Questions in the same space and thread share a Dialogflow session. Only
+    the first question of a session is answered from the cache, as later
+    ones may depend on the conversation so far.
+  """
+  if ANSWER_BACKEND == 'discoveryengine':
+      return search_question(text)
+  session_id, new_session = sessions.get(agent, space, thread)
+  answer = answer_cache.get(text, agent) if new_session else None
+  if answer is None:
+      answer = generate_answer(text, agent, session_id, on_partial)
+      if new_session and answer['responseMessages'][0]['text']['text'][0] != INDEXING_MESSAGE:
+          answer_cache.put(text, agent, answer)
+  responses = answer['responseMessages']
+  output_message = responses[0]['text']['text'][0]
+
+  if output_message == INDEXING_MESSAGE:
+      output_message = 'Sorry, I can\'t help you with that.'
+  elif len(responses) > 1 and 'payload' in responses[1]:
+      content = responses[1]['payload']['richContent'][0][0]
+      action_link = None
+      for k, v in content.items():
+          if k == 'actionLink':
+              action_link = v
+              break
+      output_message += f'\n{action_link}'
+      print(f'response {output_message}')
+  return output_message
+
+def search_question(text):
+  """Returns the reply text for a question answered by Discovery Engine search."""
+  global search_answers
+  if search_answers is None:
+      from discoveryengine import SearchAnswers
+      search_answers = SearchAnswers(SEARCH_DATASTORE_ID)
+  # Cached apart from agent answers, under the datastore searched.
+  cache_key = f'search:{search_answers.data_store_id}'
+  answer = answer_cache.get(text, cache_key)
+  if answer is None:
+      answer = search_answers.answer(text)
+      if answer['text']:
+          answer_cache.put(text, cache_key, answer)
+
+  if not answer['text']:
+      return 'Sorry, I can\'t help you with that.'
+  output_message = answer['text']
+  for number, citation in enumerate(answer['citations'], start=1):
+      output_message += f'\n[{number}] <{citation["link"]}|{citation["title"]}>'
+  return output_message
+
 def _init():
-  for api in ['iam.googleapis.com','dialogflow.googleapis.com','datastore.googleapis.com','discoveryengine.googleapis.com','drive.googleapis.com']:
-    ApiEnable().enable_api(project_id=os.environ.get('PROJECT'), api=api)
-  storage = Storage().check_storage(bucket_name=f"{os.environ.get('PROJECT')}_{os.environ.get('BUCKET_NAME')}")
+  """Enables the APIs and creates the buckets, once per configuration."""
+  global _initialized
+  if _initialized:
+      return
+  from google.api_core.exceptions import GoogleAPICallError
+  from checkfolder import load_targets
+  from datastore import Datastore
+  from initialize import ApiEnable
+  from storageservice import Storage
+
+  bucket_names = sorted(target.bucket_name for target in load_targets())
+  # Adding an API or a sync target changes the fingerprint, which runs the
+  # setup again.
+  fingerprint = json.dumps([REQUIRED_APIS, bucket_names])
+  datastore = Datastore()
+  try:
+      done = datastore.fetch("initialized") == fingerprint
+  except GoogleAPICallError:
+      # Datastore itself may not be enabled yet.
+      done = False
+  if not done:
+      ApiEnable().enable_apis(project_id=os.environ.get('PROJECT'), apis=REQUIRED_APIS)
+      storage = Storage()
+      for bucket_name in bucket_names:
+          storage.check_storage(bucket_name=bucket_name)
+      datastore.store(key="initialized", value=fingerprint, indexed=False)
+  _initialized = True
 
 if __name__ == '__main__':
   app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Process-wide metrics and structured logging.
+
+External calls are wrapped in timed() and sync or chat stages in stage().
+Both feed counters and latency histograms that render() exposes in the
+Prometheus text format, and stages are also written to stdout as JSON
+entries, which App Engine turns into structured logs.
+"""
+
+import collections
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIX = "drivebot"
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_DESCRIPTIONS = {
+  "api_calls_total": ("counter", "External API calls."),
+  "api_errors_total": ("counter", "External API calls that raised."),
+  "api_retries_total": ("counter", "External API calls retried."),
+  "api_bytes_total": ("counter", "Bytes transferred through external APIs."),
+  "api_call_seconds": ("histogram", "Latency of external API calls."),
+  "stage_seconds": ("histogram", "Duration of sync and chat stages."),
+  "stage_errors_total": ("counter", "Sync and chat stages that raised."),
+}
+
+
+class Registry:
+  """Thread-safe counters and histograms keyed by name and labels."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._counters = collections.defaultdict(float)
+    self._histograms = {}
+
+  def inc(self, name:str, value:float=1, **labels):
+    with self._lock:
+      self._counters[(name, _label_key(labels))] += value
+
+  def observe(self, name:str, value:float, **labels):
+    key = (name, _label_key(labels))
+    with self._lock:
+      histogram = self._histograms.get(key)
+      if histogram is None:
+        # One count per bucket, then +Inf, then the sum.
+        histogram = self._histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+      for i, bound in enumerate(BUCKETS):
+        if value <= bound:
+          histogram[i] += 1
+      histogram[len(BUCKETS)] += 1
+      histogram[-1] += value
+
+  def render(self):
+    """Returns every metric in the Prometheus text exposition format."""
+    with self._lock:
+      counters = dict(self._counters)
+      histograms = {key: list(value) for key, value in self._histograms.items()}
+
+    lines = []
+    for name, (kind, description) in _DESCRIPTIONS.items():
+      full_name = f"{PREFIX}_{name}"
+      lines.append(f"# HELP {full_name} {description}")
+      lines.append(f"# TYPE {full_name} {kind}")
+      for (metric, labels), value in sorted(counters.items()):
+        if metric == name:
+          lines.append(f"{full_name}{_format_labels(labels)} {value:g}")
+      for (metric, labels), histogram in sorted(histograms.items()):
+        if metric != name:
+          continue
+        for bound, count in zip(BUCKETS, histogram):
+          lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', f'{bound:g}'),))} {count}")
+        lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram[len(BUCKETS)]}")
+        lines.append(f"{full_name}_sum{_format_labels(labels)} {histogram[-1]:g}")
+        lines.append(f"{full_name}_count{_format_labels(labels)} {histogram[len(BUCKETS)]}")
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _label_key(labels):
+  return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels):
+  if not labels:
+    return ""
+  return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _escape(value):
+  return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+@contextmanager
+def timed(api:str, operation:str):
+  """Counts and times one external call, recording it as an error if it raises."""
+  started = time.perf_counter()
+  try:
+    yield
+  except Exception:
+    REGISTRY.inc("api_errors_total", api=api, operation=operation)
+    raise
+  finally:
+    REGISTRY.inc("api_calls_total", api=api, operation=operation)
+    REGISTRY.observe("api_call_seconds", time.perf_counter() - started,
+                     api=api, operation=operation)
+
+
+@contextmanager
+def stage(name:str, **fields):
+  """
+  Times a stage of a sync or chat request and logs it when it ends.
+
+  The block receives a dict it can add fields to, such as item counts, for
+  the structured log entry.
+  """
+  started = time.perf_counter()
+  error = None
+  try:
+    yield fields
+  except Exception as exc:
+    error = exc
+    REGISTRY.inc("stage_errors_total", stage=name)
+    raise
+  finally:
+    duration = time.perf_counter() - started
+    REGISTRY.observe("stage_seconds", duration, stage=name)
+    log(f"{name} {'failed' if error else 'finished'} in {duration:.3f}s",
+        severity="ERROR" if error else "INFO",
+        stage=name, duration_seconds=round(duration, 3), **fields)
+
+
+def add_bytes(api:str, direction:str, size:int):
+  REGISTRY.inc("api_bytes_total", size, api=api, direction=direction)
+
+
+def record_retry(api:str, operation:str):
+  REGISTRY.inc("api_retries_total", api=api, operation=operation)
+
+
+def log(message:str, severity:str="INFO", **fields):
+  """Writes a structured log entry to stdout."""
+  print(json.dumps({"severity": severity, "message": message, **fields}, default=str),
+        flush=True)
+
+
+def render():
+  return REGISTRY.render()
@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Drive push notifications.
+
+With PUSH_NOTIFICATIONS=1 a watch channel on the Drive changes feed posts
+to the /push route whenever something changes. Bursts of notifications are
+debounced into one incremental sync, run by a Cloud Task on the /push/sync
+route PUSH_DEBOUNCE seconds after the first of them. The /push/renew cron
+keeps a channel registered, and the /watch cron only syncs when no sync has
+run for PUSH_SAFETY_INTERVAL.
+"""
+
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+import uuid
+
+from googleapiclient.errors import HttpError
+
+PUSH_NOTIFICATIONS = os.environ.get('PUSH_NOTIFICATIONS', '') in ('1', 'true')
+PUSH_ADDRESS = os.environ.get('PUSH_ADDRESS') or f"https://{os.environ.get('PROJECT')}.appspot.com/push"
+# Drive keeps a changes channel open for at most a week.
+PUSH_CHANNEL_TTL = int(os.environ.get('PUSH_CHANNEL_TTL', 24 * 3600))
+# A channel expiring sooner than this is replaced on renewal.
+PUSH_RENEW_MARGIN = int(os.environ.get('PUSH_RENEW_MARGIN', 12 * 3600))
+PUSH_DEBOUNCE = float(os.environ.get('PUSH_DEBOUNCE', 5))
+PUSH_SAFETY_INTERVAL = float(os.environ.get('PUSH_SAFETY_INTERVAL', 3600))
+# Times a push sync is put off while another run holds the lease, at
+# delays doubling from PUSH_DEBOUNCE up to PUSH_RETRY_MAX_DELAY seconds.
+# After that the /watch cron picks the changes up.
+PUSH_RETRY_ATTEMPTS = int(os.environ.get('PUSH_RETRY_ATTEMPTS', 5))
+PUSH_RETRY_MAX_DELAY = float(os.environ.get('PUSH_RETRY_MAX_DELAY', 120))
+PUSH_SYNC_PATH = '/push/sync'
+
+
+class SyncScheduler:
+  """
+  Coalesces bursts of notifications into single syncs run by Cloud Tasks.
+
+  The first notification of a burst creates a task that runs the sync
+  delay seconds later. Tasks are named after the delay window they are
+  created in, so Cloud Tasks refuses the rest of the burst as duplicates,
+  whichever instance receives them.
+  """
+
+  def __init__(self, dispatcher=None, delay:float=PUSH_DEBOUNCE):
+    self._dispatcher = dispatcher
+    self.delay = delay
+    # The last window this instance scheduled, which needs no more calls.
+    self._window = None
+
+  def dispatcher(self):
+    # Created on first use, as renewals and syncs never schedule.
+    if self._dispatcher is None:
+      from taskqueue import CloudTasksDispatcher
+      self._dispatcher = CloudTasksDispatcher()
+    return self._dispatcher
+
+  def trigger(self):
+    """Schedules a sync unless one is already scheduled; True if this call did."""
+    window = int(time.time() // self.delay)
+    if window == self._window:
+      return False
+    self._window = window
+    return self.dispatcher().dispatch({"attempt": 0}, path=PUSH_SYNC_PATH, delay=self.delay,
+                                      name=f"push-sync-{window}")
+
+  def retry(self, attempt:int):
+    """
+    Schedules a sync again after attempt found the lease held, backing off.
+
+    Returns False once PUSH_RETRY_ATTEMPTS are spent.
+    """
+    if attempt + 1 >= PUSH_RETRY_ATTEMPTS:
+      print(f"Push-triggered sync put off {attempt + 1} times, leaving it to the cron.")
+      return False
+    delay = min(self.delay * 2 ** (attempt + 1), PUSH_RETRY_MAX_DELAY)
+    return self.dispatcher().dispatch({"attempt": attempt + 1}, path=PUSH_SYNC_PATH,
+                                      delay=delay)
+
+
+class PushChannels:
+  """Registers, renews and checks the Drive watch channel."""
+
+  def __init__(self, drive=None, datastore=None, address:str=PUSH_ADDRESS):
+    self._drive = drive
+    self._datastore = datastore
+    self.address = address
+    self._lock = threading.Lock()
+    self._channel = None
+
+  def drive(self):
+    # Created on first use, as notifications only need Datastore.
+    if self._drive is None:
+      from driveservice import Drive
+      self._drive = Drive()
+    return self._drive
+
+  def datastore(self):
+    if self._datastore is None:
+      from datastore import Datastore
+      self._datastore = Datastore()
+    return self._datastore
+
+  def current(self, refresh:bool=False):
+    """Returns the registered channel, read from Datastore on first use."""
+    with self._lock:
+      if self._channel is None or refresh:
+        self._channel = json.loads(self.datastore().fetch("push_channel") or "null")
+      return self._channel
+
+  def renew(self):
+    """
+    Registers a channel unless the current one lasts beyond PUSH_RENEW_MARGIN.
+
+    The replacement is stored before the old channel is stopped, so changes
+    are not missed in between. Returns the channel in use.
+    """
+    channel = self.current(refresh=True)
+    if channel and channel["expiration"] / 1000 > time.time() + PUSH_RENEW_MARGIN:
+      return channel
+
+    token = secrets.token_urlsafe(32)
+    response = self.drive().watch_changes(
+        self.drive().get_start_page_token(), channel_id=str(uuid.uuid4()),
+        address=self.address, token=token,
+        expiration=int((time.time() + PUSH_CHANNEL_TTL) * 1000))
+    new_channel = {"id": response["id"], "resourceId": response["resourceId"],
+                   "expiration": int(response["expiration"]), "token": token}
+    self.datastore().store(key="push_channel", value=json.dumps(new_channel), indexed=False)
+    with self._lock:
+      self._channel = new_channel
+    print(f"Registered push channel {new_channel['id']}.")
+
+    if channel:
+      try:
+        self.drive().stop_channel(channel["id"], channel["resourceId"])
+      except HttpError as error:
+        # An expired channel is already gone.
+        print(f"Could not stop push channel {channel['id']}: {error}")
+    return new_channel
+
+  def verify(self, channel_id:str, token:str):
+    """Checks that a notification came from the registered channel."""
+    channel = self.current()
+    if channel and channel["id"] != channel_id:
+      # Another instance may have renewed the channel.
+      channel = self.current(refresh=True)
+    return bool(channel and channel["id"] == channel_id
+                and hmac.compare_digest(channel["token"], token or ""))
+
+
+channels = PushChannels()
+scheduler = SyncScheduler()
+
+
+def handle_notification(headers):
+  """
+  Answers a Drive notification request, given its headers.
+
+  Returns the response body and status code. Notifications that do not
+  carry the registered channel's id and token are refused.
+  """
+  if not channels.verify(headers.get('X-Goog-Channel-ID'), headers.get('X-Goog-Channel-Token')):
+    return 'Unknown channel', 403
+  state = headers.get('X-Goog-Resource-State')
+  # Drive sends a sync message when the channel opens.
+  if state != 'sync':
+    scheduler.trigger()
+  return '', 200
+
+
+def run_push_sync(payload:dict):
+  """
+  Runs the sync a notification scheduled, given the task's payload.
+
+  If another run holds the lease, it may have read the changes before this
+  burst, so the sync is scheduled again for after it.
+  """
+  from checkfolder import trigger_drive_watch
+  from lease import LeaseHeld
+  try:
+    trigger_drive_watch()
+  except LeaseHeld:
+    scheduler.retry(payload.get("attempt", 0))
+    return 'Put off, another sync is running'
+  return 'Synced'
+
+
+def recently_synced(datastore=None):
+  """Checks whether a sync ran within PUSH_SAFETY_INTERVAL seconds."""
+  last_sync = (datastore or channels.datastore()).fetch("last_sync")
+  return bool(last_sync) and time.time() - last_sync < PUSH_SAFETY_INTERVAL
@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Quota-aware rate limiting and retries for external API calls.
+
+Every call to an API is paced by a token bucket shared by all the threads
+of the instance. A call that fails with a rate limit or server error is
+retried with exponential backoff and full jitter, waiting at least as long
+as the Retry-After header asks. Rate limit errors also halve the bucket's
+rate, which then climbs back to the configured ceiling as calls succeed.
+"""
+
+import email.utils
+import json
+import os
+import random
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+import metrics
+
+# Calls per second each API is paced to, kept under the default quotas:
+# Drive allows 12,000 queries a minute and Cloud Storage ramps up from
+# about 1,000 object writes a second per bucket. Other APIs are unpaced.
+DEFAULT_RATE_LIMITS = {"drive": 180, "storage": 500}
+# A JSON object overriding the defaults per API, e.g. {"drive": 50}.
+RATE_LIMITS = {**DEFAULT_RATE_LIMITS,
+               **json.loads(os.environ.get('RATE_LIMITS') or '{}')}
+# Attempts made at a call before its error is raised.
+RETRY_ATTEMPTS = int(os.environ.get('RETRY_ATTEMPTS', 6))
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 32))
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+
+class TokenBucket:
+  """
+  Hands out calls at up to rate a second, with bursts of up to a second's worth.
+
+  slow_down() halves the rate, down to a tenth of the ceiling, and each
+  speed_up() adds back a hundredth of it.
+  """
+
+  def __init__(self, rate:float):
+    self.ceiling = rate
+    self.rate = rate
+    self._tokens = rate
+    self._updated = time.monotonic()
+    self._lock = threading.Lock()
+
+  def _refill(self):
+    now = time.monotonic()
+    self._tokens = min(self.ceiling, self._tokens + (now - self._updated) * self.rate)
+    self._updated = now
+
+  def acquire(self, count:int=1):
+    """Blocks until count calls may be made."""
+    while True:
+      with self._lock:
+        self._refill()
+        # A batch larger than a burst waits for a full bucket and runs it into debt.
+        needed = min(count, self.ceiling)
+        if self._tokens >= needed:
+          self._tokens -= count
+          return
+        wait = (needed - self._tokens) / self.rate
+      time.sleep(wait)
+
+  def slow_down(self):
+    with self._lock:
+      self.rate = max(self.ceiling / 10, self.rate / 2)
+
+  def speed_up(self):
+    with self._lock:
+      self.rate = min(self.ceiling, self.rate + self.ceiling / 100)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def bucket(api:str):
+  """Returns the shared token bucket of api, or None if it is unpaced."""
+  with _buckets_lock:
+    if api not in _buckets:
+      rate = RATE_LIMITS.get(api)
+      _buckets[api] = TokenBucket(rate) if rate else None
+    return _buckets[api]
+
+
+def slow_down(api:str):
+  limiter = bucket(api)
+  if limiter:
+    limiter.slow_down()
+
+
+def error_status(error):
+  """Returns the HTTP status of an API error, or None if it has none."""
+  if isinstance(error, HttpError):
+    return error.resp.status
+  code = getattr(error, "code", None)
+  if isinstance(code, int):
+    return code
+  response = getattr(error, "response", None)
+  return getattr(response, "status_code", None)
+
+
+def is_rate_limited(error):
+  status = error_status(error)
+  if status == 429:
+    return True
+  if status == 403 and isinstance(error, HttpError):
+    content = error.content.decode("utf-8", "replace") if error.content else ""
+    return any(reason in content for reason in RATE_LIMIT_REASONS)
+  return False
+
+
+def is_retryable(error):
+  return error_status(error) in RETRYABLE_STATUSES or is_rate_limited(error)
+
+
+def is_permanent(error):
+  """Whether error will recur however often its call is repeated, such as a 404 for a deleted file."""
+  status = error_status(error)
+  return (status is not None and 400 <= status < 500 and status != 408
+          and not is_retryable(error))
+
+
+def retry_after(error):
+  """Returns the seconds the Retry-After header of an error asks for, or 0."""
+  if isinstance(error, HttpError):
+    value = error.resp.get("retry-after")
+  else:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    value = headers.get("Retry-After")
+  if not value:
+    return 0
+  try:
+    return max(0, float(value))
+  except ValueError:
+    pass
+  try:
+    return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+  except (TypeError, ValueError):
+    return 0
+
+
+def backoff(attempt:int):
+  """Returns a jittered delay before retry number attempt + 1."""
+  return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def wait_to_retry(api:str, operation:str, error, attempt:int):
+  """
+  Waits before another attempt at a call that failed with error.
+
+  Raises error instead if it is not retryable or attempt was the last.
+  """
+  if not is_retryable(error) or attempt + 1 >= RETRY_ATTEMPTS:
+    raise error
+  if is_rate_limited(error):
+    slow_down(api)
+  delay = max(retry_after(error), backoff(attempt))
+  metrics.record_retry(api, operation)
+  print(f"{api} {operation} failed with {error_status(error)}, retrying in {delay:.1f}s")
+  time.sleep(delay)
+
+
+def call(api:str, operation:str, fn, cost:int=1, attempts:int=None):
+  """
+  Makes a paced and timed call to fn, retrying it while it fails with retryable errors.
+
+  cost is the number of calls fn makes, such as the size of a batch.
+  attempts caps the tries below RETRY_ATTEMPTS, with 1 for calls that
+  cannot safely be repeated.
+  """
+  limiter = bucket(api)
+  attempts = min(attempts or RETRY_ATTEMPTS, RETRY_ATTEMPTS)
+  attempt = 0
+  while True:
+    if limiter:
+      limiter.acquire(cost)
+    try:
+      with metrics.timed(api, operation):
+        result = fn()
+    except Exception as error:
+      if attempt + 1 >= attempts:
+        if is_rate_limited(error):
+          slow_down(api)
+        raise
+      wait_to_retry(api, operation, error, attempt)
+      attempt += 1
+      continue
+    if limiter:
+      limiter.speed_up()
+    return result
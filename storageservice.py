@@ -17,16 +17,30 @@ limitations under the License.
 
 Cloud Storage Service.
 """
-import io
+import base64
+import time
+
+import clients
+import metrics
+import ratelimit
+from driveservice import Drive, CHUNK_SIZE, get_content_type
+
+# Cloud Storage accepts up to 100 calls in one batch request.
+DELETE_BATCH_SIZE = 100
+
+
+class _BatchSent(Exception):
+  """Ends a batch block whose requests were already sent with finish()."""
+
+
+class ChecksumMismatch(Exception):
+  """Raised when an uploaded file's content is not the revision that was planned."""
 
-from google.cloud import storage
-from driveservice import Drive
-from google.cloud.storage import Blob
 
 class Storage:
-  def __init__(self):
-    self.storage = storage.Client()
-    self.drive = Drive()
+  def __init__(self, drive:Drive=None):
+    self.storage = clients.get("storage")
+    self.drive = drive or Drive()
 
 
   def check_storage(self, bucket_name: str, storage_class: str = "STANDARD"):
@@ -59,41 +73,164 @@ class Storage:
     )
     return new_bucket
 
-  def list_bucket_files(self, bucket_name: str):
-    blobs = self.storage.list_blobs(bucket_name)
-    return [blob.name for blob in blobs]
+  def list_bucket_files(self, bucket_name: str, prefix: str = None):
+    """
+    Lists the bucket's objects, or those whose names start with prefix,
+    with their metadata in a single pass.
 
-  def upload_file(self, bucket_name: str, file_id: str, mime_type: str):
+    Returns a dict per object with its name, generation, size, md5 and
+    updated time.
     """
-    Uploads a file to the bucket from Google Drive.
+    # The iterator fetches pages as it is consumed, so all of them are
+    # timed, and a listing that fails part way is started again.
+    def list_blobs():
+      blobs = self.storage.list_blobs(
+          bucket_name, prefix=prefix,
+          fields="items(name,generation,size,md5Hash,updated),nextPageToken")
+      return [{"name": blob.name,
+               "generation": blob.generation,
+               "size": blob.size,
+               "md5": blob.md5_hash,
+               "updated": blob.updated} for blob in blobs]
+    return ratelimit.call("storage", "objects.list", list_blobs)
+
+  def upload_file(self, bucket_name: str, file_id: str, mime_type: str, object_name: str,
+                  md5_checksum: str = None):
+    """
+    Streams a file from Google Drive into the bucket as object_name.
+
+    Chunks read from Drive are written straight into a resumable upload, so
+    memory use stays at a few chunks whatever the size of the file. A failed
+    download raises before the upload is finalized.
+
+    Drive serves the file's current revision. If md5_checksum is given and
+    the uploaded content has another MD5, the object is deleted again and
+    ChecksumMismatch is raised.
+
+    Returns the generation of the uploaded object.
     """
-    file = self.drive.get_drive_blob(file_id, mime_type)
     bucket = self.storage.bucket(bucket_name)
-    blob = Blob(f"{file_id}.pdf", bucket)
-    stream = io.BytesIO(file)
-    blob.upload_from_file(stream, rewind=True)
+    blob = bucket.blob(object_name, chunk_size=CHUNK_SIZE)
+    stream = self.drive.open_drive_blob(file_id, mime_type, chunk_size=CHUNK_SIZE)
+    # Without a size the upload is resumable and ends at the first short
+    # chunk read from the stream. The stream cannot be rewound, so a failed
+    # upload is not repeated here; the item is retried by the next run.
+    ratelimit.call("storage", "objects.upload",
+                   lambda: blob.upload_from_file(stream, size=None,
+                                                 content_type=get_content_type(mime_type)),
+                   attempts=1)
+    metrics.add_bytes("storage", "upload", stream.tell())
+    uploaded_md5 = base64.b64decode(blob.md5_hash).hex() if blob.md5_hash else None
+    if md5_checksum and uploaded_md5 not in (None, md5_checksum):
+      generation = blob.generation
+      ratelimit.call("storage", "objects.delete",
+                     lambda: blob.delete(if_generation_match=generation))
+      raise ChecksumMismatch(f"{file_id} changed since it was planned: uploaded MD5 "
+                             f"{uploaded_md5}, expected {md5_checksum}")
 
     print(
         "File {} uploaded to {}.".format(
             blob.name, bucket.name
         )
     )
+    return blob.generation
+
+  def find_object(self, bucket_name: str, object_name: str):
+    """Returns the generation of object_name, or None if it is not stored."""
+    blob = ratelimit.call("storage", "objects.get",
+                          lambda: self.storage.bucket(bucket_name).get_blob(object_name))
+    return blob.generation if blob else None
+
+  def upload_data(self, bucket_name: str, data: bytes, content_type: str, object_name: str):
+    """Uploads content already in memory as object_name and returns its generation."""
+    blob = self.storage.bucket(bucket_name).blob(object_name)
+    ratelimit.call("storage", "objects.upload",
+                   lambda: blob.upload_from_string(data, content_type=content_type))
+    metrics.add_bytes("storage", "upload", len(data))
+    print(f"File {blob.name} uploaded to {bucket_name}.")
+    return blob.generation
+
+  def upload_stream(self, bucket_name: str, chunks, content_type: str, object_name: str):
+    """
+    Uploads the byte strings chunks yields as object_name.
 
-  def delete_blob(self, bucket_name, blob_name):
-    """Deletes a blob from the bucket."""
-    # bucket_name = "your-bucket-name"
-    # blob_name = "your-object-name"
-
-    bucket = self.storage.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    generation_match_precondition = None
-
-    # Optional: set a generation-match precondition to avoid potential race conditions
-    # and data corruptions. The request to delete is aborted if the object's
-    # generation number does not match your precondition.
-    blob.reload()  # Fetch blob metadata to use in generation_match_precondition.
-    generation_match_precondition = blob.generation
+    They are written into a resumable upload as they come, so no more than
+    a transfer chunk of them is held in memory at a time.
+    """
+    blob = self.storage.bucket(bucket_name).blob(object_name, chunk_size=CHUNK_SIZE)
+    def upload():
+      with blob.open("wb", content_type=content_type, ignore_flush=True) as writer:
+        for chunk in chunks:
+          writer.write(chunk)
+        return writer.tell()
+    # The chunks cannot be read again, so a failed upload is not repeated here.
+    size = ratelimit.call("storage", "objects.upload", upload, attempts=1)
+    metrics.add_bytes("storage", "upload", size)
+    print(f"File {blob.name} uploaded to {bucket_name}.")
+
+  def download_data(self, bucket_name: str, object_name: str, max_bytes: int = None):
+    """Reads an object into memory, or returns None if it is gone or larger than max_bytes."""
+    blob = ratelimit.call("storage", "objects.get",
+                          lambda: self.storage.bucket(bucket_name).get_blob(object_name))
+    if blob is None or (max_bytes is not None and blob.size > max_bytes):
+      return None
+    data = ratelimit.call("storage", "objects.download",
+                          lambda: blob.download_as_bytes(if_generation_match=blob.generation))
+    metrics.add_bytes("storage", "download", len(data))
+    return data
+
+  def delete_blobs(self, bucket_name: str, blobs: list):
+    """
+    Deletes objects with batch requests of up to DELETE_BATCH_SIZE calls.
 
-    blob.delete(if_generation_match=generation_match_precondition)
+    blobs are dicts with the name and generation of each object, as returned
+    by list_bucket_files. Each delete is conditional on that generation, so
+    an object rewritten since it was listed is kept. An object that is
+    already gone counts as deleted, and deletes that are rate limited or
+    hit a server error are retried with backoff.
 
-    print(f"Blob {blob_name} deleted.")
+    Returns the names of the objects that were not deleted.
+    """
+    bucket = self.storage.bucket(bucket_name)
+    failed = set()
+    pending = list(blobs)
+    attempt = 0
+    while pending:
+      retry = []
+      rate_limited = False
+      for i in range(0, len(pending), DELETE_BATCH_SIZE):
+        chunk = pending[i:i + DELETE_BATCH_SIZE]
+        responses = ratelimit.call("storage", "batch.delete",
+                                   lambda: self._delete_batch(bucket, chunk),
+                                   cost=len(chunk))
+        # One response per deferred delete, in order.
+        for blob, response in zip(chunk, responses):
+          if 200 <= response.status_code < 300 or response.status_code == 404:
+            print(f"Blob {blob['name']} deleted.")
+          elif (response.status_code in ratelimit.RETRYABLE_STATUSES
+                and attempt + 1 < ratelimit.RETRY_ATTEMPTS):
+            retry.append(blob)
+            rate_limited |= response.status_code == 429
+          else:
+            print(f"Blob {blob['name']} not deleted: {response.status_code}")
+            failed.add(blob["name"])
+      if retry:
+        if rate_limited:
+          ratelimit.slow_down("storage")
+        metrics.record_retry("storage", "objects.delete")
+        time.sleep(ratelimit.backoff(attempt))
+        attempt += 1
+      pending = retry
+    return failed
+
+  def _delete_batch(self, bucket, blobs: list):
+    """Sends one batch of conditional deletes and returns a response per delete, in order."""
+    try:
+      with self.storage.batch(raise_exception=False) as batch:
+        for blob in blobs:
+          bucket.delete_blob(blob["name"], if_generation_match=blob.get("generation"))
+        responses = batch.finish(raise_exception=False)
+        # Leaving the block normally would send the batch a second time.
+        raise _BatchSent()
+    except _BatchSent:
+      return responses
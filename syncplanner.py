@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Reconciliation planner for the Drive to Cloud Storage sync.
+
+Planning has no side effects: it compares the Drive listing, the bucket
+listing and the manifest, and returns the transfers that would bring the
+bucket up to date. Every item is shaped like a Drive change, with the file
+id under "fileId", so the same items can be executed, retried or reported.
+
+Objects are content addressed: each is named after the MD5 of its content,
+so copies and shortcuts of one file share a single object. A reference map
+in Datastore records the files using each object, and a delete item
+removes one file's reference, deleting the object only with the last one.
+"""
+
+import datetime
+import mimetypes
+import os
+
+from driveservice import FOLDER_MIME_TYPE, MAX_FILE_SIZE, get_content_type, get_export_format
+
+# Object extension per stored content type. Other types fall back to
+# mimetypes, whose guesses for these vary between platforms.
+EXTENSIONS = {
+  "application/pdf": ".pdf",
+  "text/html": ".html",
+  "text/plain": ".txt",
+  "text/csv": ".csv",
+  "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ".docx",
+  "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": ".xlsx",
+  "application/vnd.openxmlformats-officedocument.presentationml.presentation": ".pptx",
+}
+# Files modified within this many days are transferred before older ones.
+RECENT_DAYS = float(os.environ.get('SYNC_RECENT_DAYS', 7))
+
+
+class SyncPlan:
+  """The transfers a sync will make, grouped by kind."""
+
+  def __init__(self):
+    # Binary files downloaded as-is.
+    self.uploads = []
+    # Google files exported again.
+    self.reexports = []
+    # References to drop, each with the file id and the blob it referenced.
+    # Those of files that will reference a new object once transferred are
+    # marked replaced.
+    self.deletes = []
+    # Files that cannot be exported or are larger than MAX_FILE_SIZE.
+    self.skipped = []
+    self.noops = 0
+    # Set when the changes cannot be planned and a full scan is needed,
+    # and on the full scan's plan that replaces them.
+    self.rescan = False
+    # The ids of the folders in the tree, listed by a full scan.
+    self.folder_ids = None
+
+  @classmethod
+  def from_items(cls, items):
+    """Rebuilds a plan from items saved by items()."""
+    plan = cls()
+    for item in items:
+      if "blob" in item:
+        plan.deletes.append(item)
+      else:
+        plan.add_transfer(item["file"])
+    return plan
+
+  def transfers(self):
+    """Returns the uploads and re-exports, most urgent first."""
+    recent_since = (datetime.datetime.now(datetime.timezone.utc)
+                    - datetime.timedelta(days=RECENT_DAYS)).strftime("%Y-%m-%dT%H:%M:%S")
+    return sorted(self.uploads + self.reexports,
+                  key=lambda item: priority(item, recent_since))
+
+  def items(self):
+    return self.deletes + self.transfers()
+
+  def to_dict(self):
+    return {
+      "uploads": [item["fileId"] for item in self.uploads],
+      "reexports": [item["fileId"] for item in self.reexports],
+      "deletes": [item["blob"]["name"] for item in self.deletes],
+      "skipped": self.skipped,
+      "noops": self.noops,
+      "rescan": self.rescan,
+    }
+
+  def add_transfer(self, file):
+    item = {"fileId": file["id"], "file": file}
+    if get_export_format(file["mimeType"]):
+      self.reexports.append(item)
+    else:
+      self.uploads.append(item)
+
+  def add_delete(self, file_id, blob, replaced=False):
+    item = {"fileId": file_id,
+            "blob": {"name": blob["name"], "generation": blob.get("generation")}}
+    # A replaced object's file is still synced, under its new object.
+    item["replaced" if replaced else "removed"] = True
+    self.deletes.append(item)
+
+
+class SyncPlanner:
+  """
+  Plans a full scan in time linear in the number of files and objects.
+
+  The bucket listing is indexed by object name up front. Drive files are
+  then added in batches, together with their manifest entries, so the
+  listing can be planned as it streams in. Objects no current file claimed
+  by the time the plan is finished have their references dropped.
+  """
+
+  def __init__(self, stored_blobs):
+    self.plan = SyncPlan()
+    self._stored = {blob["name"]: blob for blob in stored_blobs}
+    self._claimed = set()
+    self._synced_ids = set()
+
+  def add_files(self, files, manifest:dict):
+    """Plans a batch of Drive files against their manifest entries, keyed by id."""
+    for file in files:
+      if not is_syncable(file):
+        self.plan.skipped.append(file["id"])
+        continue
+      self._synced_ids.add(file["id"])
+      entry = manifest.get(file["id"])
+      name = entry["object_name"] if entry else None
+      if is_current(file, entry) and name in self._stored:
+        self._claimed.add(name)
+        self.plan.noops += 1
+      else:
+        self.plan.add_transfer(file)
+
+  def unclaimed(self):
+    """Returns the names of the objects no current file has claimed so far."""
+    return [name for name in self._stored if name not in self._claimed]
+
+  def finish(self, references:dict=None):
+    """
+    Drops every reference to the objects no current file claimed.
+
+    references maps those objects' names to the ids of the files recorded
+    as using them. An object with none recorded predates the reference map
+    and is named after its one file.
+    """
+    for name in self.unclaimed():
+      blob = self._stored[name]
+      file_ids = (references or {}).get(name, {}).get("file_ids") or [document_id(name)]
+      for file_id in file_ids:
+        self.plan.add_delete(file_id, blob, replaced=file_id in self._synced_ids)
+    self._stored = {}
+    return self.plan
+
+
+def plan_changes(changes, manifest:dict, in_folder, tree_folders:set=None):
+  """
+  Plans a batch of Drive changes.
+
+  in_folder is called with a changed file and says whether it sits under
+  the synced folder. Changed files that are no longer under it, or can no
+  longer be synced, have their objects deleted, using the object name and
+  generation in the manifest.
+
+  A folder that changed under the synced folder, or that was under it at
+  the last full scan, whose folder ids are tree_folders, calls for a full
+  scan. Changes to folders elsewhere are ignored. Without tree_folders
+  every folder change calls for one.
+  """
+  plan = SyncPlan()
+  for change in changes:
+    if change.get("replaced"):
+      # A retried delete of an object left behind by a rename.
+      plan.deletes.append(change)
+      continue
+    file = change.get("file") or {}
+    was_in_tree = change["fileId"] in (tree_folders or ())
+    if file.get("mimeType") == FOLDER_MIME_TYPE or was_in_tree:
+      # A moved folder carries its whole subtree with it, and the
+      # descendants do not show up in the feed themselves.
+      if (tree_folders is None or was_in_tree
+          or (not change.get("removed") and not file.get("trashed") and in_folder(file))):
+        plan.rescan = True
+        return plan
+      plan.noops += 1
+      continue
+
+    entry = manifest.get(change["fileId"])
+    synced = not change.get("removed") and not file.get("trashed") and in_folder(file)
+    skipped = synced and not is_syncable(file)
+    if skipped:
+      plan.skipped.append(change["fileId"])
+    if synced and not skipped:
+      # A transfer drops the file's reference to its old object itself.
+      if is_current(file, entry):
+        plan.noops += 1
+      else:
+        plan.add_transfer(file)
+    elif entry:
+      plan.add_delete(change["fileId"], {"name": entry["object_name"],
+                                          "generation": entry.get("generation")})
+    elif not skipped:
+      plan.noops += 1
+  return plan
+
+
+def object_name(file, content_hash:str=None):
+  """
+  Returns the name of the object a Drive file's content is stored as.
+
+  The name is the hex MD5 of the content, from Drive's md5Checksum for
+  binary files, and content_hash for exports, which Drive cannot hash.
+  Binary files without a checksum are named after their file id.
+  """
+  content_type = get_content_type(file["mimeType"])
+  extension = EXTENSIONS.get(content_type) or mimetypes.guess_extension(content_type) or ""
+  return f"{content_hash or file.get('md5Checksum') or file['id']}{extension}"
+
+
+def document_id(name:str):
+  """Returns the id an object is indexed under, its name without the extension."""
+  return name.rsplit(".", 1)[0]
+
+
+def priority(item, recent_since:str):
+  """
+  Sort key putting files modified since recent_since first, then smaller files.
+
+  Google files report no size, and their exports are small, so they sort
+  as small files.
+  """
+  file = item["file"]
+  # Drive's RFC 3339 UTC timestamps compare correctly as strings.
+  return (file.get("modifiedTime", "") < recent_since, int(file.get("size") or 0))
+
+
+def is_syncable(file):
+  """Checks that a file can be exported or downloaded and is small enough."""
+  if not get_content_type(file.get("mimeType", "")):
+    return False
+  return int(file.get("size") or 0) <= MAX_FILE_SIZE
+
+
+def is_current(file, entry):
+  """
+  Checks whether a manifest entry still matches the file in Drive.
+
+  Binary files are compared by md5Checksum. Google files have no checksum,
+  so their modifiedTime stands in for the content. version is recorded but
+  not compared, as it also moves on sharing and other metadata edits.
+  Entries without a content_hash predate content addressing, and their
+  files are transferred again.
+  """
+  if not entry or "content_hash" not in entry:
+    return False
+  if entry.get("export_format") != get_export_format(file["mimeType"]):
+    return False
+  if entry.get("content_type") != get_content_type(file["mimeType"]):
+    return False
+  if entry.get("targetId") != file.get("targetId"):
+    return False
+  if file.get("md5Checksum"):
+    return entry.get("content_hash") == file["md5Checksum"]
+  return entry.get("modifiedTime") == file.get("modifiedTime")
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Dispatch of sync work to task queue workers.
+
+With SYNC_DISPATCH=cloudtasks, transfers are posted as Cloud Tasks that
+call the app's /tasks route, so a large sync is spread over many requests
+and instances. SYNC_DISPATCH=local runs the same tasks on in-process
+threads, standing in for Cloud Tasks in tests and benchmarks.
+"""
+
+import base64
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import clients
+from transferpool import SYNC_WORKERS
+
+# "cloudtasks" or "local"; anything else transfers within the /watch request.
+SYNC_DISPATCH = os.environ.get('SYNC_DISPATCH', '')
+TASKS_API_ENDPOINT = os.environ.get('TASKS_API_ENDPOINT', 'https://cloudtasks.googleapis.com')
+TASK_LOCATION = os.environ.get('TASK_LOCATION', 'us-central1')
+TASK_QUEUE = os.environ.get('TASK_QUEUE', 'drive-sync')
+# Transfers per task. Cloud Tasks limits a task to 1 MiB.
+TASK_BATCH_SIZE = int(os.environ.get('TASK_BATCH_SIZE', 50))
+TASK_PATH = '/tasks'
+
+
+class LocalDispatcher:
+  """Runs tasks on worker threads in this process."""
+
+  def __init__(self, handler, max_workers:int=SYNC_WORKERS):
+    self.handler = handler
+    self._executor = ThreadPoolExecutor(max_workers=max_workers)
+    self._futures = []
+
+  def dispatch(self, payload:dict, path:str=None):
+    # Every task goes to the handler, whatever its path. Round trip through
+    # JSON, as a real task body would.
+    payload = json.loads(json.dumps(payload))
+    # Tasks that finished without an error have nothing left to report.
+    self._futures = [(queued, future) for queued, future in self._futures
+                     if not future.done() or future.exception()]
+    self._futures.append((payload, self._executor.submit(self.handler, payload)))
+
+  def wait(self):
+    """Waits for every dispatched task and returns the payload and error of each that raised."""
+    failed = []
+    for payload, future in self._futures:
+      error = future.exception()
+      if error:
+        print(f"Task failed: {error}")
+        failed.append((payload, error))
+    self._futures = []
+    return failed
+
+
+class CloudTasksDispatcher:
+  """Creates App Engine tasks on a Cloud Tasks queue with the REST API."""
+
+  def __init__(self, session=None, endpoint:str=TASKS_API_ENDPOINT, queue:str=None):
+    self._session = session
+    self.endpoint = endpoint.rstrip("/")
+    self.queue = queue or (f"projects/{os.environ.get('PROJECT')}/locations/"
+                           f"{TASK_LOCATION}/queues/{TASK_QUEUE}")
+
+  def dispatch(self, payload:dict, path:str=TASK_PATH, delay:float=None, name:str=None):
+    """
+    Creates a task that posts payload to path, delay seconds from now if given.
+
+    A task called name is only created once, and False is returned if the
+    queue already has or recently had one of that name.
+    """
+    body = base64.b64encode(json.dumps(payload).encode()).decode()
+    task = {
+      "appEngineHttpRequest": {
+        "httpMethod": "POST",
+        "relativeUri": path,
+        "headers": {"Content-Type": "application/json"},
+        "body": body,
+      }
+    }
+    if delay:
+      task["scheduleTime"] = time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                           time.gmtime(time.time() + delay))
+    if name:
+      task["name"] = f"{self.queue}/tasks/{name}"
+    response = self.session().post(f"{self.endpoint}/v2/{self.queue}/tasks", json={"task": task})
+    if name and response.status_code == 409:
+      return False
+    response.raise_for_status()
+    return True
+
+  def wait(self):
+    """Returns no failures, as Cloud Tasks retries failed tasks itself."""
+    return []
+
+  def session(self):
+    # Created on first use, as /tasks workers never dispatch.
+    if self._session is None:
+      self._session = clients.get("tasks")
+    return self._session
+
+
+def get_dispatcher(handler):
+  """Returns the dispatcher SYNC_DISPATCH selects, or None to transfer in-request."""
+  if SYNC_DISPATCH == 'cloudtasks':
+    return CloudTasksDispatcher()
+  if SYNC_DISPATCH == 'local':
+    return LocalDispatcher(handler)
+  return None
@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests of the answer cache shared through Datastore.
+"""
+
+import datetime
+import unittest
+from unittest import mock
+
+import answercache
+import clients
+from answercache import AnswerCache
+
+
+class DictClient:
+  """A Datastore client holding its entities in a dict."""
+
+  def __init__(self):
+    self.entities = {}
+
+  def key(self, *path, namespace=None):
+    return (namespace, *path)
+
+  def get(self, key):
+    return self.entities.get(key)
+
+  def put(self, entity):
+    self.entities[entity.key] = entity
+
+  def delete(self, key):
+    self.entities.pop(key, None)
+
+
+class SharedAnswerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.client = DictClient()
+    clients.register("datastore", self.client)
+    self.addCleanup(clients.register, "datastore", None)
+
+  def shared_cache(self):
+    # A fresh instance reads only what another instance shared.
+    return AnswerCache(backend="datastore", ttl=60)
+
+  def test_answer_is_shared_with_timestamp_expiry(self):
+    self.shared_cache().put("What is the policy?", "agent", {"text": "yes"})
+
+    (entity,) = self.client.entities.values()
+    self.assertIsInstance(entity["expires"], datetime.datetime)
+    self.assertEqual(self.shared_cache().get("what is the policy", "agent"), {"text": "yes"})
+
+  def test_expired_answer_is_deleted_when_read(self):
+    self.shared_cache().put("What is the policy?", "agent", {"text": "yes"})
+
+    with mock.patch.object(answercache.time, "time", return_value=4102444800.0):
+      self.assertIsNone(self.shared_cache().get("What is the policy?", "agent"))
+    self.assertEqual(self.client.entities, {})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests of async chat replies against a local fake of the Chat REST API.
+"""
+
+import json
+import os
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import requests
+
+import clients
+from chatreply import (CHAT_REPLY_PATH, PLACEHOLDER_MESSAGE, TIMEOUT_MESSAGE, AsyncReplier,
+                       ChatClient)
+from fakeservices import (ApiStats, FakeBackend, FakeDatastoreClient, FakeSessionsClient)
+
+os.environ.setdefault('AGENT_ID', 'test')
+os.environ.setdefault('PROJECT', 'test')
+
+
+class FakeChatApi(BaseHTTPRequestHandler):
+  """Records the messages created and updated, answering as the Chat API does."""
+
+  def do_POST(self):
+    self._record("POST")
+    if self.server.fail_creates:
+      self._respond(500, {"error": {"code": 500}})
+    else:
+      self._respond(200, {"name": f"{self.path.split('?')[0][len('/v1/'):]}/1"})
+
+  def do_PATCH(self):
+    self._record("PATCH")
+    self._respond(200, {})
+
+  def _record(self, method):
+    length = int(self.headers.get("Content-Length", 0))
+    with self.server.lock:
+      self.server.calls.append((method, self.path, json.loads(self.rfile.read(length))))
+
+  def _respond(self, status, body):
+    data = json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, *args):
+    pass
+
+
+class FakeDispatcher:
+  """Records the tasks created."""
+
+  def __init__(self):
+    self.tasks = []
+
+  def dispatch(self, payload:dict, path:str=None):
+    self.tasks.append({"payload": json.loads(json.dumps(payload)), "path": path})
+
+
+class AsyncReplyTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeChatApi)
+    cls.server.lock = threading.Lock()
+    threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+    clients.register("dialogflow", FakeSessionsClient(FakeBackend(ApiStats()),
+                                                      shapes=(("text", 1),)))
+    clients.register("datastore", FakeDatastoreClient(FakeBackend(ApiStats())))
+    import main
+    cls.main = main
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.server.shutdown()
+    cls.server.server_close()
+
+  def setUp(self):
+    self.server.calls = []
+    self.server.fail_creates = False
+    chat = ChatClient(session=requests.Session(),
+                      endpoint=f"http://127.0.0.1:{self.server.server_port}")
+    self.dispatcher = FakeDispatcher()
+    replier = AsyncReplier(lambda *args, **kwargs: self.main.answer_question(*args, **kwargs),
+                           chat=chat, dispatcher=self.dispatcher)
+    patches = [mock.patch.object(self.main, "CHAT_REPLY_MODE", "async"),
+               mock.patch.object(self.main, "async_replier", replier)]
+    for patch in patches:
+      patch.start()
+      self.addCleanup(patch.stop)
+
+  def post_question(self, text):
+    event = {"type": "MESSAGE",
+             "space": {"name": "spaces/test", "type": "DM"},
+             "user": {"name": "users/1", "displayName": "Test User"},
+             "message": {"text": text, "thread": {"name": "spaces/test/threads/1"}}}
+    return self.main.app.test_client().post("/chat", json=event)
+
+  def run_task(self, payload, headers=None):
+    return self.main.app.test_client().post(
+        CHAT_REPLY_PATH, json=payload,
+        headers={"X-AppEngine-QueueName": "drive-sync"} if headers is None else headers)
+
+  def wait_for_calls(self, count, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+      with self.server.lock:
+        if len(self.server.calls) >= count:
+          return list(self.server.calls)
+      time.sleep(0.01)
+    self.fail(f"Chat API got {len(self.server.calls)} calls, expected {count}")
+
+  def test_answer_replaces_placeholder(self):
+    response = self.post_question("What is the refund policy?")
+
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response.get_json(), {})
+    (task,) = self.dispatcher.tasks
+    self.assertEqual(task["path"], CHAT_REPLY_PATH)
+    self.assertEqual(self.run_task(task["payload"]).status_code, 200)
+    (create_method, create_path, create_body), (update_method, update_path, update_body) = \
+        self.wait_for_calls(2)
+    self.assertEqual(create_method, "POST")
+    self.assertTrue(create_path.startswith("/v1/spaces/test/messages?"))
+    self.assertEqual(create_body, {"text": PLACEHOLDER_MESSAGE,
+                                   "thread": {"name": "spaces/test/threads/1"}})
+    self.assertEqual(update_method, "PATCH")
+    self.assertEqual(update_path, "/v1/spaces/test/messages/1?updateMask=text")
+    self.assertEqual(update_body,
+                     {"text": "This is a generated answer to: What is the refund policy?"})
+
+  def test_answers_in_request_when_placeholder_fails(self):
+    self.server.fail_creates = True
+
+    response = self.post_question("What is the travel policy?")
+
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response.get_json(),
+                     {"text": "This is a generated answer to: What is the travel policy?"})
+    self.assertEqual([method for method, _, _ in self.wait_for_calls(1)], ["POST"])
+
+
+  def test_deadline_counts_time_in_queue(self):
+    self.post_question("What is the leave policy?")
+    (task,) = self.dispatcher.tasks
+    task["payload"]["submitted"] -= self.main.async_replier.deadline
+
+    with mock.patch.object(self.main, "answer_question") as answer_question:
+      self.run_task(task["payload"])
+
+    answer_question.assert_not_called()
+    self.assertEqual(self.wait_for_calls(2)[1][2], {"text": TIMEOUT_MESSAGE})
+
+  def test_reply_route_only_serves_cloud_tasks(self):
+    self.post_question("What is the leave policy?")
+    (task,) = self.dispatcher.tasks
+
+    self.assertEqual(self.run_task(task["payload"], headers={}).status_code, 403)
+    self.assertEqual(len(self.wait_for_calls(1)), 1)
+
+  def test_local_dispatch_answers_on_threads(self):
+    replier = AsyncReplier(self.main.async_replier.answer_fn,
+                           chat=self.main.async_replier.chat())
+    with mock.patch("chatreply.CHAT_REPLY_DISPATCH", "local"), \
+         mock.patch.object(self.main, "async_replier", replier):
+      self.post_question("What is the refund policy?")
+
+    self.assertEqual(self.wait_for_calls(2)[1][2],
+                     {"text": "This is a generated answer to: What is the refund policy?"})
+
+
+if __name__ == '__main__':
+  unittest.main()
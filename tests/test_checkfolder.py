@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests of the dispatch of sync work to the configured targets.
+"""
+
+import json
+import os
+import unittest
+from unittest import mock
+
+import checkfolder
+
+TARGETS = [{"name": "sales", "folder_id": "folder-1", "bucket": "sales",
+            "datastore_id": "sales-docs"}]
+
+
+class SyncTaskTest(unittest.TestCase):
+
+  def setUp(self):
+    patch = mock.patch.dict(os.environ, {"SYNC_TARGETS": json.dumps(TARGETS)})
+    patch.start()
+    self.addCleanup(patch.stop)
+
+  def test_task_for_removed_target_is_dropped(self):
+    with mock.patch.object(checkfolder, "watch_for") as watch_for:
+      checkfolder.run_sync_task({"target": "marketing", "bucket_name": "b", "items": []})
+
+    watch_for.assert_not_called()
+
+  def test_task_runs_on_its_target(self):
+    with mock.patch.object(checkfolder, "watch_for") as watch_for:
+      checkfolder.run_sync_task({"target": "sales", "bucket_name": "b", "items": []})
+
+    self.assertEqual(watch_for.call_args.args[0].datastore_id, "sales-docs")
+    watch_for.return_value.run_task.assert_called_once_with(target="sales", bucket_name="b",
+                                                            items=[])
+
+
+class SearchDatastoreTest(unittest.TestCase):
+
+  def test_single_target_datastore_is_searched(self):
+    with mock.patch.dict(os.environ, {"SYNC_TARGETS": json.dumps(TARGETS)}):
+      os.environ.pop("DATASTORE_ID", None)
+      self.assertEqual(checkfolder.search_datastore_id(), "sales-docs")
+
+  def test_several_targets_need_datastore_id(self):
+    targets = TARGETS + [dict(TARGETS[0], name="marketing", datastore_id="marketing-docs")]
+    with mock.patch.dict(os.environ, {"SYNC_TARGETS": json.dumps(targets)}):
+      os.environ.pop("DATASTORE_ID", None)
+      with self.assertRaises(ValueError):
+        checkfolder.search_datastore_id()
+      os.environ["DATASTORE_ID"] = "marketing-docs"
+      self.assertEqual(checkfolder.search_datastore_id(), "marketing-docs")
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests of syncs against the fakes of the Google services.
+"""
+
+import json
+import unittest
+from unittest import mock
+
+from google.api_core.exceptions import NotFound
+
+import drivewatch
+from drivewatch import IMPORT_ATTEMPTS, DriveWatch
+from fakeservices import (ApiStats, FakeBackend, FakeDatastore, FakeDiscoveryEngine,
+                          FakeDrive, FakeStorage)
+from driveservice import FOLDER_MIME_TYPE, get_export_format
+from syncplanner import document_id, object_name
+from taskqueue import LocalDispatcher
+
+FOLDER_ID = "root"
+BUCKET_NAME = "test_bucket"
+
+
+class FailingStorage(FakeStorage):
+  """A bucket whose uploads from the files in failing raise, and which lists the uploads made."""
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.failing = set()
+    self.error = RuntimeError
+    self.uploads = []
+
+  def upload_file(self, bucket_name:str, file_id:str, mime_type:str, object_name:str,
+                  md5_checksum:str=None):
+    if file_id in self.failing:
+      raise self.error(f"upload of {file_id} failed")
+    generation = super().upload_file(bucket_name, file_id, mime_type, object_name,
+                                     md5_checksum)
+    self.uploads.append(object_name)
+    return generation
+
+
+class FailingDiscoveryEngine(FakeDiscoveryEngine):
+  """Discovery Engine whose next updateCorpus raises once raising is set, and whose imports fail while failing is."""
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.raising = False
+    self.failing = False
+
+  def updateCorpus(self, documents:list=None, deleted_ids:list=None):
+    if self.raising:
+      self.raising = False
+      raise RuntimeError("import failed")
+    return super().updateCorpus(documents, deleted_ids)
+
+  def poll_operations(self, names:list):
+    pending, failed = super().poll_operations(names)
+    return pending, list(names) if self.failing else failed
+
+
+class SyncTest(unittest.TestCase):
+
+  def setUp(self):
+    backend = FakeBackend(ApiStats())
+    self.drive = FakeDrive(backend, FOLDER_ID, 20, mean_size=1024)
+    self.storage = FailingStorage(backend, self.drive)
+    self.datastore = FakeDatastore(backend)
+    self.discovery = FailingDiscoveryEngine(backend)
+    self.watch = DriveWatch(drive=self.drive, storage=self.storage, datastore=self.datastore,
+                            discovery=self.discovery, dispatcher=None)
+
+  def sync(self):
+    self.watch.check_files(folder_id=FOLDER_ID, bucket_name=BUCKET_NAME)
+
+  def binary_file(self):
+    return next(file for file in self.drive._files.values()
+                if not get_export_format(file["mimeType"]))
+
+  def edit(self, file):
+    self.drive._touch(file)
+    self.drive._changes.append({"fileId": file["id"], "file": dict(file)})
+
+  def dry_run(self):
+    return self.watch.check_files(folder_id=FOLDER_ID, bucket_name=BUCKET_NAME, dry_run=True)
+
+  def add_folder(self, folder_id, parent):
+    folder = {"id": folder_id, "name": folder_id, "mimeType": FOLDER_MIME_TYPE,
+              "parents": [parent]}
+    self.drive._children[parent].append(folder)
+    self.drive._parents[folder_id] = parent
+    self.drive._changes.append({"fileId": folder_id, "file": dict(folder)})
+
+  def move_folder(self, folder_id, parent):
+    folder = next(file for file in self.drive._children[self.drive._parents[folder_id]]
+                  if file["id"] == folder_id)
+    self.drive._children[folder["parents"][0]].remove(folder)
+    folder["parents"] = [parent]
+    self.drive._children[parent].append(folder)
+    self.drive._parents[folder_id] = parent
+    self.drive._changes.append({"fileId": folder_id, "file": dict(folder)})
+
+  def retry_ids(self):
+    return [item["fileId"]
+            for item in json.loads(self.datastore.fetch("retry_changes") or "[]")]
+
+  def test_failed_local_task_is_retried(self):
+    self.watch.dispatcher = LocalDispatcher(lambda payload: self.watch.run_task(**payload))
+    file = self.binary_file()
+    self.storage.failing.add(file["id"])
+
+    self.sync()
+
+    self.assertIn(file["id"], self.retry_ids())
+    self.assertNotIn(file["id"], self.datastore.get_manifest([file["id"]]))
+
+    self.storage.failing.clear()
+    self.sync()
+
+    self.assertEqual(self.retry_ids(), [])
+    entry = self.datastore.get_manifest([file["id"]])[file["id"]]
+    self.assertIn(entry["object_name"], self.storage.objects)
+
+  def test_retry_gives_way_to_newer_change(self):
+    self.sync()
+    file = self.binary_file()
+    self.storage.failing.add(file["id"])
+    self.edit(file)
+    self.sync()
+    self.assertIn(file["id"], self.retry_ids())
+
+    self.storage.failing.clear()
+    self.edit(file)
+    self.sync()
+
+    entry = self.datastore.get_manifest([file["id"]])[file["id"]]
+    self.assertEqual(entry["md5Checksum"], file["md5Checksum"])
+    # Every stored object is referenced by a file.
+    self.assertEqual(set(self.storage.objects), set(self.datastore.references["object_refs"]))
+
+  def test_permanent_failure_is_not_retried(self):
+    self.sync()
+    file = self.binary_file()
+    self.storage.failing.add(file["id"])
+    self.storage.error = NotFound
+    self.edit(file)
+
+    self.sync()
+
+    self.assertEqual(self.retry_ids(), [])
+
+  def test_stale_snapshot_is_not_stored_under_its_checksum(self):
+    self.sync()
+    file = self.binary_file()
+    self.edit(file)
+    stale = dict(file)
+    # Edited again after the feed was read.
+    self.drive._touch(file)
+
+    self.sync()
+
+    self.assertNotIn(object_name(stale), self.storage.objects)
+    self.assertIn(file["id"], self.retry_ids())
+
+    self.drive._changes.append({"fileId": file["id"], "file": dict(file)})
+    self.sync()
+
+    entry = self.datastore.get_manifest([file["id"]])[file["id"]]
+    self.assertEqual(entry["md5Checksum"], file["md5Checksum"])
+    self.assertEqual(self.retry_ids(), [])
+    self.assertEqual(set(self.storage.objects), set(self.datastore.references["object_refs"]))
+
+  def test_copies_are_uploaded_once(self):
+    original, copy = [file for file in self.drive._files.values()
+                      if not get_export_format(file["mimeType"])][:2]
+    copy.update(mimeType=original["mimeType"], md5Checksum=original["md5Checksum"])
+
+    self.sync()
+
+    manifest = self.datastore.get_manifest([original["id"], copy["id"]])
+    name = manifest[original["id"]]["object_name"]
+    self.assertEqual(self.storage.uploads.count(name), 1)
+    self.assertEqual(manifest[copy["id"]]["object_name"], name)
+    self.assertEqual(manifest[copy["id"]]["generation"], manifest[original["id"]]["generation"])
+
+  def test_failed_import_is_retried_with_its_transfer(self):
+    self.sync()
+    file = self.binary_file()
+    self.edit(file)
+    self.discovery.raising = True
+
+    with self.assertRaises(RuntimeError):
+      self.sync()
+
+    self.assertNotEqual(self.datastore.get_manifest([file["id"]])[file["id"]]["md5Checksum"],
+                        file["md5Checksum"])
+    imported = self.discovery.imported
+    self.sync()
+
+    self.assertEqual(self.discovery.imported, imported + 1)
+    self.assertEqual(self.datastore.get_manifest([file["id"]])[file["id"]]["md5Checksum"],
+                     file["md5Checksum"])
+
+  def test_failed_import_is_started_again(self):
+    self.sync()
+    self.edit(self.binary_file())
+    self.sync()
+    imported = self.discovery.imported
+    self.discovery.failing = True
+
+    for attempt in range(2, IMPORT_ATTEMPTS + 1):
+      self.sync()
+      self.assertEqual(self.discovery.imported, imported + attempt - 1)
+      self.assertEqual([row["attempts"] for row in self.datastore.get_rows("imports").values()],
+                       [attempt])
+    self.sync()
+
+    self.assertEqual(self.discovery.imported, imported + IMPORT_ATTEMPTS - 1)
+    self.assertEqual(self.datastore.get_rows("imports"), {})
+
+  def test_chunks_are_streamed_to_import_files(self):
+    with mock.patch.object(drivewatch, "CHUNKED_IMPORT", True), \
+        mock.patch.object(drivewatch, "CHUNK_IMPORT_BATCH_SIZE", 2):
+      self.sync()
+
+    chunks = sum(len(row["chunk_ids"])
+                 for row in self.datastore.get_rows("chunks").values())
+    files = [blob for name, blob in self.storage.objects.items()
+             if name.startswith(drivewatch.IMPORT_PREFIX)]
+    self.assertGreater(chunks, 0)
+    self.assertEqual(len(files), -(-chunks // 2))
+    self.assertEqual(self.discovery.jsonl_imports, len(files))
+    self.assertTrue(all(blob["size"] for blob in files))
+
+  def test_documents_left_at_deadline_are_imported_whole(self):
+    self.sync()
+    documents = [{"id": document_id(name), "uri": f"gs://{BUCKET_NAME}/{name}",
+                  "mime_type": row["content_type"], "file_id": row["file_ids"][0],
+                  "object_name": name, "stored": True}
+                 for name, row in self.datastore.references["object_refs"].items()]
+
+    whole, removed, operations = self.watch._import_chunks(BUCKET_NAME, documents, [], {},
+                                                           deadline=0)
+
+    self.assertEqual(whole, documents)
+    self.assertEqual((removed, operations), ([], []))
+
+  def test_dry_run_reports_rescan(self):
+    self.assertTrue(self.dry_run()["rescan"])
+    self.sync()
+    self.assertFalse(self.dry_run()["rescan"])
+
+    self.add_folder("subfolder", FOLDER_ID)
+
+    self.assertTrue(self.dry_run()["rescan"])
+
+  def test_folder_change_outside_tree_does_not_rescan(self):
+    self.sync()
+
+    self.add_folder("elsewhere", "other-root")
+    self.move_folder("elsewhere", "another-root")
+
+    self.assertFalse(self.dry_run()["rescan"])
+
+  def test_folder_moved_out_of_tree_rescans(self):
+    self.add_folder("subfolder", FOLDER_ID)
+    self.sync()
+
+    self.move_folder("subfolder", "other-root")
+
+    self.assertTrue(self.dry_run()["rescan"])
+
+
+if __name__ == '__main__':
+  unittest.main()
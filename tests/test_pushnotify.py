@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests of push notifications, posted to the app as Drive would post them.
+"""
+
+import json
+import os
+import unittest
+from unittest import mock
+
+import pushnotify
+from fakeservices import ApiStats, FakeBackend, FakeDatastore
+from lease import LeaseHeld
+from pushnotify import (PUSH_DEBOUNCE, PUSH_RETRY_ATTEMPTS, PUSH_RETRY_MAX_DELAY,
+                        PUSH_SYNC_PATH, PushChannels, SyncScheduler)
+
+os.environ.setdefault('PROJECT', 'test')
+
+CHANNEL = {"id": "channel-1", "resourceId": "resource-1",
+           "expiration": 4102444800000, "token": "secret"}
+
+
+class FakeDispatcher:
+  """Records the tasks created, refusing a name already taken as Cloud Tasks does."""
+
+  def __init__(self):
+    self.tasks = []
+
+  def dispatch(self, payload:dict, path:str=None, delay:float=None, name:str=None):
+    if name and any(task["name"] == name for task in self.tasks):
+      return False
+    self.tasks.append({"payload": payload, "path": path, "delay": delay, "name": name})
+    return True
+
+
+class PushNotificationTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    import main
+    cls.client = main.app.test_client()
+
+  def setUp(self):
+    datastore = FakeDatastore(FakeBackend(ApiStats()))
+    datastore.store(key="push_channel", value=json.dumps(CHANNEL))
+    self.dispatcher = FakeDispatcher()
+    patches = [mock.patch.object(pushnotify, "channels", PushChannels(datastore=datastore)),
+               mock.patch.object(pushnotify, "scheduler", SyncScheduler(self.dispatcher)),
+               # Keeps the burst within one debounce window.
+               mock.patch.object(pushnotify.time, "time", return_value=1000.0)]
+    for patch in patches:
+      patch.start()
+      self.addCleanup(patch.stop)
+
+  def notify(self, state="change", token=CHANNEL["token"]):
+    return self.client.post("/push", headers={"X-Goog-Channel-ID": CHANNEL["id"],
+                                              "X-Goog-Channel-Token": token,
+                                              "X-Goog-Resource-State": state})
+
+  def run_task(self, payload, headers=None):
+    return self.client.post(PUSH_SYNC_PATH, json=payload,
+                            headers={"X-AppEngine-QueueName": "drive-sync"}
+                            if headers is None else headers)
+
+  def test_burst_schedules_one_sync(self):
+    for _ in range(5):
+      self.assertEqual(self.notify().status_code, 200)
+
+    self.assertEqual(self.dispatcher.tasks, [{"payload": {"attempt": 0}, "path": PUSH_SYNC_PATH,
+                                              "delay": PUSH_DEBOUNCE,
+                                              "name": self.dispatcher.tasks[0]["name"]}])
+    # Another instance's notifications of the burst are refused by name.
+    self.assertFalse(SyncScheduler(self.dispatcher).trigger())
+
+  def test_unknown_channel_and_sync_messages_schedule_nothing(self):
+    self.assertEqual(self.notify(token="forged").status_code, 403)
+    self.assertEqual(self.notify(state="sync").status_code, 200)
+
+    self.assertEqual(self.dispatcher.tasks, [])
+
+  def test_sync_runs_in_task(self):
+    with mock.patch("checkfolder.trigger_drive_watch") as trigger:
+      response = self.run_task({"attempt": 0})
+
+    self.assertEqual(response.status_code, 200)
+    trigger.assert_called_once_with()
+    self.assertEqual(self.dispatcher.tasks, [])
+
+  def test_held_lease_puts_sync_off_with_backoff(self):
+    with mock.patch("checkfolder.trigger_drive_watch",
+                    side_effect=LeaseHeld({"holder": "other"})):
+      for attempt in range(PUSH_RETRY_ATTEMPTS):
+        self.assertEqual(self.run_task({"attempt": attempt}).status_code, 200)
+
+    self.assertEqual([task["payload"]["attempt"] for task in self.dispatcher.tasks],
+                     list(range(1, PUSH_RETRY_ATTEMPTS)))
+    delays = [task["delay"] for task in self.dispatcher.tasks]
+    self.assertEqual(delays, sorted(delays))
+    self.assertGreater(delays[0], PUSH_DEBOUNCE)
+    self.assertLessEqual(delays[-1], PUSH_RETRY_MAX_DELAY)
+
+  def test_sync_route_only_serves_cloud_tasks(self):
+    with mock.patch("checkfolder.trigger_drive_watch") as trigger:
+      response = self.run_task({"attempt": 0}, headers={})
+
+    self.assertEqual(response.status_code, 403)
+    trigger.assert_not_called()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Plain text extraction and chunking of synced documents.
+
+HTML, plain text and the Office formats are read with the standard
+library. PDFs need pypdf, and are reported as not extractable without it.
+"""
+
+import hashlib
+import importlib.util
+import io
+import os
+import re
+import zipfile
+from html.parser import HTMLParser
+from xml.etree import ElementTree
+
+# Characters per chunk. Paragraphs are kept whole where they fit.
+TEXT_CHUNK_SIZE = int(os.environ.get('TEXT_CHUNK_SIZE', 2000))
+# pypdf is only imported when a PDF is read.
+_HAS_PYPDF = importlib.util.find_spec("pypdf") is not None
+
+_WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_DRAWING_NS = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+_SHEET_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+
+
+def extract_text(data:bytes, content_type:str):
+  """Returns the text of a document, or None if its type cannot be read here."""
+  extractor = _EXTRACTORS.get(content_type)
+  if extractor is None:
+    return None
+  return extractor(data)
+
+
+def is_extractable(content_type:str):
+  if content_type == "application/pdf" and not _HAS_PYPDF:
+    return False
+  return content_type in _EXTRACTORS
+
+
+def chunk_text(text:str, size:int=TEXT_CHUNK_SIZE):
+  """
+  Splits text into chunks of at most size characters.
+
+  Paragraphs are packed into chunks whole, and only paragraphs longer than
+  a chunk are split, at whitespace. An edit therefore only changes the
+  chunks around it.
+  """
+  chunks = []
+  current = ""
+  for paragraph in re.split(r"\n\s*\n", text):
+    paragraph = " ".join(paragraph.split())
+    while len(paragraph) > size:
+      cut = paragraph.rfind(" ", 0, size + 1)
+      cut = cut if cut > 0 else size
+      if current:
+        chunks.append(current)
+        current = ""
+      chunks.append(paragraph[:cut])
+      paragraph = paragraph[cut:].lstrip()
+    if not paragraph:
+      continue
+    if current and len(current) + 2 + len(paragraph) > size:
+      chunks.append(current)
+      current = ""
+    current = f"{current}\n\n{paragraph}" if current else paragraph
+  if current:
+    chunks.append(current)
+  return chunks
+
+
+def chunk_id(file_id:str, chunk:str):
+  """Returns a document id for a chunk, stable for as long as its text is unchanged."""
+  return f"{file_id}-{hashlib.md5(chunk.encode()).hexdigest()[:16]}"
+
+
+class _HtmlText(HTMLParser):
+  _BLOCKS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6",
+             "table", "ul", "ol", "blockquote", "pre", "hr"}
+  _SKIPPED = {"script", "style", "head", "title"}
+
+  def __init__(self):
+    super().__init__()
+    self.parts = []
+    self._skipping = 0
+
+  def handle_starttag(self, tag, attrs):
+    if tag in self._SKIPPED:
+      self._skipping += 1
+    elif tag in self._BLOCKS:
+      self.parts.append("\n\n")
+
+  def handle_endtag(self, tag):
+    if tag in self._SKIPPED:
+      self._skipping = max(0, self._skipping - 1)
+    elif tag in self._BLOCKS:
+      self.parts.append("\n\n")
+
+  def handle_data(self, data):
+    if not self._skipping:
+      self.parts.append(data)
+
+
+def _html(data):
+  parser = _HtmlText()
+  parser.feed(data.decode("utf-8", "replace"))
+  parser.close()
+  return "".join(parser.parts)
+
+
+def _plain(data):
+  return data.decode("utf-8", "replace")
+
+
+def _paragraphs(xml, paragraph_tag, text_tag):
+  root = ElementTree.fromstring(xml)
+  return "\n\n".join("".join(node.text or "" for node in paragraph.iter(text_tag))
+                     for paragraph in root.iter(paragraph_tag))
+
+
+def _docx(data):
+  with zipfile.ZipFile(io.BytesIO(data)) as archive:
+    return _paragraphs(archive.read("word/document.xml"), f"{_WORD_NS}p", f"{_WORD_NS}t")
+
+
+def _pptx(data):
+  with zipfile.ZipFile(io.BytesIO(data)) as archive:
+    slides = sorted((name for name in archive.namelist()
+                     if re.fullmatch(r"ppt/slides/slide\d+\.xml", name)),
+                    key=lambda name: int(re.search(r"\d+", name).group()))
+    return "\n\n".join(_paragraphs(archive.read(name), f"{_DRAWING_NS}p", f"{_DRAWING_NS}t")
+                       for name in slides)
+
+
+def _xlsx(data):
+  with zipfile.ZipFile(io.BytesIO(data)) as archive:
+    names = archive.namelist()
+    shared = []
+    if "xl/sharedStrings.xml" in names:
+      root = ElementTree.fromstring(archive.read("xl/sharedStrings.xml"))
+      shared = ["".join(node.text or "" for node in item.iter(f"{_SHEET_NS}t"))
+                for item in root.iter(f"{_SHEET_NS}si")]
+    sheets = sorted((name for name in names
+                     if re.fullmatch(r"xl/worksheets/sheet\d+\.xml", name)),
+                    key=lambda name: int(re.search(r"\d+", name).group()))
+    # A sheet is one paragraph, so chunks hold whole sheets where they fit.
+    text = []
+    for name in sheets:
+      rows = []
+      for row in ElementTree.fromstring(archive.read(name)).iter(f"{_SHEET_NS}row"):
+        cells = []
+        for cell in row.iter(f"{_SHEET_NS}c"):
+          value = cell.find(f"{_SHEET_NS}v")
+          if cell.get("t") == "s" and value is not None:
+            cells.append(shared[int(value.text)])
+          elif cell.get("t") == "inlineStr":
+            cells.append("".join(node.text or "" for node in cell.iter(f"{_SHEET_NS}t")))
+          elif value is not None:
+            cells.append(value.text or "")
+        if any(cells):
+          rows.append("\t".join(cells))
+      text.append("\n".join(rows))
+    return "\n\n".join(text)
+
+
+def _pdf(data):
+  # pypdf searches the whole of a file without a header before giving up.
+  if b"%PDF-" not in data[:1024]:
+    return None
+  from pypdf import PdfReader
+  return "\n\n".join(page.extract_text() or "" for page in PdfReader(io.BytesIO(data)).pages)
+
+
+_EXTRACTORS = {
+  "text/html": _html,
+  "text/plain": _plain,
+  "application/pdf": _pdf,
+  "application/vnd.openxmlformats-officedocument.wordprocessingml.document": _docx,
+  "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": _xlsx,
+  "application/vnd.openxmlformats-officedocument.presentationml.presentation": _pptx,
+}
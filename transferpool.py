@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+
+"""
+Copyright 2024 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Worker pool for Drive to Cloud Storage transfers.
+"""
+
+import collections
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+SYNC_WORKERS = int(os.environ.get('SYNC_WORKERS', 8))
+
+
+class TransferResult:
+  """Outcome of a single upload, export or delete."""
+
+  def __init__(self, action:str, item, value=None, error:Exception=None):
+    self.action = action
+    self.item = item
+    self.value = value
+    self.error = error
+
+  @property
+  def ok(self):
+    return self.error is None
+
+
+class FairScheduler:
+  """
+  Shares a fixed number of transfer slots between sync targets.
+
+  A freed slot goes to the waiting targets in turn, so a target with a
+  long queue of transfers gets no more than its share while others wait.
+  """
+
+  def __init__(self, slots:int=SYNC_WORKERS):
+    self._lock = threading.Lock()
+    self._free = slots
+    # Waiting targets in turn order, each with its waiters in order.
+    self._waiting = collections.OrderedDict()
+
+  @contextmanager
+  def slot(self, target:str):
+    self._acquire(target)
+    try:
+      yield
+    finally:
+      self._release()
+
+  def _acquire(self, target):
+    with self._lock:
+      if self._free:
+        self._free -= 1
+        return
+      event = threading.Event()
+      self._waiting.setdefault(target, collections.deque()).append(event)
+    event.wait()
+
+  def _release(self):
+    with self._lock:
+      if not self._waiting:
+        self._free += 1
+        return
+      # Hand the slot straight to the next target, which then goes to the
+      # back of the turn order.
+      target, events = self._waiting.popitem(last=False)
+      event = events.popleft()
+      if events:
+        self._waiting[target] = events
+    event.set()
+
+
+class TransferPool:
+  """
+  Runs transfers on a bounded pool of worker threads.
+
+  Each task is reported on its own, so an exception fails only the item it
+  was raised for. Submitting blocks once twice max_workers tasks are
+  waiting, which keeps a long listing from being queued up all at once.
+
+  With a scheduler, each task also holds one of its slots, taken in the
+  name of target, while it runs.
+  """
+
+  def __init__(self, max_workers:int=SYNC_WORKERS, scheduler:FairScheduler=None,
+               target:str=None):
+    self.scheduler = scheduler
+    self.target = target
+    self._executor = ThreadPoolExecutor(max_workers=max_workers)
+    self._slots = threading.BoundedSemaphore(max_workers * 2)
+    self._futures = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self._executor.shutdown(wait=True)
+
+  def submit(self, action:str, item, fn, *args, **kwargs):
+    self._slots.acquire()
+    future = self._executor.submit(self._run, action, item, fn, args, kwargs)
+    future.add_done_callback(lambda _: self._slots.release())
+    self._futures.append(future)
+
+  def wait(self):
+    """Waits for every submitted task and returns their results in order."""
+    results = [future.result() for future in self._futures]
+    self._futures = []
+    return results
+
+  def _run(self, action, item, fn, args, kwargs):
+    try:
+      if self.scheduler:
+        with self.scheduler.slot(self.target):
+          return TransferResult(action, item, value=fn(*args, **kwargs))
+      return TransferResult(action, item, value=fn(*args, **kwargs))
+    except Exception as error:
+      print(f"{action} of {item} failed: {error}")
+      return TransferResult(action, item, error=error)